@@ -0,0 +1 @@
+"""Performance benchmarks and synthetic cohort generation for AMRrules."""
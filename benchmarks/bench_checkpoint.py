@@ -0,0 +1,64 @@
+"""
+Checks for resuming checkpointed runs (amrrules --checkpoint-dir ... --resume): which rows are read past as
+already done, and that a run isn't resumed once the samples selected with --samples have changed.
+
+Run from the repository root with:
+    pytest benchmarks/bench_checkpoint.py
+"""
+
+import argparse
+
+import pytest
+
+from amrrules.checkpoint import Checkpoint, iter_sample_batches, run_fingerprint
+from amrrules.sample_index import parse_sample_list
+
+ROWS = [{'Name': name, 'row': i} for i, name in enumerate(['s1', 's1', 's2', 's3', 's3', 's3', 's4'])]
+
+
+def _batches(rows, batch_size, completed_samples=None, rows_done=0):
+    return [([row['row'] for row in batch_rows], samples)
+            for batch_rows, samples in iter_sample_batches(iter(rows), batch_size, completed_samples, rows_done)]
+
+
+def test_batches_split_between_samples():
+    assert _batches(ROWS, 2) == [([0, 1, 2], ['s1', 's2']), ([3, 4, 5, 6], ['s3', 's4'])]
+
+
+def test_resume_skips_completed_samples():
+    assert _batches(ROWS, 2, ['s1', 's2'], 3) == [([3, 4, 5, 6], ['s3', 's4'])]
+    assert _batches(ROWS, 2, ['s1', 's2', 's3', 's4'], 7) == []
+
+
+def test_resume_checks_rows_of_completed_samples():
+    # the completed samples had a different number of rows in the checkpointed run
+    with pytest.raises(ValueError, match='Cannot resume'):
+        _batches(ROWS, 2, ['s1', 's2'], 2)
+    with pytest.raises(ValueError, match='Cannot resume'):
+        _batches(ROWS, 2, ['s1', 's2', 's3', 's4'], 6)
+
+
+def test_completed_sample_later_in_input():
+    rows = ROWS + [{'Name': 's1', 'row': 7}]
+    with pytest.raises(ValueError, match='more than one place'):
+        _batches(rows, 2, ['s1', 's2'], 3)
+
+
+def test_resume_refused_when_samples_file_changes(tmp_path):
+    input_file = tmp_path / "input.tsv"
+    input_file.write_text("Name\tGene symbol\n")
+    samples_file = tmp_path / "samples.txt"
+    samples_file.write_text("s1\ns2\n")
+    args = argparse.Namespace(input=str(input_file), organism_file=None, samples=str(samples_file))
+
+    def fingerprint():
+        return run_fingerprint(args, {'amrfp': 'a', 'card': 'c'}, parse_sample_list(args.samples))
+
+    checkpoint_dir = tmp_path / "checkpoint"
+    Checkpoint(checkpoint_dir, fingerprint())
+    # the same samples in a different order are the same selection
+    samples_file.write_text("s2\ns1\n")
+    Checkpoint(checkpoint_dir, fingerprint(), resume=True)
+    samples_file.write_text("s1\ns2\ns3\n")
+    with pytest.raises(ValueError, match='selected samples differ'):
+        Checkpoint(checkpoint_dir, fingerprint(), resume=True)
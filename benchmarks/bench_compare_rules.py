@@ -0,0 +1,97 @@
+"""
+Checks for comparing two rulesets (amrrules --compare-rules): the bundled rules against a copy of themselves, then
+against a copy with one rule changed, on the bundled Klebsiella pneumoniae genomes.
+
+Run from the repository root with:
+    pytest benchmarks/bench_compare_rules.py
+"""
+
+import csv
+import shutil
+from pathlib import Path
+
+import pytest
+
+from amrrules import rules_engine
+from amrrules.cli import build_parser
+from benchmarks.conftest import quiet
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+RULES_DIR = REPO_DIR / "src" / "amrrules" / "rules"
+INPUT_FILE = REPO_DIR / "tests" / "data" / "input" / "test_kpneumo_20strains.tsv"
+ORGANISM = 's__Klebsiella pneumoniae'
+
+
+def _old_rules(tmp_path, category=None):
+    """A copy of the bundled rules, with the clinical category of KPN0001 (blaSHV, penicillins) set to category."""
+    old_dir = tmp_path / "old_rules"
+    shutil.copytree(RULES_DIR, old_dir, ignore=shutil.ignore_patterns('__pycache__'))
+    if category is not None:
+        path = old_dir / "Klebsiella_pneumoniae.tsv"
+        with open(path, newline='') as f:
+            reader = csv.DictReader(f, delimiter='\t')
+            fieldnames, rules = reader.fieldnames, list(reader)
+        for rule in rules:
+            if rule['ruleID'] == 'KPN0001':
+                rule['clinical category'] = category
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter='\t', lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rules)
+    return old_dir
+
+
+def _compare(tmp_path, old_dir):
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    args = build_parser().parse_args(['--input', str(INPUT_FILE), '--organism', ORGANISM, '--compare-rules', str(old_dir),
+                                      '--output-dir', str(out_dir), '--output-prefix', 'cmp'])
+    quiet(rules_engine.run, args)
+    with open(out_dir / "cmp_rules_comparison.tsv", newline='') as f:
+        report = list(csv.DictReader(f, delimiter='\t'))
+    with open(out_dir / "cmp_rules_comparison_counts.tsv", newline='') as f:
+        counts = {row['measure']: int(row['count']) for row in csv.DictReader(f, delimiter='\t')}
+    return report, counts
+
+
+def test_identical_rulesets_have_no_changes(resources_available, tmp_path):
+    report, counts = _compare(tmp_path, _old_rules(tmp_path))
+    assert report == []
+    assert counts['samples compared'] == 20
+    assert counts['entries unchanged'] > 0
+    assert {k: v for k, v in counts.items() if k not in ('samples compared', 'entries unchanged')} == {
+        'samples with changes': 0, 'entries changed': 0, 'entries added': 0, 'entries removed': 0,
+        'clinical category changed': 0, 'phenotype changed': 0, 'evidence grade changed': 0, 'ruleIDs changed': 0}
+
+
+def test_changed_rule_gives_delta_rows(resources_available, tmp_path):
+    report, counts = _compare(tmp_path, _old_rules(tmp_path, category='S'))
+    # every genome carries blaSHV, so each has its penicillin entry changed from the old category to R, and nothing else
+    assert len(report) == 20
+    assert len({row['sample'] for row in report}) == 20
+    for row in report:
+        assert (row['drug'], row['drug class'], row['change'], row['changed fields']) == (
+            '(all)', 'penicillin beta-lactam', 'changed', 'clinical category')
+        assert row['old clinical category'] in ('S', '-') and row['new clinical category'] == 'R'
+        assert row['old ruleIDs'] == row['new ruleIDs'] == 'KPN0001'
+        assert row['organism'] == ORGANISM
+    assert counts['samples with changes'] == 20
+    assert counts['entries changed'] == counts['clinical category changed'] == 20
+    assert counts['entries added'] == counts['entries removed'] == 0
+    assert counts['clinical category S -> R'] + counts['clinical category - -> R'] == 20
+
+
+def test_sample_rows_must_be_together(resources_available, tmp_path):
+    with open(INPUT_FILE, newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        fieldnames, rows = reader.fieldnames, list(reader)
+    # move the first row of the input to the end, splitting up the first sample's rows
+    input_file = tmp_path / "split.tsv"
+    with open(input_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter='\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows[1:] + rows[:1])
+    args = build_parser().parse_args(['--input', str(input_file), '--organism', ORGANISM, '--compare-rules',
+                                      str(_old_rules(tmp_path)), '--output-dir', str(tmp_path), '--output-prefix', 'cmp'])
+    with pytest.raises(ValueError, match='more than one place'):
+        quiet(rules_engine.run, args)
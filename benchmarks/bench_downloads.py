@@ -0,0 +1,231 @@
+"""
+Checks for downloading resources (amrrules --download-resources), against a local HTTP server.
+
+The server stands in for the NCBI and CARD download sites, serving a fake AMRFinderPlus version.txt and
+ReferenceGeneHierarchy.txt, and bz2 CARD archives, so no network access is needed. The checks cover streaming
+downloads to disk, stopping extraction of a CARD archive once the wanted files are out, cleaning up after a failed
+download, and skipping versions that are already installed.
+
+Run from the repository root with:
+    pytest benchmarks/bench_downloads.py
+"""
+
+import http.server
+import io
+import os
+import tarfile
+import threading
+from collections import Counter
+
+import pytest
+
+from amrrules import resources
+from amrrules.resources import (AMRFP_FILES, CARD_DATA_FILES, CARD_ONTOLOGY_FILES, ResourceManager,
+                                _stream_to_file)
+
+AMRFP_VERSION = "2025-07-16.1"
+HIERARCHY = b"".join(f"node{i}\tparent{i // 10}\n".encode('utf-8') for i in range(5000))
+# incompressible padding after the wanted files in each archive, much bigger than anything read before stopping
+PADDING_SIZE = 2 * 1024 * 1024
+
+
+def _archive(files, padding=0):
+    """A bz2 tar archive of files (name: content), in sub-directories as the real CARD archives are, then padding."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:bz2') as tar:
+        members = list(files.items())
+        if padding:
+            members.append(("padding.bin", os.urandom(padding)))
+        for name, content in members:
+            info = tarfile.TarInfo(f"./card/{name}")
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+ARCHIVES = {
+    "/card/ontology.tar.bz2": _archive({name: f"{name} content\n".encode('utf-8') for name in CARD_ONTOLOGY_FILES}, PADDING_SIZE),
+    "/card/data.tar.bz2": _archive({name: f"{name} content\n".encode('utf-8') for name in CARD_DATA_FILES}, PADDING_SIZE),
+}
+
+
+class FakeDownloads(http.server.BaseHTTPRequestHandler):
+    """Serves server.files (path: content), counting requests in server.requests. Paths in server.truncated get their
+    headers and half their content before the connection is closed."""
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.path in self.server.truncated:
+            content = content[:len(content) // 2]
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeDownloads)
+    httpd.files = {
+        "/amrfp/latest/version.txt": (AMRFP_VERSION + "\n").encode('utf-8'),
+        "/amrfp/latest/ReferenceGeneHierarchy.txt": HIERARCHY,
+        **ARCHIVES,
+    }
+    httpd.requests = Counter()
+    httpd.truncated = set()
+    httpd.base_url = f"http://127.0.0.1:{httpd.server_port}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _manager(server, store_dir):
+    manager = ResourceManager(store_dir)
+    manager.amrfp_db_root_url = server.base_url + "/amrfp"
+    manager.card_ontology_url = server.base_url + "/card/ontology.tar.bz2"
+    manager.card_data_url = server.base_url + "/card/data.tar.bz2"
+    return manager
+
+
+def _leftovers(store_dir):
+    """Temporary download directories and partly written files left anywhere in the store."""
+    return sorted(str(p.relative_to(store_dir)) for p in store_dir.rglob('.*'))
+
+
+class ChunkedSource(io.BytesIO):
+    """A file-like object that records the size of each read from it."""
+
+    def __init__(self, content):
+        super().__init__(content)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return super().read(size)
+
+
+def test_stream_to_file_chunked_and_atomic(tmp_path, monkeypatch):
+    monkeypatch.setattr(resources, 'DOWNLOAD_CHUNK_SIZE', 4096)
+    target = tmp_path / "ReferenceGeneHierarchy.txt"
+    replaced = []
+    real_replace = os.replace
+
+    def replace(src, dst):
+        # the target only appears once the whole file has been written next to it
+        assert not target.exists()
+        assert os.path.getsize(src) == len(HIERARCHY)
+        replaced.append((src, dst))
+        real_replace(src, dst)
+
+    monkeypatch.setattr(resources.os, 'replace', replace)
+    source = ChunkedSource(HIERARCHY)
+    _stream_to_file(source, target)
+
+    assert target.read_bytes() == HIERARCHY
+    assert len(source.reads) > len(HIERARCHY) // 4096 and all(size == 4096 for size in source.reads)
+    [(src, dst)] = replaced
+    assert os.path.dirname(src) == str(tmp_path) and os.path.basename(src).endswith(".part") and dst == target
+    assert os.stat(target).st_mode & 0o777 == 0o644
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["ReferenceGeneHierarchy.txt"]
+
+
+def test_download_installs_versions(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(resources, 'DOWNLOAD_CHUNK_SIZE', 4096)
+    manager = _manager(server, tmp_path)
+    assert manager.setup_all_resources()
+
+    amrfp_dir = tmp_path / "amrfp" / AMRFP_VERSION
+    card_dir = tmp_path / "card" / ResourceManager.card_version
+    assert (amrfp_dir / "ReferenceGeneHierarchy.txt").read_bytes() == HIERARCHY
+    assert (amrfp_dir / "version.txt").read_text().strip() == AMRFP_VERSION
+    for name in CARD_ONTOLOGY_FILES + CARD_DATA_FILES:
+        assert (card_dir / name).read_text() == f"{name} content\n"
+    assert sorted(p.name for p in amrfp_dir.iterdir()) == sorted(AMRFP_FILES)
+    assert sorted(p.name for p in card_dir.iterdir()) == sorted(CARD_ONTOLOGY_FILES + CARD_DATA_FILES)
+    assert (tmp_path / "amrfp" / "LATEST").read_text().strip() == AMRFP_VERSION
+    assert _leftovers(tmp_path) == []
+
+    reader = ResourceManager(tmp_path)
+    assert reader.amrfp_dir == amrfp_dir and reader.card_dir == card_dir
+
+
+def test_extraction_stops_once_files_are_out(server, tmp_path, monkeypatch):
+    read = Counter()
+    real_urlopen = resources.urllib.request.urlopen
+
+    def urlopen(url):
+        response = real_urlopen(url)
+        real_read = response.read
+
+        def counted_read(*args):
+            data = real_read(*args)
+            read[url] += len(data)
+            return data
+
+        response.read = counted_read
+        return response
+
+    monkeypatch.setattr(resources.urllib.request, 'urlopen', urlopen)
+    manager = _manager(server, tmp_path)
+    assert manager.download_card_archives()
+
+    for path, archive in ARCHIVES.items():
+        # the wanted files are at the start of each archive, so the padding after them is never read
+        assert 0 < read[server.base_url + path] < len(archive) - PADDING_SIZE // 2
+    assert not list(tmp_path.rglob("padding.bin"))
+
+
+@pytest.mark.parametrize('failure', ['truncated', 'missing'])
+def test_failed_amrfp_download_leaves_nothing(failure, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(resources, 'DOWNLOAD_CHUNK_SIZE', 4096)
+    path = "/amrfp/latest/ReferenceGeneHierarchy.txt"
+    if failure == 'truncated':
+        server.truncated.add(path)
+    else:
+        del server.files[path]
+    manager = _manager(server, tmp_path)
+    assert not manager.download_amrfp_resources()
+
+    assert server.requests[path] == 1
+    assert not (tmp_path / "amrfp" / AMRFP_VERSION).exists()
+    assert not (tmp_path / "amrfp" / "LATEST").exists()
+    assert ResourceManager(tmp_path).store.installed_versions('amrfp') == []
+    assert _leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize('failure', ['truncated', 'missing'])
+def test_failed_card_download_leaves_nothing(failure, server, tmp_path):
+    path = "/card/data.tar.bz2"
+    if failure == 'truncated':
+        # cut off inside the wanted member, so it can't be extracted in full
+        server.files[path] = _archive({name: os.urandom(256 * 1024) for name in CARD_DATA_FILES})
+        server.truncated.add(path)
+    else:
+        del server.files[path]
+    manager = _manager(server, tmp_path)
+    assert not manager.download_card_archives()
+
+    assert not (tmp_path / "card" / ResourceManager.card_version).exists()
+    assert not (tmp_path / "card" / "LATEST").exists()
+    assert _leftovers(tmp_path) == []
+
+
+def test_second_run_skips_download(server, tmp_path):
+    assert _manager(server, tmp_path).setup_all_resources()
+    installed = {p: p.stat().st_ino for p in tmp_path.rglob('*') if p.is_file() and p.name != 'LATEST'}
+    first = Counter(server.requests)
+
+    assert _manager(server, tmp_path).setup_all_resources()
+    second = server.requests - first
+    # only the small version.txt is fetched again, to find out which AMRFP version is current
+    assert second == Counter({"/amrfp/latest/version.txt": 1})
+    assert {p: p.stat().st_ino for p in tmp_path.rglob('*') if p.is_file() and p.name != 'LATEST'} == installed
@@ -0,0 +1,394 @@
+"""
+Differential equivalence checks: every optimised execution path must give exactly the same reports as the
+reference path, for every bundled input and option combination, and for the synthetic cohort.
+
+The reference path is a plain run with empty resource caches and summary deduplication turned off. Each
+other path (warm caches, shared tables, checkpointed batches, indexed sample selection, single-report runs,
+per-sample partitions, the NDJSON stream, watch mode with one or more workers) is run on the same input with the same options, and its reports are
+compared with the reference row by row. Any differences are listed by row, sample and column.
+
+Run from the repository root with:
+    pytest benchmarks/bench_equivalence.py
+and to check every combination of the interpretation options rather than each option on its own:
+    pytest benchmarks/bench_equivalence.py --equivalence-full-grid
+"""
+
+import csv
+import itertools
+import json
+import shlex
+import shutil
+from functools import partial
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from amrrules import rules_engine, watch
+from amrrules.cli import build_parser, build_watch_parser
+from amrrules.resources import CARD_BETALACTAM_AROS, CARD_DRUG_ALIASES, CardDrugIndex, ResourceManager, get_registry
+from amrrules.rules_io import get_rule_files, parse_rules_file, rule_drugs
+from amrrules.partitioned_output import INTERPRETED_FILE, SUMMARY_FILE, partition_value
+from amrrules.sample_index import build_index
+from amrrules.summariser import create_summary_dict
+from amrrules.utils import get_supported_organisms, open_input
+from benchmarks.conftest import quiet
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+WORKFLOW_FILE = REPO_DIR / ".github" / "workflows" / "generate-example-outputs.yml"
+REPORTS = {'interpreted': '_interpreted.tsv', 'summary': '_genome_summary.tsv'}
+# most differences to list in a failure report
+MAX_DIFFERENCES = 20
+
+
+def _workflow_commands():
+    """The amrrules commands the example outputs are generated with, as argument lists."""
+    commands = []
+    for line in WORKFLOW_FILE.read_text().splitlines():
+        words = shlex.split(line.strip())
+        if words[:2] == ['amrrules', '--input']:
+            commands.append(words[1:])
+    return commands
+
+
+def _input_cases():
+    """
+    Each bundled input with the organism (or organism file) it's run with in the workflow, as
+    (case name, input and organism arguments).
+    """
+    cases = {}
+    for command in _workflow_commands():
+        args = build_parser().parse_args(command)
+        org_args = ['--organism', args.organism] if args.organism else ['--organism-file', str(REPO_DIR / args.organism_file)]
+        cases.setdefault(Path(args.input).stem, ['--input', str(REPO_DIR / args.input)] + org_args)
+    return sorted(cases.items())
+
+
+# the interpretation options: every value of --no-rule-interpretation, each flag on its own, and everything at once
+OPTION_COMBOS = [
+    ('default', []),
+    ('nr_nwt', ['-nr', 'nwt']),
+    ('nr_nwtR', ['-nr', 'nwtR']),
+    ('nr_nwtS', ['-nr', 'nwtS']),
+    ('annot_full', ['--annot-opts', 'full']),
+    ('flag_core', ['--flag-core']),
+    ('full_disrupt', ['--full-disrupt']),
+    ('print_non_amr', ['--print-non-amr']),
+    ('all_on', ['-nr', 'nwtR', '--annot-opts', 'full', '--flag-core', '--full-disrupt', '--print-non-amr']),
+]
+
+
+def _full_grid():
+    combos = []
+    for nr, annot, flag_core, full_disrupt, print_non_amr in itertools.product(
+            ['none', 'nwt', 'nwtR', 'nwtS'], ['minimal', 'full'], [False, True], [False, True], [False, True]):
+        argv = ['-nr', nr, '--annot-opts', annot]
+        argv += ['--flag-core'] * flag_core + ['--full-disrupt'] * full_disrupt + ['--print-non-amr'] * print_non_amr
+        name = '-'.join([nr, annot] + [flag for flag, on in [('core', flag_core), ('disrupt', full_disrupt), ('nonamr', print_non_amr)] if on])
+        combos.append((name, argv))
+    return combos
+
+
+def pytest_generate_tests(metafunc):
+    if 'option_combo' in metafunc.fixturenames:
+        combos = _full_grid() if metafunc.config.getoption('--equivalence-full-grid') else OPTION_COMBOS
+        metafunc.parametrize('option_combo', [argv for _, argv in combos], ids=[name for name, _ in combos])
+    if 'input_case' in metafunc.fixturenames:
+        cases = _input_cases()
+        metafunc.parametrize('input_case', [argv for _, argv in cases], ids=[name for name, _ in cases])
+
+
+# row by row comparison
+
+def _read_report(path):
+    with open(path, 'r', newline='') as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    return (rows[0] if rows else []), rows[1:]
+
+
+def diff_reports(reference_file, candidate_file, limit=MAX_DIFFERENCES):
+    """
+    Compare two reports row by row, and return a list of their differences (empty if they're identical),
+    each naming the row, its sample and the columns that differ.
+    """
+    ref_header, ref_rows = _read_report(reference_file)
+    cand_header, cand_rows = _read_report(candidate_file)
+    if ref_header != cand_header:
+        missing = [c for c in ref_header if c not in cand_header]
+        extra = [c for c in cand_header if c not in ref_header]
+        return [f"header differs: missing columns {missing}, extra columns {extra}, reference order {ref_header}"]
+
+    differences = []
+    # up to the end of the shorter report, then any extra rows are listed below
+    for row_number, (ref_row, cand_row) in enumerate(zip(ref_rows, cand_rows, strict=False), start=2):
+        if ref_row == cand_row:
+            continue
+        columns = [f"{name}: {ref!r} -> {cand!r}" for name, ref, cand in itertools.zip_longest(ref_header, ref_row, cand_row) if ref != cand]
+        differences.append(f"row {row_number} (sample {ref_row[0] if ref_row else '?'}): " + "; ".join(columns))
+        if len(differences) >= limit:
+            differences.append("...")
+            return differences
+    if len(ref_rows) != len(cand_rows):
+        longer, name = (ref_rows, 'missing') if len(ref_rows) > len(cand_rows) else (cand_rows, 'extra')
+        differences.append(f"{abs(len(ref_rows) - len(cand_rows))} {name} rows, starting at row {min(len(ref_rows), len(cand_rows)) + 2}: "
+                           f"{longer[min(len(ref_rows), len(cand_rows))]}")
+    return differences
+
+
+def assert_equivalent(reference, candidate, path_name):
+    """Check every report the candidate path wrote against the reference, reporting all of the differences at once."""
+    failures = []
+    for report, candidate_file in candidate.items():
+        if candidate_file is None:
+            continue
+        differences = diff_reports(reference[report], candidate_file)
+        if differences:
+            failures.append(f"{report} report from the {path_name} path differs from the reference path "
+                            f"({reference[report]} vs {candidate_file}):\n  " + "\n  ".join(differences))
+    assert not failures, "\n".join(failures)
+
+
+# execution paths
+
+def _run(argv, out_dir, prefix='eq'):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    args = build_parser().parse_args(argv + ['--output-dir', str(out_dir), '--output-prefix', prefix])
+    quiet(rules_engine.run, args)
+    return {report: out_dir / (prefix + suffix) for report, suffix in REPORTS.items()}
+
+
+def _input_path(argv):
+    return argv[argv.index('--input') + 1]
+
+
+def _sample_names(input_file):
+    with open_input(input_file) as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        if 'Name' not in reader.fieldnames:
+            return None
+        return list(dict.fromkeys(row['Name'] for row in reader))
+
+
+def reference_path(argv, tmp_path):
+    # empty caches, and every sample summarised from scratch
+    get_registry().clear()
+    with mock.patch.object(rules_engine, 'create_summary_dict', partial(create_summary_dict, deduplicate=False)):
+        return _run(argv, tmp_path / 'reference')
+
+
+def default_path(argv, tmp_path):
+    get_registry().clear()
+    return _run(argv, tmp_path / 'default')
+
+
+def warm_cache_path(argv, tmp_path):
+    # the second of two runs, so the resource registry and per-run caches are already populated
+    _run(argv, tmp_path / 'warm_first')
+    return _run(argv, tmp_path / 'warm')
+
+
+def shared_tables_path(argv, tmp_path):
+    get_registry().clear()
+    return _run(argv + ['--shared-tables'], tmp_path / 'shared_tables')
+
+
+def checkpoint_path(argv, tmp_path):
+    # one sample per batch, so every sample goes through a part file and the final assembly
+    return _run(argv + ['--checkpoint-dir', str(tmp_path / 'checkpoint_dir'), '--checkpoint-batch-size', '1'], tmp_path / 'checkpoint')
+
+
+def indexed_samples_path(argv, tmp_path):
+    samples = _sample_names(_input_path(argv))
+    if not samples:
+        pytest.skip("input has no Name column to select samples by")
+    index_file = tmp_path / 'input.amrrules_index.json'
+    quiet(build_index, _input_path(argv), str(index_file))
+    samples_file = tmp_path / 'samples.txt'
+    samples_file.write_text('\n'.join(samples) + '\n')
+    return _run(argv + ['--samples', str(samples_file), '--sample-index', str(index_file)], tmp_path / 'indexed_samples')
+
+
+def single_report_path(argv, tmp_path):
+    # each report from a run that only writes that report
+    interpreted = _run(argv + ['--outputs', 'interpreted'], tmp_path / 'interpreted_only')
+    summary = _run(argv + ['--outputs', 'summary'], tmp_path / 'summary_only')
+    return {'interpreted': interpreted['interpreted'], 'summary': summary['summary']}
+
+
+def partitioned_path(argv, tmp_path):
+    # per-sample partitions, with few open files so writers are evicted and reopened, joined back in input order
+    out_dir = tmp_path / 'partitioned'
+    _run(argv + ['--output-layout', 'partitioned', '--max-open-files', '2'], out_dir)
+    samples = _sample_names(_input_path(argv))
+    if samples is None:
+        samples = [argv[argv.index('--sample-id') + 1] if '--sample-id' in argv else 'sample']
+    joined = {}
+    for report, file_name in (('interpreted', INTERPRETED_FILE), ('summary', SUMMARY_FILE)):
+        joined[report] = out_dir / f'joined{REPORTS[report]}'
+        header_written = False
+        with open(joined[report], 'w', newline='') as out:
+            for sample in samples:
+                for part_file in (out_dir / 'eq').glob(f'organism=*/sample={partition_value(sample)}/{file_name}'):
+                    with open(part_file, 'r', newline='') as part:
+                        part_header = part.readline()
+                        if not header_written:
+                            out.write(part_header)
+                            header_written = True
+                        shutil.copyfileobj(part, out)
+    return joined
+
+
+def ndjson_path(argv, tmp_path):
+    # the reports rebuilt from the NDJSON stream (with the headers of the reports from the same run, which must match them)
+    out_dir = tmp_path / 'ndjson'
+    reports = _run(argv + ['--ndjson', str(out_dir / 'eq.ndjson')], out_dir)
+    rows = {'interpreted': [], 'summary': []}
+    with open(out_dir / 'eq.ndjson', 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['record'] in rows:
+                rows[record['record']].append(record['fields'])
+    rebuilt = {}
+    for report, report_file in reports.items():
+        header, _ = _read_report(report_file)
+        rebuilt[report] = out_dir / f'rebuilt{REPORTS[report]}'
+        with open(rebuilt[report], 'w', newline='') as out:
+            writer = csv.DictWriter(out, fieldnames=header, delimiter='\t')
+            writer.writeheader()
+            writer.writerows(rows[report])
+        assert not diff_reports(report_file, rebuilt[report]), f"{report} rows in the NDJSON stream differ from the {report} report"
+    return rebuilt
+
+
+def _watch_path(argv, tmp_path, workers, chunks=1):
+    """
+    Split the input into chunks of whole samples, drop them into a watched directory and interpret them with
+    amrrules watch, then join the per-file reports back together in input order.
+    """
+    input_file = _input_path(argv)
+    samples = _sample_names(input_file)
+    if not samples:
+        pytest.skip("watch mode names samples after their file when there is no Name column")
+    watch_dir = tmp_path / f'watch_in_{workers}'
+    watch_dir.mkdir()
+    with open_input(input_file) as f:
+        header = f.readline()
+        rows = f.readlines()
+    name_col = header.rstrip('\n').split('\t').index('Name')
+    chunk_size = -(-len(samples) // chunks)
+    chunk_of = {sample: i // chunk_size for i, sample in enumerate(samples)}
+    chunk_files = [watch_dir / f'chunk_{i:04d}.tsv' for i in range(chunks)]
+    chunk_rows = [[] for _ in range(chunks)]
+    for row in rows:
+        chunk_rows[chunk_of[row.rstrip('\n').split('\t')[name_col]]].append(row)
+    for chunk_file, lines in zip(chunk_files, chunk_rows, strict=True):
+        chunk_file.write_text(header + ''.join(lines))
+
+    out_dir = tmp_path / f'watch_{workers}'
+    other_args = [a for a in argv if a != input_file and a != '--input']
+    args = build_watch_parser().parse_args([str(watch_dir), '--output-dir', str(out_dir), '--workers', str(workers),
+                                            '--settle-time', '0', '--poll-interval', '0.05', '--once'] + other_args)
+    args.pattern = ['*.tsv']
+    quiet(watch.watch, args)
+
+    joined = {}
+    for report, suffix in REPORTS.items():
+        joined[report] = out_dir / f'joined{suffix}'
+        with open(joined[report], 'w', newline='') as out:
+            for i, chunk_file in enumerate(chunk_files):
+                with open(out_dir / (chunk_file.stem + suffix), 'r', newline='') as part:
+                    part_header = part.readline()
+                    if i == 0:
+                        out.write(part_header)
+                    shutil.copyfileobj(part, out)
+    return joined
+
+
+PATHS = {
+    'default': default_path,
+    'warm_cache': warm_cache_path,
+    'shared_tables': shared_tables_path,
+    'checkpoint': checkpoint_path,
+    'indexed_samples': indexed_samples_path,
+    'single_report': single_report_path,
+    'partitioned': partitioned_path,
+    'ndjson': ndjson_path,
+    'watch_serial': partial(_watch_path, workers=1),
+}
+
+
+@pytest.fixture(scope='session')
+def reference_outputs(tmp_path_factory):
+    """Reference reports for each (input, options) pair, computed once and shared by every path's check."""
+    cache = {}
+
+    def get(argv):
+        key = tuple(argv)
+        if key not in cache:
+            cache[key] = reference_path(argv, tmp_path_factory.mktemp('reference'))
+        return cache[key]
+    return get
+
+
+# every optimised path against the reference, for every bundled input and option combination
+
+@pytest.mark.parametrize('path_name', PATHS)
+def test_bundled_inputs_equivalent(path_name, input_case, option_combo, reference_outputs, resources_available, tmp_path):
+    argv = input_case + option_combo
+    candidate = PATHS[path_name](argv, tmp_path)
+    assert_equivalent(reference_outputs(argv), candidate, path_name)
+
+
+# and on the synthetic cohort, including watch mode with several workers interpreting chunks of it at once
+
+COHORT_COMBOS = [OPTION_COMBOS[0], OPTION_COMBOS[-1]]
+COHORT_PATHS = {
+    **PATHS,
+    'watch_serial': partial(_watch_path, workers=1, chunks=8),
+    'watch_parallel': partial(_watch_path, workers=4, chunks=8),
+}
+
+
+@pytest.mark.parametrize('path_name', COHORT_PATHS)
+@pytest.mark.parametrize('cohort_options', [argv for _, argv in COHORT_COMBOS], ids=[name for name, _ in COHORT_COMBOS])
+def test_cohort_equivalent(path_name, cohort_options, cohort, reference_outputs, resources_available, tmp_path):
+    argv = ['--input', cohort.amrfp_file, '--organism-file', cohort.organism_file] + cohort_options
+    candidate = COHORT_PATHS[path_name](argv, tmp_path)
+    assert_equivalent(reference_outputs(argv), candidate, path_name)
+
+
+# the drug classes resolved on demand from the ontology index, against a map of every drug in CARD read with obonet
+
+def _obonet_card_drug_map(obo_file, categories_file):
+    """Every drug in every CARD drug class, from the ontology as obonet reads it."""
+    obonet = pytest.importorskip('obonet')
+    ontology = obonet.read_obo(obo_file)
+    with open(categories_file, newline='') as f:
+        drug_classes = {row['ARO Name']: row['ARO Accession'] for row in csv.DictReader(f, delimiter='\t')
+                        if row['ARO Category'] == 'Drug Class'}
+    sources = [(aro, drug_class, True) for drug_class, aro in drug_classes.items()]
+    sources += [(aro, ontology.nodes[aro].get('name'), False) for aro in CARD_BETALACTAM_AROS if aro in ontology]
+    drug_map = {}
+    for aro, drug_class, use_aliases in sources:
+        if aro not in ontology:
+            continue
+        for child, _, relationship in ontology.in_edges(aro, keys=True):
+            if relationship != 'is_a':
+                continue
+            name = ontology.nodes[child].get('name')
+            drug_map[name] = drug_class
+            alias = CARD_DRUG_ALIASES.get(name)
+            if use_aliases and alias and any(f'"{alias}"' in synonym for synonym in ontology.nodes[child].get('synonym', [])):
+                drug_map[alias] = drug_class
+    return drug_map
+
+
+def test_card_drug_index_equivalent(resources_available):
+    rm = ResourceManager()
+    full_map = _obonet_card_drug_map(str(rm.card_dir / "aro.obo"), str(rm.card_dir / "aro_categories.tsv"))
+    index = CardDrugIndex(str(rm.card_dir / "aro.obo"), str(rm.card_dir / "aro_categories.tsv"))
+    assert index.full_drug_class_map() == full_map
+    drugs = set(rule_drugs(parse_rules_file(get_rule_files(get_supported_organisms())))) | set(full_map)
+    differences = [(drug, full_map.get(drug), index.drug_class(drug)) for drug in sorted(drugs, key=str)
+                   if full_map.get(drug) != index.drug_class(drug)]
+    assert not differences, differences[:MAX_DIFFERENCES]
@@ -0,0 +1,147 @@
+"""
+Memory budget checks for AMRrules, using tracemalloc.
+
+Each check measures the peak allocation of one part of the pipeline, normalised per
+sample (or per entry for the reference structures), and fails if it grows by more than
+the allowed tolerance over the value stored in memory_baseline.json. The top allocation
+sites are printed for every check, so the change responsible is easy to find.
+
+Run from the repository root with:
+    pytest benchmarks/bench_memory.py -s
+and after an intentional change, refresh the stored values with:
+    pytest benchmarks/bench_memory.py --update-memory-baseline
+"""
+
+import json
+import sys
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+
+import pytest
+
+from amrrules import rules_engine
+from amrrules.cli import build_parser
+from amrrules.resources import ResourceManager, get_registry
+from amrrules.summariser import create_summary_dict
+from benchmarks.conftest import quiet
+
+BASELINE_FILE = Path(__file__).resolve().parent / "memory_baseline.json"
+# object sizes differ between Python versions, and fixed costs are spread differently over
+# different cohort sizes, so baselines are stored per Python major.minor version and cohort size
+PYTHON_VERSION = f"{sys.version_info.major}.{sys.version_info.minor}"
+TOP_SITES = 10
+
+
+def measure_peak(fn, *args, **kwargs):
+    """
+    Call fn under tracemalloc, and return its result, the peak traced allocation in bytes,
+    and a snapshot of the allocations still held once fn has returned.
+    """
+    tracemalloc.start(10)
+    try:
+        result = fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    return result, peak, snapshot
+
+
+def top_sites(snapshot, limit=TOP_SITES):
+    """Format the largest allocation sites in the snapshot, ignoring tracemalloc itself."""
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    lines = []
+    for stat in snapshot.statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        lines.append(f"  {stat.size / 1024:10.1f} KiB  {stat.count:8d} blocks  {frame.filename}:{frame.lineno}")
+    return "\n".join(lines)
+
+
+@pytest.fixture(scope='session')
+def memory_baseline(request):
+    baseline = json.loads(BASELINE_FILE.read_text()) if BASELINE_FILE.exists() else {}
+    update = request.config.getoption('--update-memory-baseline')
+    section = f"python-{PYTHON_VERSION}/cohort-{request.config.getoption('--cohort-size')}"
+    yield baseline, section, update
+    if update:
+        BASELINE_FILE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+
+
+def check_budget(memory_baseline, name, bytes_per_unit, snapshot, unit):
+    baseline, section, update = memory_baseline
+    print(f"\n{name}: {bytes_per_unit:,.0f} bytes per {unit}\nTop allocation sites:\n{top_sites(snapshot)}")
+
+    values = baseline.setdefault('baselines', {}).setdefault(section, {})
+    if update:
+        values[name] = round(bytes_per_unit)
+        return
+    if name not in values:
+        pytest.skip(f"No memory baseline for {name} in {section}. Run with --update-memory-baseline to record one.")
+
+    allowed = values[name] * (1 + baseline.get('tolerance', 0.2))
+    assert bytes_per_unit <= allowed, (
+        f"{name} grew to {bytes_per_unit:,.0f} bytes per {unit}, over the budget of {allowed:,.0f} "
+        f"(baseline {values[name]:,} + {baseline.get('tolerance', 0.2):.0%}).\n"
+        f"Top allocation sites:\n{top_sites(snapshot)}"
+    )
+
+
+def _group_by_sample(genotypes):
+    grouped_by_sample = defaultdict(list)
+    for g in genotypes:
+        grouped_by_sample[g.sample_name].append(g)
+    return grouped_by_sample
+
+
+# ResourceManager structures, normalised per entry so they don't depend on the database version.
+# the registry is cleared first, so the structures are actually built rather than reused
+
+def test_refseq_nodes_memory(memory_baseline, resources_available):
+    get_registry().clear()
+    nodes, peak, snapshot = measure_peak(ResourceManager().refseq_nodes)
+    check_budget(memory_baseline, 'refseq_nodes_peak', peak / max(len(nodes), 1), snapshot, 'node')
+
+
+def test_amrfp_card_conversion_memory(memory_baseline, resources_available):
+    conversion, peak, snapshot = measure_peak(ResourceManager().get_amrfp_card_conversion)
+    check_budget(memory_baseline, 'amrfp_card_conversion_peak', peak / max(len(conversion), 1), snapshot, 'subclass')
+
+
+def test_card_drug_class_map_memory(memory_baseline, resources_available):
+    get_registry().clear()
+    card_map, peak, snapshot = measure_peak(ResourceManager().get_card_drug_class_map)
+    check_budget(memory_baseline, 'card_drug_class_map_peak', peak / max(len(card_map), 1), snapshot, 'drug')
+
+
+# per-sample structures
+
+def test_geno_results_memory(memory_baseline, pipeline_inputs, cohort):
+    _, peak, snapshot = measure_peak(pipeline_inputs.matched_results)
+    check_budget(memory_baseline, 'geno_results_peak', peak / cohort.size, snapshot, 'sample')
+
+
+def test_genotypes_memory(memory_baseline, pipeline_inputs, cohort):
+    matched_results = pipeline_inputs.matched_results()
+    _, peak, snapshot = measure_peak(
+        rules_engine.expand_genotypes, matched_results, pipeline_inputs.card_drug_map,
+        pipeline_inputs.card_amrfp_conversion, 'none')
+    check_budget(memory_baseline, 'genotypes_peak', peak / cohort.size, snapshot, 'sample')
+
+
+def test_summary_dict_memory(memory_baseline, pipeline_inputs, cohort):
+    grouped_by_sample = _group_by_sample(pipeline_inputs.genotypes())
+    _, peak, snapshot = measure_peak(create_summary_dict, grouped_by_sample, pipeline_inputs.rules, False, 'none')
+    check_budget(memory_baseline, 'summary_dict_peak', peak / cohort.size, snapshot, 'sample')
+
+
+def test_run_memory(memory_baseline, cohort, resources_available, tmp_path):
+    args = build_parser().parse_args([
+        '--input', cohort.amrfp_file,
+        '--organism-file', cohort.organism_file,
+        '--output-prefix', 'memory',
+        '--output-dir', str(tmp_path),
+    ])
+    get_registry().clear()
+    _, peak, snapshot = measure_peak(quiet, rules_engine.run, args)
+    check_budget(memory_baseline, 'run_peak', peak / cohort.size, snapshot, 'sample')
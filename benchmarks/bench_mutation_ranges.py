@@ -0,0 +1,182 @@
+"""
+Checks for range rules (eg p.(83_87)X, see mutation_ranges.py), which no bundled rule uses yet, so the
+equivalence checks never reach them: parsing each kind of range rule and detected variant, which variants each
+kind accepts, interval tree lookups at the edges of the ranges, and that exact rules take precedence.
+
+Run from the repository root with:
+    pytest benchmarks/bench_mutation_ranges.py
+"""
+
+import random
+
+import pytest
+
+from amrrules.genotype_parser import GenoResult
+from amrrules.mutation_ranges import (ANY, DELETION, FRAMESHIFT, INSERTION, NONSENSE, SUBSTITUTION, IntervalTree,
+                                      MutationRuleIndex, parse_range_rule, parse_variant)
+
+ORGANISM = 's__Test organism'
+
+
+@pytest.mark.parametrize('mutation, expected', [
+    ('p.(83_87)X', ('p', 83, 87, SUBSTITUTION, '')),
+    ('p.(83_87)Xaa', ('p', 83, 87, SUBSTITUTION, '')),
+    ('p.(83_87)Leu', ('p', 83, 87, SUBSTITUTION, 'Leu')),
+    ('p.(1_300)fs', ('p', 1, 300, FRAMESHIFT, '')),
+    ('p.(1_300)fsTer', ('p', 1, 300, FRAMESHIFT, '')),
+    ('p.(1_300)Ter', ('p', 1, 300, NONSENSE, '')),
+    ('p.(1_100)del', ('p', 1, 100, DELETION, '')),
+    ('p.(1_100)ins', ('p', 1, 100, INSERTION, '')),
+    ('p.(1_100)insGlyAsp', ('p', 1, 100, INSERTION, 'GlyAsp')),
+    ('p.(1_100)', ('p', 1, 100, ANY, '')),
+    ('c.(-35_-10)N>N', ('c', -35, -10, SUBSTITUTION, 'N>N')),
+    ('c.(-35_-10)N>T', ('c', -35, -10, SUBSTITUTION, 'N>T')),
+    ('c.(-35_1)del', ('c', -35, 1, DELETION, '')),
+    # a single position, and a range given backwards
+    ('p.(83)X', ('p', 83, 83, SUBSTITUTION, '')),
+    ('c.(-10)', ('c', -10, -10, ANY, '')),
+    ('p.(87_83)X', ('p', 83, 87, SUBSTITUTION, '')),
+])
+def test_parse_range_rule(mutation, expected):
+    rule = parse_range_rule(mutation)
+    assert (rule.kind, rule.start, rule.end, rule.variant_class, rule.detail) == expected
+
+
+@pytest.mark.parametrize('mutation', [None, '', '-', 'p.Ser83Leu', 'c.25C>T', 'p.(1_100)Q', 'c.(1_100)X', 'c.(1_100)fs',
+                                      'p.(1_100)N>T', 'c.[2045A>G][3]'])
+def test_parse_range_rule_not_a_range(mutation):
+    assert parse_range_rule(mutation) is None
+
+
+@pytest.mark.parametrize('mutation, expected', [
+    ('p.Ser83Leu', ('p', 83, 83, SUBSTITUTION, 'Leu')),
+    ('p.Gly238Alafs', ('p', 238, 238, FRAMESHIFT, '')),
+    ('p.Gly238AlafsTer12', ('p', 238, 238, FRAMESHIFT, '')),
+    ('p.Gln100Ter', ('p', 100, 100, NONSENSE, '')),
+    ('p.114_115insGlyAsp', ('p', 114, 115, INSERTION, 'GlyAsp')),
+    ('p.Ser83del', ('p', 83, 83, DELETION, '')),
+    ('p.Ser83_Gly85del', ('p', 83, 85, DELETION, '')),
+    ('c.25C>T', ('c', 25, 25, SUBSTITUTION, 'C>T')),
+    ('c.-11C>T', ('c', -11, -11, SUBSTITUTION, 'C>T')),
+    ('c.-14_-13insGT', ('c', -14, -13, INSERTION, 'GT')),
+    ('c.-53Adel', ('c', -53, -53, DELETION, '')),
+    ('c.-53ACdel', ('c', -53, -52, DELETION, '')),
+])
+def test_parse_variant(mutation, expected):
+    variant = parse_variant(mutation)
+    assert (variant.kind, variant.start, variant.end, variant.variant_class, variant.detail) == expected
+
+
+@pytest.mark.parametrize('mutation', [None, '', '-', 'p.Ser83', 'c.[3]'])
+def test_parse_variant_unplaced(mutation):
+    assert parse_variant(mutation) is None
+
+
+@pytest.mark.parametrize('rule, accepted, rejected', [
+    ('p.(83_87)X', ['p.Ser83Leu', 'p.Asp87Asn'], ['p.Gly82Ser', 'p.Gly88Ser', 'p.Ser85Alafs', 'p.Ser85del', 'c.85C>T']),
+    ('p.(83_87)Leu', ['p.Ser83Leu'], ['p.Ser83Phe', 'p.Ser83Alafs']),
+    ('p.(1_300)fs', ['p.Gly1Alafs', 'p.Gly300AlafsTer12'], ['p.Gly301Alafs', 'p.Gln100Ter', 'p.Ser83Leu']),
+    ('p.(1_300)Ter', ['p.Gln100Ter'], ['p.Gln301Ter', 'p.Gly100Alafs']),
+    # deletions and insertions overlapping either end of the range
+    ('p.(1_100)del', ['p.Ser100_Gly102del', 'p.Ser1del'], ['p.Ser101del', 'p.Ser83Leu']),
+    ('p.(1_100)ins', ['p.100_101insGly', 'p.1_2insGlyAsp'], ['p.101_102insGly', 'p.Ser83del']),
+    ('p.(1_100)insGly', ['p.50_51insGly'], ['p.50_51insGlyAsp']),
+    ('p.(1_100)', ['p.Ser83Leu', 'p.Gly1Alafs', 'p.Gln100Ter', 'p.Ser100_Gly102del', 'p.100_101insGly'],
+     ['p.Ser101Leu', 'c.50C>T']),
+    ('c.(-35_-10)N>N', ['c.-35C>T', 'c.-10A>G'], ['c.-36C>T', 'c.-9A>G', 'c.-20Adel']),
+    ('c.(-35_-10)N>T', ['c.-20C>T', 'c.-20A>T'], ['c.-20C>G']),
+    ('c.(-35_-10)C>N', ['c.-20C>T'], ['c.-20A>T']),
+    ('c.(-35_-10)del', ['c.-36AAdel', 'c.-10Adel'], ['c.-37AAdel', 'c.-9Adel']),
+    ('c.(-10)', ['c.-10C>T', 'c.-11_-10insA', 'c.-11AAdel'], ['c.-11C>T', 'c.-9C>T']),
+])
+def test_range_rule_accepts(rule, accepted, rejected):
+    range_rule = parse_range_rule(rule)
+    assert [m for m in accepted if not range_rule.accepts(parse_variant(m))] == []
+    assert [m for m in rejected if range_rule.accepts(parse_variant(m))] == []
+
+
+@pytest.mark.parametrize('query, expected', [
+    ((10, 10), ['a', 'b']), # the end of one interval and the start of the next
+    ((11, 11), ['b']),
+    ((21, 25), []),
+    ((20, 20), ['b', 'c']),
+    ((4, 4), []),
+    ((5, 5), ['a']),
+    ((-5, 4), ['d']),
+    ((0, 100), ['a', 'b', 'c']),
+    ((-100, 100), ['a', 'b', 'c', 'd']),
+])
+def test_interval_tree_boundaries(query, expected):
+    tree = IntervalTree([(5, 10, 'a'), (10, 20, 'b'), (20, 20, 'c'), (-10, -5, 'd')])
+    assert sorted(tree.overlapping(*query)) == expected
+
+
+def test_interval_tree_matches_brute_force():
+    rng = random.Random(1)
+    intervals = []
+    for i in range(300):
+        start = rng.randint(-50, 500)
+        intervals.append((start, start + rng.randint(0, 40), i))
+    tree = IntervalTree(intervals)
+    for _ in range(500):
+        start = rng.randint(-60, 550)
+        end = start + rng.randint(0, 30)
+        assert sorted(tree.overlapping(start, end)) == sorted(i for s, e, i in intervals if s <= end and e >= start)
+    assert IntervalTree([]).overlapping(0, 10) == []
+
+
+def _rule(rule_id, mutation, variation_type='Protein variant detected', node='gyrA', organism=ORGANISM):
+    return {'ruleID': rule_id, 'organism': organism, 'variation type': variation_type, 'nodeID': node,
+            'nucleotide accession': '-', 'protein accession': '-', 'HMM accession': '-', 'mutation': mutation}
+
+
+RULES = [
+    _rule('TST0001', 'p.(83_87)X'),
+    _rule('TST0002', 'p.Ser83Leu'),
+    _rule('TST0003', 'p.(80_90)'),
+    _rule('TST0004', 'p.(1_100)fs', variation_type='Inactivating mutation detected'),
+    _rule('TST0005', 'p.(83_87)X', node='parC'),
+    _rule('TST0006', 'p.(83_87)X', organism='s__Other organism'),
+]
+
+
+def test_mutation_rule_index():
+    index = MutationRuleIndex(RULES)
+    assert [r['ruleID'] for r in index.candidates(ORGANISM, 'Protein variant detected', 'nodeID', 'gyrA')] == ['TST0001', 'TST0002', 'TST0003']
+    assert index.candidates(ORGANISM, 'Nucleotide variant detected', 'nodeID', 'gyrA') == []
+    assert index.has_rules(ORGANISM, 'Protein variant detected', 'nodeID', 'parC')
+    # accession fields of '-' aren't indexed for range rules
+    assert not index.has_rules(ORGANISM, 'Protein variant detected', 'HMM accession', '-')
+    # in the order of the rules file, and only those that accept the variant
+    matches = index.matches(ORGANISM, 'Protein variant detected', 'nodeID', 'gyrA', parse_variant('p.Asp87Asn'))
+    assert [r['ruleID'] for r in matches] == ['TST0001', 'TST0003']
+    matches = index.matches(ORGANISM, 'Protein variant detected', 'nodeID', 'gyrA', parse_variant('p.Asp89Asn'))
+    assert [r['ruleID'] for r in matches] == ['TST0003']
+
+
+def _genotype(mutation, variation_type='Protein variant detected', node='gyrA'):
+    g = GenoResult({}, None, {'': ORGANISM}, False, False)
+    g.to_process = True
+    g.nodeID = node
+    g.closest_acc = g.hmm_acc = 'NA'
+    g.variation_type = variation_type
+    g.mutation = mutation
+    return g
+
+
+@pytest.mark.parametrize('indexed', [True, False], ids=['index', 'scan'])
+@pytest.mark.parametrize('mutation, variation_type, expected', [
+    # an exact rule takes precedence over range rules that also cover the variant
+    ('p.Ser83Leu', 'Protein variant detected', ['TST0002']),
+    ('p.Ser83Phe', 'Protein variant detected', ['TST0001', 'TST0003']),
+    ('p.Gly81Alafs', 'Protein variant detected', ['TST0003']),
+    ('p.Gly95Ser', 'Protein variant detected', []),
+    ('p.Gly50Alafs', 'Inactivating mutation detected', ['TST0004']),
+    ('p.Gly150Alafs', 'Inactivating mutation detected', None),
+])
+def test_find_matching_rules_with_ranges(indexed, mutation, variation_type, expected):
+    g = _genotype(mutation, variation_type)
+    organism_rules = [r for r in RULES if r['organism'] == ORGANISM]
+    g.find_matching_rules(None if indexed else organism_rules, {}, mutation_index=MutationRuleIndex(RULES) if indexed else None)
+    assert g.match_path == 'nodeID'
+    assert (None if g.matched_rules is None else [r['ruleID'] for r in g.matched_rules]) == expected
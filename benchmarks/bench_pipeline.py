@@ -0,0 +1,125 @@
+"""
+Timing benchmarks for the main stages of an AMRrules run, using pytest-benchmark.
+
+Run from the repository root with:
+    pytest benchmarks --cohort-size 1000
+"""
+
+from collections import defaultdict
+from types import SimpleNamespace
+
+from amrrules import rules_engine
+from amrrules.cli import build_parser
+from amrrules.output import write_genotype_report, write_genome_report
+from amrrules.resources import ResourceManager, get_registry
+from amrrules.rules_io import parse_rules_file, extract_relevant_rules, get_rule_files
+from amrrules.summariser import create_summary_dict
+from benchmarks.conftest import quiet
+
+
+def _group_by_sample(genotypes):
+    grouped_by_sample = defaultdict(list)
+    for g in genotypes:
+        grouped_by_sample[g.sample_name].append(g)
+    return grouped_by_sample
+
+
+# resource loading, a fresh ResourceManager and an empty registry each round so the caches are always cold
+
+def _cold_manager():
+    get_registry().clear()
+    return (ResourceManager(),), {}
+
+
+def test_load_refseq_nodes(benchmark, resources_available):
+    benchmark.pedantic(lambda rm: rm.refseq_nodes(), setup=_cold_manager, rounds=20, iterations=1)
+
+
+def test_load_amrfp_card_conversion(benchmark, resources_available):
+    benchmark(lambda: ResourceManager().get_amrfp_card_conversion())
+
+
+def test_load_card_drug_class_map(benchmark, resources_available):
+    benchmark.pedantic(lambda rm: rm.get_card_drug_class_map(), setup=_cold_manager, rounds=5, iterations=1)
+
+
+def test_attach_shared_tables(benchmark, resources_available):
+    # tables are built on the first round and attached on every round after that
+    def attach():
+        get_registry().clear()
+        rm = ResourceManager(shared_tables=True)
+        return rm.refseq_nodes(), rm.get_amrfp_card_conversion(), rm.get_card_drug_class_map()
+    attach()
+    benchmark(attach)
+
+
+def test_load_refseq_nodes_shared(benchmark, resources_available):
+    # a second ResourceManager for the same version reuses the structure already held by the registry
+    ResourceManager().refseq_nodes()
+    benchmark(lambda: ResourceManager().refseq_nodes())
+
+
+def test_parse_rules(benchmark, pipeline_inputs):
+    rule_files = get_rule_files(pipeline_inputs.organism_dict.values())
+    benchmark(parse_rules_file, rule_files)
+
+
+# per-row and per-sample stages
+
+def test_find_matching_rules(benchmark, pipeline_inputs):
+    def match_all(geno_results):
+        for g in geno_results:
+            if g.to_process:
+                g.find_matching_rules(extract_relevant_rules(pipeline_inputs.rules, g.organism), pipeline_inputs.amrfp_nodes)
+
+    benchmark.pedantic(match_all, setup=lambda: ((pipeline_inputs.geno_results(),), {}), rounds=5, iterations=1)
+
+
+def test_expand_genotypes(benchmark, pipeline_inputs):
+    benchmark.pedantic(
+        rules_engine.expand_genotypes,
+        setup=lambda: ((pipeline_inputs.matched_results(), pipeline_inputs.card_drug_map, pipeline_inputs.card_amrfp_conversion, 'none'), {}),
+        rounds=5, iterations=1)
+
+
+def test_create_summary_dict(benchmark, pipeline_inputs):
+    grouped_by_sample = _group_by_sample(pipeline_inputs.genotypes())
+    benchmark.pedantic(create_summary_dict, args=(grouped_by_sample, pipeline_inputs.rules, False, 'none'), rounds=5, iterations=1)
+
+
+def test_create_summary_dict_no_dedup(benchmark, pipeline_inputs):
+    # every sample summarised from scratch, for comparison with the deduplicated version above
+    grouped_by_sample = _group_by_sample(pipeline_inputs.genotypes())
+    benchmark.pedantic(create_summary_dict, args=(grouped_by_sample, pipeline_inputs.rules, False, 'none'),
+                       kwargs={'deduplicate': False}, rounds=5, iterations=1)
+
+
+# writers
+
+def test_write_genotype_report(benchmark, pipeline_inputs, tmp_path):
+    geno_results = pipeline_inputs.matched_results()
+    output_rows = []
+    for g in geno_results:
+        g.annotate_row('minimal')
+        if g.print_row:
+            output_rows.extend(g.annotated_row)
+    args = SimpleNamespace(output_dir=str(tmp_path), output_prefix='bench', annot_opts='minimal')
+    benchmark(write_genotype_report, args, output_rows, [], {}, pipeline_inputs.fieldnames)
+
+
+def test_write_genome_report(benchmark, pipeline_inputs, tmp_path):
+    summary_entry_dict = create_summary_dict(_group_by_sample(pipeline_inputs.genotypes()), pipeline_inputs.rules, False, 'none')
+    benchmark(write_genome_report, summary_entry_dict, str(tmp_path), 'bench')
+
+
+# the whole pipeline, as a user would run it
+
+def test_run(benchmark, cohort, resources_available, tmp_path):
+    args = build_parser().parse_args([
+        '--input', cohort.amrfp_file,
+        '--organism-file', cohort.organism_file,
+        '--output-prefix', 'bench',
+        '--output-dir', str(tmp_path),
+    ])
+    benchmark.extra_info['cohort_size'] = cohort.size
+    benchmark.pedantic(quiet, args=(rules_engine.run, args), rounds=3, iterations=1)
@@ -0,0 +1,195 @@
+"""
+Calibration and checks for the run planner (amrrules plan).
+
+The planner predicts a run from per-row, per-AMR-row and per-sample costs stored in
+src/amrrules/plan_calibration.json. These are measured here from runs of amrrules over the cohort (with
+--metrics-json, as separate processes, so startup and peak memory are what a real run would see). The checks
+compare the planner's estimates from a sample of the cohort (plain, gzip and BGZF) with the true counts, and its
+predictions from the stored calibration with a measured run.
+
+Run from the repository root with:
+    pytest benchmarks/bench_plan.py -s
+and to refresh the stored calibration on this machine with the values measured in this run:
+    pytest benchmarks/bench_plan.py --update-plan-calibration
+"""
+
+import gzip
+import json
+import subprocess
+import sys
+import time
+import zlib
+from argparse import Namespace
+from pathlib import Path
+
+import pytest
+
+import amrrules
+from amrrules import planner
+from amrrules.rules_io import get_rule_files, parse_rules_file
+from amrrules.utils import get_organisms
+
+CALIBRATION_FILE = Path(amrrules.__file__).resolve().parent / planner.CALIBRATION_FILE
+# reads of a small share of the cohort (whatever its size), so it's sampled rather than read in full
+SAMPLED_SHARE = 0.15
+PROBES = 16
+# how far the estimates from a sample can be from the true counts. Genomes have very different numbers of rows (and
+# AMR rows), so the number of samples and AMR fraction are allowed 3 standard errors for the number of samples seen,
+# if that's more
+ROWS_TOLERANCE = 0.1
+SAMPLES_TOLERANCE = 0.1
+AMR_FRACTION_TOLERANCE = 0.05
+# how far the predicted output sizes can be from a measured run (times depend on the machine, so are only printed)
+OUTPUT_TOLERANCE = 0.2
+
+
+def write_bgzf(src, dest, block_size=0xff00):
+    """Compress src as BGZF, the way bgzip does: gzip members of at most 64 KiB, each with the BC subfield giving its size."""
+    with open(src, 'rb') as f_in, open(dest, 'wb') as f_out:
+        for data in [*iter(lambda: f_in.read(block_size), b''), b'']:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            deflated = compressor.compress(data) + compressor.flush()
+            bsize = 18 + len(deflated) + 8
+            f_out.write(planner.BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + (bsize - 1).to_bytes(2, 'little'))
+            f_out.write(deflated + zlib.crc32(data).to_bytes(4, 'little') + len(data).to_bytes(4, 'little'))
+
+
+def _run(cohort, out_dir, prefix, *options):
+    """Run amrrules over the cohort in its own process, and return its run report and wall time (including startup)."""
+    metrics_file = out_dir / f"{prefix}_metrics.json"
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'amrrules', '--input', cohort.amrfp_file, '--organism-file', cohort.organism_file,
+                    '--output-dir', str(out_dir), '--output-prefix', prefix, '--metrics-json', str(metrics_file), *options],
+                   check=True, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    return json.loads(metrics_file.read_text()), wall
+
+
+def _report_size(path):
+    with open(path, 'rb') as f:
+        header = f.readline()
+        rows = sum(1 for _ in f)
+    return len(header), rows, Path(path).stat().st_size
+
+
+def _stage(metrics, name):
+    return metrics['stages'].get(name, {}).get('wall_s', 0.0)
+
+
+@pytest.fixture(scope='session')
+def plan_runs(cohort, resources_available, tmp_path_factory):
+    """Runs of amrrules over the cohort, with what the calibration is worked out from."""
+    out_dir = tmp_path_factory.mktemp('plan')
+    metrics, wall = _run(cohort, out_dir, 'minimal')
+    _run(cohort, out_dir, 'full', '--annot-opts', 'full', '--outputs', 'interpreted')
+    _run(cohort, out_dir, 'compact', '--interpreted-layout', 'compact', '--outputs', 'interpreted')
+
+    organism_dict, _ = get_organisms(cohort.organism_file)
+    rules = parse_rules_file(get_rule_files(organism_dict.values()))
+    exact = planner.sample_input(cohort.amrfp_file, prefix_bytes=1 << 40)
+
+    return {
+        'metrics': metrics, 'wall': wall, 'n_rules': len(rules), 'exact': exact,
+        'reports': {name: _report_size(out_dir / f"{name}_interpreted.tsv") for name in ('minimal', 'full', 'compact')},
+        'summary': _report_size(out_dir / "minimal_genome_summary.tsv"),
+    }
+
+
+def derive_calibration(plan_runs):
+    metrics = plan_runs['metrics']
+    exact = plan_runs['exact']
+    rows = metrics['counts']['rows']
+    samples = metrics['counts']['samples']
+    amr_rows = exact['amr_rows']
+    amr_bytes_per_row = exact['amr_bytes'] / amr_rows
+    stages = ('startup', 'matching', 'annotation', 'genotype_expansion', 'summarisation', 'write_interpreted', 'write_genome_summary')
+    # everything in the run that isn't one of the stages is reading and parsing the input rows, as is validating it
+    row_s = (metrics['total']['wall_s'] - sum(_stage(metrics, name) for name in stages) + _stage(metrics, 'validate_input')) / rows
+    header, expanded_rows, minimal_bytes = plan_runs['reports']['minimal']
+    _, _, full_bytes = plan_runs['reports']['full']
+    _, compact_rows, _ = plan_runs['reports']['compact']
+    _, _, summary_bytes = plan_runs['summary']
+    output_mb = (minimal_bytes + summary_bytes) / 1e6
+    base_rss_mb = metrics['stages']['startup']['process_peak_rss_mb_after']
+    return {
+        'calibrated_with': {'python': f"{sys.version_info.major}.{sys.version_info.minor}", 'amrrules_version': amrrules.__version__,
+                            'samples': samples, 'rows': rows, 'rules_loaded': plan_runs['n_rules']},
+        # interpreter startup and imports, plus loading the resources and rules (which run alongside validating the input)
+        'fixed_s': plan_runs['wall'] - metrics['total']['wall_s'] + max(_stage(metrics, 'startup') - _stage(metrics, 'validate_input'), 0),
+        'row_s': row_s,
+        'amr_row_s': (_stage(metrics, 'matching') + _stage(metrics, 'annotation') + _stage(metrics, 'genotype_expansion')) / amr_rows,
+        'sample_s': _stage(metrics, 'summarisation') / samples,
+        'write_s_per_mb': (_stage(metrics, 'write_interpreted') + _stage(metrics, 'write_genome_summary')) / output_mb,
+        'base_rss_mb': base_rss_mb,
+        'rss_bytes_per_row': (metrics['total']['peak_rss_mb'] - base_rss_mb) * 1024 * 1024 / rows,
+        'interpreted_rows_per_amr_row': {'expanded': expanded_rows / amr_rows, 'compact': compact_rows / amr_rows},
+        'annotation_bytes_per_row': {'minimal': (minimal_bytes - header) / expanded_rows - amr_bytes_per_row,
+                                     'full': (full_bytes - header) / expanded_rows - amr_bytes_per_row},
+        'summary_bytes_per_sample': summary_bytes / samples,
+    }
+
+
+def _rounded(value):
+    # to 4 significant figures, which is more than the costs are repeatable to
+    if isinstance(value, dict):
+        return {k: _rounded(v) for k, v in value.items()}
+    return float(f"{value:.4g}") if isinstance(value, float) else value
+
+
+def test_plan_calibration(request, plan_runs):
+    calibration = derive_calibration(plan_runs)
+    if request.config.getoption('--update-plan-calibration'):
+        CALIBRATION_FILE.write_text(json.dumps(_rounded(calibration), indent=2, sort_keys=True) + "\n")
+        return
+    stored = planner.load_calibration()
+    print(f"\n{'':28s} {'stored':>12s} {'measured':>12s}")
+    for key, value in calibration.items():
+        if isinstance(value, float):
+            print(f"{key:28s} {stored.get(key, float('nan')):12.4g} {value:12.4g}")
+    assert set(calibration) == set(stored), "The stored calibration is out of date with bench_plan.py. Run with --update-plan-calibration."
+
+
+def _sampled_input(cohort, compression, tmp_path):
+    if compression == 'none':
+        return cohort.amrfp_file
+    path = tmp_path / f"cohort.tsv.{compression}.gz"
+    if compression == 'gzip':
+        with open(cohort.amrfp_file, 'rb') as f_in, gzip.open(path, 'wb') as f_out:
+            f_out.write(f_in.read())
+    else:
+        write_bgzf(cohort.amrfp_file, path)
+    return str(path)
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip', 'bgzf'])
+def test_plan_estimates(compression, cohort, tmp_path):
+    organism_dict, _ = get_organisms(cohort.organism_file)
+    truth = planner.estimate_input(planner.sample_input(cohort.amrfp_file, prefix_bytes=1 << 40), organism_dict)
+    size = Path(cohort.amrfp_file).stat().st_size
+    sample = planner.sample_input(_sampled_input(cohort, compression, tmp_path), prefix_bytes=int(size * SAMPLED_SHARE),
+                                  probes=PROBES, probe_bytes=int(size * SAMPLED_SHARE / PROBES))
+    estimate = planner.estimate_input(sample, organism_dict)
+    print(f"\n{compression}: {estimate['rows']} rows (true {truth['rows']}), {estimate['samples']} samples (true {truth['samples']}), "
+          f"AMR fraction {estimate['amr_fraction']:.3f} (true {truth['amr_fraction']:.3f}), from {estimate['sampled_rows']} rows")
+    assert sample['compression'] == compression
+    assert truth['exact'] and not estimate['exact']
+    assert abs(estimate['rows'] - truth['rows']) <= ROWS_TOLERANCE * truth['rows']
+    seen = len({row.get('Name') for run in sample['runs'] for row in run})
+    assert abs(estimate['samples'] - truth['samples']) <= max(SAMPLES_TOLERANCE, 3 / seen ** 0.5) * truth['samples']
+    p = truth['amr_fraction']
+    assert abs(estimate['amr_fraction'] - p) <= max(AMR_FRACTION_TOLERANCE, 3 * (p * (1 - p) / seen) ** 0.5)
+
+
+def test_plan_prediction(plan_runs, cohort):
+    organism_dict, _ = get_organisms(cohort.organism_file)
+    estimate = planner.estimate_input(plan_runs['exact'], organism_dict)
+    args = Namespace(annot_opts='minimal', interpreted_layout='expanded', outputs='both', print_non_amr=False,
+                     checkpoint_dir=None, checkpoint_batch_size=1000)
+    predicted = planner.predict_run(estimate, planner.load_calibration(), args)
+    _, interpreted_rows, interpreted_bytes = plan_runs['reports']['minimal']
+    _, _, summary_bytes = plan_runs['summary']
+    print(f"\npredicted {predicted['runtime_s']:.2f}s, {predicted['peak_rss_mb']:.0f} MB peak; "
+          f"measured {plan_runs['wall']:.2f}s, {plan_runs['metrics']['total']['peak_rss_mb']:.0f} MB peak")
+    assert abs(predicted['interpreted_rows'] - interpreted_rows) <= OUTPUT_TOLERANCE * interpreted_rows
+    assert abs(predicted['interpreted_bytes'] - interpreted_bytes) <= OUTPUT_TOLERANCE * interpreted_bytes
+    assert abs(predicted['summary_bytes'] - summary_bytes) <= OUTPUT_TOLERANCE * summary_bytes
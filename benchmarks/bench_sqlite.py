@@ -0,0 +1,58 @@
+"""
+Checks for the SQLite results store (amrrules --sqlite): re-running the same samples with the same rules replaces
+their results rather than adding to them.
+
+Run from the repository root with:
+    pytest benchmarks/bench_sqlite.py
+"""
+
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from amrrules import rules_engine
+from amrrules.cli import build_parser
+from amrrules.sqlite_output import SqliteStore
+from benchmarks.conftest import quiet
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+INPUT_FILE = REPO_DIR / "tests" / "data" / "input" / "test_kpneumo_20strains.tsv"
+
+
+def _run(tmp_path, db_path, prefix):
+    args = build_parser().parse_args(['--input', str(INPUT_FILE), '--organism', 's__Klebsiella pneumoniae',
+                                      '--sqlite', str(db_path), '--output-dir', str(tmp_path), '--output-prefix', prefix])
+    quiet(rules_engine.run, args)
+
+
+def test_rerun_replaces_results(resources_available, tmp_path):
+    db_path = tmp_path / "results.db"
+    _run(tmp_path, db_path, 'first')
+    _run(tmp_path, db_path, 'second')
+
+    conn = sqlite3.connect(db_path)
+    count = lambda sql: conn.execute(sql).fetchone()[0]
+    assert count("SELECT COUNT(*) FROM runs") == 2
+    assert count("SELECT COUNT(DISTINCT rules_digest) FROM runs") == 1
+    assert count("SELECT COUNT(*) FROM samples") == 20
+    assert count("SELECT COUNT(*) FROM interpreted") == 242
+    # one row per sample and row number, all from the second run
+    assert count("SELECT COUNT(*) FROM (SELECT DISTINCT sample, rules_digest, row_number FROM interpreted)") == 242
+    assert count("SELECT COUNT(DISTINCT run_id) FROM interpreted") == 1
+    assert count("SELECT MAX(run_id) FROM runs") == count("SELECT run_id FROM interpreted LIMIT 1")
+    summary_rows = count("SELECT COUNT(*) FROM summary")
+    assert summary_rows > 0
+    assert count("SELECT COUNT(*) FROM (SELECT DISTINCT sample, rules_digest, drug, drug_class FROM summary)") == summary_rows
+    assert count("SELECT COUNT(*) FROM summary_rules WHERE summary_id NOT IN (SELECT summary_id FROM summary)") == 0
+    conn.close()
+
+
+def test_incompatible_store_refused(tmp_path):
+    db_path = tmp_path / "old.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE samples (sample TEXT NOT NULL, rules_version TEXT NOT NULL, rules_digest TEXT NOT NULL)")
+    conn.close()
+    args = build_parser().parse_args(['--input', str(INPUT_FILE), '--organism', 's__Klebsiella pneumoniae', '--sqlite', str(db_path)])
+    with pytest.raises(ValueError, match='incompatible'):
+        SqliteStore(str(db_path), args, {}, 'digest', {})
@@ -0,0 +1,101 @@
+"""Shared fixtures for the AMRrules benchmark suite."""
+
+import contextlib
+import csv
+import io
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+
+from amrrules.genotype_parser import GenoResult
+from amrrules.resources import ResourceManager
+from amrrules.rules_io import parse_rules_file, extract_relevant_rules, get_rule_files
+from amrrules.utils import get_organisms, open_input
+from amrrules.rules_engine import expand_genotypes
+from benchmarks.generate_cohort import write_cohort
+
+DATA_DIR = Path(__file__).resolve().parent / "data"
+
+
+def pytest_addoption(parser):
+    parser.addoption('--cohort-size', type=int, default=1000, help='Number of synthetic genomes to benchmark against (eg 1000, 10000, 100000). Default 1000.')
+    parser.addoption('--cohort-seed', type=int, default=1, help='Seed used to generate the synthetic cohort. Default 1.')
+    parser.addoption('--equivalence-full-grid', action='store_true', help='Check the optimised paths against the reference for every combination of the interpretation options, rather than each option on its own.')
+    parser.addoption('--update-memory-baseline', action='store_true', help='Overwrite the stored memory baseline with the values measured in this run, instead of checking against it.')
+    parser.addoption('--update-plan-calibration', action='store_true', help="Overwrite the planner's stored calibration (src/amrrules/plan_calibration.json) with the costs measured in this run.")
+
+
+def quiet(fn, *args, **kwargs):
+    """Call fn with stdout suppressed, as run() prints progress messages."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+@dataclass
+class Cohort:
+    amrfp_file: str
+    organism_file: str
+    size: int
+
+
+@dataclass
+class PipelineInputs:
+    organism_dict: dict
+    rules: list
+    amrfp_nodes: dict
+    card_amrfp_conversion: dict
+    card_drug_map: dict
+    raw_rows: list
+    fieldnames: list
+
+    def geno_results(self):
+        """Parse the raw rows into fresh GenoResult objects (matching mutates them, so each round needs new ones)."""
+        return [GenoResult(dict(row), 'amrfp', self.organism_dict, False, False) for row in self.raw_rows]
+
+    def matched_results(self):
+        """Return GenoResult objects with rules matched, ready for annotation and genotype expansion."""
+        geno_results = self.geno_results()
+        for g in geno_results:
+            if g.to_process:
+                g.find_matching_rules(extract_relevant_rules(self.rules, g.organism), self.amrfp_nodes)
+        return geno_results
+
+    def genotypes(self, no_rule_interpretation='none'):
+        return expand_genotypes(self.matched_results(), self.card_drug_map, self.card_amrfp_conversion, no_rule_interpretation)
+
+
+@pytest.fixture(scope='session')
+def resources_available():
+    rm = ResourceManager()
+    missing = [f for f in ("ReferenceGeneHierarchy.txt",) if not (rm.amrfp_dir / f).exists()]
+    missing += [f for f in ("aro.obo", "aro_categories.tsv") if not (rm.card_dir / f).exists()]
+    if missing:
+        pytest.skip(f"Resource files missing ({', '.join(missing)}). Please run: amrrules --download-resources")
+
+
+@pytest.fixture(scope='session')
+def cohort(request):
+    size = request.config.getoption('--cohort-size')
+    seed = request.config.getoption('--cohort-seed')
+    amrfp_file, organism_file = quiet(write_cohort, size, DATA_DIR, seed=seed)
+    return Cohort(amrfp_file, organism_file, size)
+
+
+@pytest.fixture(scope='session')
+def pipeline_inputs(cohort, resources_available):
+    organism_dict, _ = get_organisms(cohort.organism_file)
+    rm = ResourceManager()
+    with open_input(cohort.amrfp_file) as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        raw_rows = list(reader)
+        fieldnames = reader.fieldnames.copy()
+    return PipelineInputs(
+        organism_dict=organism_dict,
+        rules=parse_rules_file(get_rule_files(organism_dict.values())),
+        amrfp_nodes=rm.refseq_nodes(),
+        card_amrfp_conversion=rm.get_amrfp_card_conversion(),
+        card_drug_map=rm.get_card_drug_class_map(),
+        raw_rows=raw_rows,
+        fieldnames=fieldnames,
+    )
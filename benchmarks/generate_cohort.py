@@ -0,0 +1,195 @@
+"""
+Generate synthetic AMRFinderPlus cohorts for benchmarking, by resampling the marker
+profiles in the bundled test inputs (tests/data/input).
+
+Each synthetic genome is based on a randomly chosen real genome of the same organism.
+Each of its markers is kept with a fixed probability, and a few extra markers are drawn
+from that organism's pooled marker distribution. This keeps the realistic mix of gene
+presence, POINTX/POINTN, PARTIAL and INTERNAL_STOP rows while giving every sample a
+slightly different profile. The same seed always produces the same cohort.
+
+Usage:
+    python -m benchmarks.generate_cohort --samples 1000 --out-dir benchmarks/data
+"""
+
+import argparse
+import csv
+import gzip
+import os
+import random
+from collections import Counter, defaultdict
+from pathlib import Path
+
+INPUT_DIR = Path(__file__).resolve().parent.parent / "tests" / "data" / "input"
+
+# bundled input files, with either the organism they belong to or the organism file that assigns one per sample
+SOURCES = [
+    ('test_abaumannii_20strains.tsv', 's__Acinetobacter baumannii'),
+    ('test_bordetella_20strains.tsv', 'test_bordetella_species.tsv'),
+    ('test_cjejuni_20strains.tsv', 's__Campylobacter jejuni'),
+    ('test_ecoli_20strains.tsv', 's__Escherichia coli'),
+    ('test_efaecium_20strains.tsv', 's__Enterococcus faecium'),
+    ('test_koxycomplex_20strains.tsv', 'test_koxycomplex_20strains_species.tsv'),
+    ('test_kpneumo_20strains.tsv', 's__Klebsiella pneumoniae'),
+    ('test_kpneumo_MDR.tsv', 's__Klebsiella pneumoniae'),
+    ('test_kpneumo_disrupt.tsv', 's__Klebsiella pneumoniae'),
+    ('test_legionella_20strains.tsv', 's__Legionella pneumophila'),
+    ('test_multispp_amrfp.tsv', 'test_multispp_species.tsv'),
+    ('test_mycotb_20strains.tsv', 's__Mycobacterium tuberculosis'),
+    ('test_ngono_20strains.tsv', 's__Neisseria gonorrhoeae'),
+    ('test_nmeningitidis_20strains.tsv', 's__Neisseria meningitidis'),
+    ('test_pmirabilis_20strains.tsv', 's__Proteus mirabilis'),
+    ('test_pseud_20strains.tsv', 's__Pseudomonas aeruginosa'),
+    ('test_saureus_20strains.tsv', 's__Staphylococcus aureus'),
+    ('test_senterica_20strains.tsv', 's__Salmonella enterica'),
+    ('test_shewanella_20strains.tsv', 's__Shewanella algae'),
+]
+
+# all synthetic cohorts are written with the AMRFinderPlus header used by most of the bundled inputs
+OUTPUT_HEADER = ['Name', 'Protein identifier', 'Contig id', 'Start', 'Stop', 'Strand', 'Gene symbol', 'Sequence name',
+                 'Scope', 'Element type', 'Element subtype', 'Class', 'Subclass', 'Method', 'Target length',
+                 'Reference sequence length', '% Coverage of reference sequence', '% Identity to reference sequence',
+                 'Alignment length', 'Accession of closest sequence', 'Name of closest sequence', 'HMM id',
+                 'HMM description', 'Hierarchy node']
+
+# newer AMRFinderPlus column names, mapped to the names in OUTPUT_HEADER
+COLUMN_ALIASES = {
+    'Protein id': 'Protein identifier',
+    'Element symbol': 'Gene symbol',
+    'Element name': 'Sequence name',
+    'Type': 'Element type',
+    'Subtype': 'Element subtype',
+    '% Coverage of reference': '% Coverage of reference sequence',
+    '% Identity to reference': '% Identity to reference sequence',
+    'Closest reference accession': 'Accession of closest sequence',
+    'Closest reference name': 'Name of closest sequence',
+    'HMM accession': 'HMM id',
+}
+
+
+def _read_organism_file(path):
+    organisms = {}
+    with open(path, 'r') as f:
+        for line in f:
+            sample_id, organism = line.strip().split('\t')
+            organisms[sample_id] = organism
+    return organisms
+
+
+def _organisms_with_rules():
+    """Return the organisms that have rules in this installation, or None if the rules can't be found."""
+    try:
+        from amrrules.utils import get_supported_organisms
+        return set(get_supported_organisms())
+    except (ImportError, FileNotFoundError):
+        return None
+
+
+def load_profiles(input_dir=INPUT_DIR, supported_organisms=None):
+    """
+    Read the bundled inputs and return a dict of organism -> list of genome profiles,
+    where each profile is the list of (normalised) rows for one genome.
+    """
+    profiles = defaultdict(dict) # key: organism, value: dict of sample name -> rows
+    for input_file, organism_source in SOURCES:
+        if organism_source.endswith('.tsv'):
+            organism_map = _read_organism_file(input_dir / organism_source)
+        else:
+            organism_map = None
+        with open(input_dir / input_file, 'r') as f:
+            reader = csv.DictReader(f, delimiter='\t')
+            for row in reader:
+                row = {COLUMN_ALIASES.get(k, k): v for k, v in row.items()}
+                sample = f"{input_file}:{row.get('Name', 'sample')}"
+                organism = organism_map.get(row.get('Name')) if organism_map else organism_source
+                if organism is None or (supported_organisms and organism not in supported_organisms):
+                    continue
+                profiles[organism].setdefault(sample, []).append({col: row.get(col, 'NA') for col in OUTPUT_HEADER})
+    return {organism: list(samples.values()) for organism, samples in profiles.items()}
+
+
+def generate_cohort(n_samples, seed=1, keep=0.9, extra_markers=2, organisms=None, profiles=None):
+    """
+    Yield (sample name, organism, rows) for n_samples synthetic genomes.
+    """
+    rng = random.Random(seed)
+    if profiles is None:
+        # only use organisms with rules, so that synthetic genomes aren't skipped by amrrules
+        profiles = load_profiles(supported_organisms=_organisms_with_rules())
+    if organisms:
+        profiles = {org: p for org, p in profiles.items() if org in organisms}
+    if not profiles:
+        raise ValueError("No source genomes available for the requested organisms.")
+
+    organism_names = sorted(profiles)
+    # weight each organism by how many source genomes we have for it
+    weights = [len(profiles[org]) for org in organism_names]
+    marker_pools = {org: [row for profile in profiles[org] for row in profile] for org in organism_names}
+    width = len(str(n_samples))
+
+    for i in range(n_samples):
+        organism = rng.choices(organism_names, weights=weights)[0]
+        template = rng.choice(profiles[organism])
+        rows = [row for row in template if rng.random() < keep]
+        for _ in range(rng.randint(0, extra_markers)):
+            rows.append(rng.choice(marker_pools[organism]))
+        # every genome needs at least one row, otherwise it won't appear in the AMRFinderPlus file
+        if not rows:
+            rows = template[:1]
+
+        sample_name = f"SYN{i + 1:0{width}d}"
+        seen_markers = set()
+        sample_rows = []
+        for row in rows:
+            marker = (row['Gene symbol'], row['Hierarchy node'])
+            if marker in seen_markers:
+                continue
+            seen_markers.add(marker)
+            row = dict(row)
+            row['Name'] = sample_name
+            sample_rows.append(row)
+        yield sample_name, organism, sample_rows
+
+
+def write_cohort(n_samples, out_dir, seed=1, gzipped=False, **kwargs):
+    """
+    Write a synthetic cohort to out_dir, and return the paths to the AMRFinderPlus file and organism file.
+    Existing files for the same size and seed are reused, as generation is deterministic.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    stem = f"cohort_{n_samples}_seed{seed}"
+    amrfp_file = os.path.join(out_dir, stem + ('.tsv.gz' if gzipped else '.tsv'))
+    organism_file = os.path.join(out_dir, stem + '_species.tsv')
+    if os.path.exists(amrfp_file) and os.path.exists(organism_file) and not kwargs:
+        return amrfp_file, organism_file
+
+    opener = gzip.open if gzipped else open
+    methods = Counter()
+    with opener(amrfp_file, 'wt', newline='') as out, open(organism_file, 'w') as org_out:
+        writer = csv.DictWriter(out, fieldnames=OUTPUT_HEADER, delimiter='\t')
+        writer.writeheader()
+        for sample_name, organism, rows in generate_cohort(n_samples, seed=seed, **kwargs):
+            writer.writerows(rows)
+            org_out.write(f"{sample_name}\t{organism}\n")
+            methods.update(row['Method'] for row in rows)
+    print(f"Wrote {n_samples} synthetic genomes to {amrfp_file}")
+    print("Rows per method: " + ", ".join(f"{m}={n}" for m, n in sorted(methods.items())))
+    return amrfp_file, organism_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic AMRFinderPlus cohort for benchmarking AMRrules.")
+    parser.add_argument('--samples', '-n', type=int, nargs='+', default=[1000], help='Number of genomes to generate. Give several values to write several cohorts (eg 1000 10000 100000).')
+    parser.add_argument('--out-dir', '-d', type=str, default=str(Path(__file__).resolve().parent / "data"), help='Output directory. Default is benchmarks/data.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed. The same seed always produces the same cohort.')
+    parser.add_argument('--organism', '-o', type=str, action='append', help='Only generate genomes for this organism. Can be given multiple times.')
+    parser.add_argument('--gzip', action='store_true', help='Write the AMRFinderPlus file gzipped.')
+    args = parser.parse_args()
+
+    kwargs = {'organisms': args.organism} if args.organism else {}
+    for n in args.samples:
+        write_cohort(n, args.out_dir, seed=args.seed, gzipped=args.gzip, **kwargs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""Checkpointing of long cohort runs, so that an interrupted run can be resumed rather than restarted."""
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from amrrules import __version__
+from amrrules.metrics import RuleStats
+from amrrules.cohort_summary import CohortSummary
+from amrrules.output import write_genotype_report, write_genome_report, wants_output, is_partitioned
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 2
+# options that change the content of the outputs, so must match when resuming
+# (--samples is matched on the samples it selects, as it can be a file that is edited between runs)
+OUTPUT_OPTIONS = ['organism', 'sample_id', 'amr_tool', 'no_rule_interpretation', 'annot_opts', 'flag_core',
+                  'full_disrupt', 'print_non_amr', 'outputs', 'drugs', 'drug_classes', 'cohort_summary',
+                  'output_layout', 'interpreted_layout', 'sqlite']
+# final reports assembled from the per-batch part files, by the report they are for
+REPORT_SUFFIXES = {'interpreted': '_interpreted.tsv', 'summary': '_genome_summary.tsv'}
+
+
+def _file_stamp(path):
+    """Identify an input file by its absolute path, size and modification time."""
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _sample_set_digest(samples):
+    """Identify a set of sample names by a checksum of the sorted names."""
+    digest = hashlib.sha256()
+    for sample in sorted(samples):
+        digest.update(sample.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+def run_fingerprint(args, resource_versions, selected_samples=None):
+    """
+    Everything about a run that determines its outputs: the amrrules version, the input (and organism) files,
+    the interpretation options, the samples selected with --samples (None for all of them) and the resource
+    versions. A run can only be resumed if this matches.
+    """
+    return {
+        'amrrules_version': __version__,
+        'input': _file_stamp(args.input),
+        'organism_file': _file_stamp(args.organism_file) if args.organism_file else None,
+        'options': {opt: getattr(args, opt, None) for opt in OUTPUT_OPTIONS},
+        'selected_samples': _sample_set_digest(selected_samples) if selected_samples is not None else None,
+        'resources': resource_versions,
+    }
+
+
+def iter_sample_batches(reader, batch_size, completed_samples=None, rows_done=0):
+    """
+    Split the rows from a csv.DictReader into batches of (up to) batch_size samples, only ever splitting
+    between samples. Yields (rows, sample names) for each batch. The rows of samples already completed in an
+    earlier run (completed_samples, which had rows_done rows between them) are read past without being returned.
+    Each sample's rows must be together in the input, otherwise a sample could be split across batches.
+    """
+    completed_samples = set(completed_samples or ())
+    rows = []
+    samples = [] # in order of first appearance in the batch
+    batch_samples = set()
+    # completed samples all come at the start of the input, before any sample still to do
+    resuming = bool(completed_samples)
+    rows_skipped = 0
+    for row in reader:
+        sample = row.get('Name', '')
+        if resuming:
+            if sample in completed_samples:
+                rows_skipped += 1
+                continue
+            resuming = False
+            _check_rows_skipped(rows_skipped, rows_done)
+        if sample not in batch_samples:
+            if sample in completed_samples:
+                raise ValueError(
+                    f"Sample {sample} has rows in more than one place in the input file. Checkpointing needs all of a "
+                    f"sample's rows to be together (eg sort the input by the Name column), or run without --checkpoint-dir.")
+            # a new sample starts here, so this is a safe place to end the batch
+            if len(samples) >= batch_size:
+                yield rows, samples
+                completed_samples.update(samples)
+                rows, samples, batch_samples = [], [], set()
+            samples.append(sample)
+            batch_samples.add(sample)
+        rows.append(row)
+    if resuming:
+        _check_rows_skipped(rows_skipped, rows_done)
+    if rows:
+        yield rows, samples
+
+
+def _check_rows_skipped(rows_skipped, rows_done):
+    if rows_skipped != rows_done:
+        raise ValueError(
+            f"Cannot resume: the completed samples have {rows_skipped} rows at the start of the input, but had {rows_done} "
+            f"rows in the checkpointed run. Rerun with the original input, or use a new checkpoint directory.")
+
+
+class Checkpoint:
+    """
+    A checkpoint directory for one run. After each batch of samples, its interpreted rows, summary rows and rule
+    stats are written to part files, and the manifest is updated (atomically) to record the batch as complete and
+    how far through the input file we are. The final reports are assembled from the part files once every batch
+    is done, so they're identical to those from an uninterrupted run.
+    """
+
+    def __init__(self, checkpoint_dir, fingerprint, resume=False):
+        self.dir = Path(checkpoint_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.dir / MANIFEST_FILE
+        self.fingerprint = fingerprint
+
+        if self.manifest_path.exists():
+            if not resume:
+                raise ValueError(
+                    f"Checkpoint directory {self.dir} already contains a run. Use --resume to continue it, "
+                    f"or choose an empty directory to start again.")
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+            self._validate()
+            print(f"Resuming from checkpoint: {len(self.manifest['batches'])} batches "
+                  f"({self.manifest['rows_done']} rows) already complete.")
+        else:
+            if resume:
+                print(f"No checkpoint found in {self.dir}, starting from the beginning.")
+            self.manifest = {'manifest_version': MANIFEST_VERSION, **fingerprint, 'rows_done': 0, 'batches': [], 'complete': False}
+            self._save()
+
+    def _validate(self):
+        """Check that the checkpointed run used the same inputs, options and resources as this one."""
+        if self.manifest.get('manifest_version') != MANIFEST_VERSION:
+            raise ValueError(f"Cannot resume from {self.dir}: it was written by an incompatible version of amrrules.")
+        differences = [key for key, value in self.fingerprint.items() if self.manifest.get(key) != value]
+        if differences:
+            raise ValueError(
+                f"Cannot resume from {self.dir}: the {', '.join(d.replace('_', ' ') for d in differences)} "
+                f"differ from the checkpointed run. Rerun with the original settings, or use a new checkpoint directory.")
+
+    def _save(self):
+        """Write the manifest via a temporary file, so an interruption never leaves a partly written manifest."""
+        fd, temp_path = tempfile.mkstemp(dir=self.dir, prefix=f".{MANIFEST_FILE}.", suffix=".part")
+        with os.fdopen(fd, 'w') as out:
+            json.dump(self.manifest, out, indent=2)
+            out.write('\n')
+        os.replace(temp_path, self.manifest_path)
+
+    @property
+    def rows_done(self):
+        return self.manifest['rows_done']
+
+    @property
+    def completed_samples(self):
+        return [sample for batch in self.manifest['batches'] for sample in batch['samples']]
+
+    def totals(self):
+        """Sum the per-batch counts (rows, samples, matched markers, ...) over all completed batches."""
+        totals = {}
+        for batch in self.manifest['batches']:
+            for name, n in batch['counts'].items():
+                totals[name] = totals.get(name, 0) + n
+        return totals
+
+    def commit_batch(self, args, output_rows, base_fieldnames, summary_entry_dict, rule_stats, rows, samples, counts, cohort_summary=None):
+        """Write the part files for a completed batch, then record it in the manifest."""
+        batch_number = len(self.manifest['batches']) + 1
+        prefix = f"batch_{batch_number:06d}"
+        # part files are only trusted once the manifest lists them, so a batch interrupted while writing is just redone
+        # (with --output-layout partitioned, the reports have already been written to each sample's partition)
+        batch_args = argparse.Namespace(**{**vars(args), 'output_dir': str(self.dir), 'output_prefix': prefix})
+        if wants_output(args, 'interpreted') and not is_partitioned(args):
+            write_genotype_report(batch_args, output_rows, [], {}, base_fieldnames)
+        if wants_output(args, 'summary') and not is_partitioned(args):
+            write_genome_report(summary_entry_dict, str(self.dir), prefix)
+        with open(self.dir / f"{prefix}_rule_stats.json", 'w') as out:
+            json.dump(rule_stats.as_dict(), out)
+        if cohort_summary is not None:
+            with open(self.dir / f"{prefix}_cohort_summary.json", 'w') as out:
+                json.dump(cohort_summary.as_dict(), out)
+
+        self.manifest['batches'].append({'batch': batch_number, 'prefix': prefix, 'rows': rows, 'samples': samples, 'counts': counts})
+        self.manifest['rows_done'] += rows
+        self._save()
+
+    def assemble(self, args):
+        """
+        Concatenate the part files from every batch into the final reports (keeping only the first header),
+        and return the paths to the interpreted and genome summary reports (None if the report wasn't
+        asked for with --outputs), the merged rule stats and the merged cohort summary (None without --cohort-summary).
+        """
+        output_dir, output_prefix = args.output_dir, args.output_prefix
+        output_files = {}
+        for report, suffix in REPORT_SUFFIXES.items():
+            if not wants_output(args, report) or is_partitioned(args):
+                output_files[report] = None
+                continue
+            output_file = os.path.join(output_dir, output_prefix + suffix)
+            fd, temp_path = tempfile.mkstemp(dir=output_dir, prefix=f".{output_prefix}{suffix}.", suffix=".part")
+            with os.fdopen(fd, 'w', newline='') as out:
+                for i, batch in enumerate(self.manifest['batches']):
+                    with open(self.dir / (batch['prefix'] + suffix), 'r', newline='') as part:
+                        header = part.readline()
+                        if i == 0:
+                            out.write(header)
+                        for line in part:
+                            out.write(line)
+            os.replace(temp_path, output_file)
+            output_files[report] = output_file
+
+        rule_stats = RuleStats()
+        for batch in self.manifest['batches']:
+            with open(self.dir / f"{batch['prefix']}_rule_stats.json", 'r') as f:
+                rule_stats.merge(RuleStats.from_dict(json.load(f)))
+        cohort_summary = None
+        if getattr(args, 'cohort_summary', False):
+            cohort_summary = CohortSummary()
+            for batch in self.manifest['batches']:
+                with open(self.dir / f"{batch['prefix']}_cohort_summary.json", 'r') as f:
+                    cohort_summary.merge(CohortSummary.from_dict(json.load(f)))
+
+        self.manifest['complete'] = True
+        self._save()
+        return output_files['interpreted'], output_files['summary'], rule_stats, cohort_summary
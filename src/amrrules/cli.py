@@ -1,12 +1,34 @@
-import argparse, os
+import argparse, contextlib, os, sys
 from amrrules import rules_engine, __version__
 from amrrules.utils import get_supported_organisms
 
-def main():
-
-    # Get list of valid organism names
-    supported_organisms = get_supported_organisms()
+def add_interpretation_options(parser):
+    """
+    Add the options that control how genotypes are interpreted and which resources are used.
+    These are shared by the main command and the watch subcommand.
+    """
+    #TODO: implement card and resfinder options, currently only amrfp is supported
+    parser.add_argument('--amr-tool', '-t', type=str, default='amrfp', help='AMR tool used to detect genotypes. Currently only amrfp is supported.')
+    #parser.add_argument('--hamronized', '-H', action='store_true', help='Input file has been hamronized')
+    parser.add_argument('--amrfp-db-version', type=str, default='latest', help="Version of the AMRFinderPlus database to use (eg 2025-07-16.1). Default is latest, the most recently downloaded version. With --download-resources, give the NCBI release directory instead (eg 4.0/2025-07-16.1) to download a specific version.")
+    parser.add_argument('--card-version', type=str, default='latest', help='Version of CARD to use (eg 4.0.1). Default is latest, the most recently downloaded version.')
+    parser.add_argument('--resource-dir', type=str, default=None, help='Directory holding downloaded AMRFinderPlus and CARD resources, one sub-directory per version. Can be shared between runs and machines. Default is $AMRRULES_RESOURCE_DIR if set, otherwise the amrrules package directory.')
+    parser.add_argument('--shared-tables', action='store_true', help='Load the AMRFinderPlus and CARD reference data from memory-mapped tables in the resource directory (built on first use), so that many amrrules processes running on one machine share a single copy in memory and start up faster.')
+    parser.add_argument('--no-rule-interpretation', '-nr', type=str, default = 'none', choices=['nwtR', 'nwtS', 'nwt', 'none'], help='How to interpret hits that do not match a rule. Default is none. Options are: none - hits will be given no phenotype and no clinical category; nwt - hits will be flagged as phenotype nonwildtype, but no clinical category will be set; nwtR - hits will be interpreted as nonwildtype and given the clinical category resistant; nwtS - hits will be interpreted as nonwildtype and given the clinical category susceptible.')
+    parser.add_argument('--annot-opts', '-a', type=str, default='minimal', choices=['minimal', 'full'], help='Annotation options: minimal (context, drug, phenotype, category, evidence grade), full (everything including breakpoints, standards, etc)')
+    parser.add_argument('--interpreted-layout', choices=['expanded', 'compact'], default='expanded', help="Layout of the interpreted report: expanded (default) writes one row per matched rule, so a hit matching several rules is written several times; compact writes one row per hit, with the annotation columns that differ between its rules joined with ';' in rule order.")
+    parser.add_argument('--flag-core', action='store_true', help='Turn on flagging core genes in the summary output')
+    parser.add_argument('--full-disrupt', action='store_true', help='Show the full mutation detected by AMRFinderPlus for POINT_DISRUPT calls in the summary report, rather than just labelling them as gene:-')
+    parser.add_argument('--print-non-amr', action='store_true', help='Include non-AMR rows (eg VIRULENCE, STRESS) from the input file in the interpreted output. By default, these rows are skipped.')
+    parser.add_argument('--outputs', type=str, default='both', choices=['both', 'interpreted', 'summary'], help='Which reports to write: both (default), interpreted (only _interpreted.tsv) or summary (only _genome_summary.tsv). Work that is only needed for the other report is skipped.')
+    parser.add_argument('--drugs', type=str, default=None, help='Only report on these drugs (comma-separated, eg "ciprofloxacin,meropenem"). Class level rules for the drug classes of these drugs are kept too, as they are part of how the drugs are interpreted.')
+    parser.add_argument('--drug-classes', type=str, default=None, help='Only report on these drug classes (comma-separated, eg "carbapenem,fluoroquinolone antibiotic"). Can be combined with --drugs.')
 
+def build_parser():
+    """
+    Build the argument parser for the main amrrules command.
+    This is kept separate from main() so that the same options can be reused when calling run() directly (eg in benchmarks).
+    """
     parser = argparse.ArgumentParser(description="Interpretation engine for AMRrules.")
     parser.add_argument('--input', type=str, help='Path to the tabular input file (must be AMRFinderPlus output for this version). Can be gzipped.')
     parser.add_argument('--output-prefix', type=str, help='Prefix name for the output files.')
@@ -17,23 +39,167 @@ def main():
     org_args.add_argument('--organism', '-o', type=str, help=f"Organism to interpret. Use --list-organisms to see all supported organisms.")
     org_args.add_argument('--organism-file', '-of', type=str, help='Path to the organism file. This file should have two columns: genome name in col1 (matching the sample name in the first col of the input file), and col2 is the organism name, which should be one of the supported organisms. File should be in tab-delimited format, with no header')
     org_args.add_argument('--list-organisms', action='store_true', help='List all supported organisms and exit.')
-    #TODO: implement card and resfinder options, currently only amrfp is supported
-    parser.add_argument('--amr-tool', '-t', type=str, default='amrfp', help='AMR tool used to detect genotypes. Currently only amrfp is supported.')
-    #parser.add_argument('--hamronized', '-H', action='store_true', help='Input file has been hamronized')
-    # TODO: implement this option to allow for selection of different AMRFP databases
-    #parser.add_argument('--amrfp_db_version', type=str, default='latest', help='Version of the AMRFP database used. Default is latest. NOTE STILL TO BE IMPLEMENTED')
-    parser.add_argument('--no-rule-interpretation', '-nr', type=str, default = 'none', choices=['nwtR', 'nwtS', 'nwt', 'none'], help='How to interpret hits that do not match a rule. Default is none. Options are: none - hits will be given no phenotype and no clinical category; nwt - hits will be flagged as phenotype nonwildtype, but no clinical category will be set; nwtR - hits will be interpreted as nonwildtype and given the clinical category resistant; nwtS - hits will be interpreted as nonwildtype and given the clinical category susceptible.')
-    parser.add_argument('--annot-opts', '-a', type=str, default='minimal', choices=['minimal', 'full'], help='Annotation options: minimal (context, drug, phenotype, category, evidence grade), full (everything including breakpoints, standards, etc)')
-    parser.add_argument('--flag-core', action='store_true', help='Turn on flagging core genes in the summary output')
-    parser.add_argument('--full-disrupt', action='store_true', help='Show the full mutation detected by AMRFinderPlus for POINT_DISRUPT calls in the summary report, rather than just labelling them as gene:-')
-    parser.add_argument('--print-non-amr', action='store_true', help='Include non-AMR rows (eg VIRULENCE, STRESS) from the input file in the interpreted output. By default, these rows are skipped.')
+    add_interpretation_options(parser)
+    parser.add_argument('--samples', type=str, default=None, help='Only interpret these samples from the input file: a comma-separated list of names, or a file with one name per line. If the input has been indexed with amrrules index, only the rows for these samples are read.')
+    parser.add_argument('--sample-index', type=str, default=None, help='Sample index for the input file, from amrrules index. Default is the input file name with .amrrules_index.json added, if it exists.')
+    parser.add_argument('--compare-rules', type=str, default=None, metavar='OLD_RULES_DIR', help='Compare the current rules against an older set of rules in this directory (laid out like the packaged rules directory, with rule_key_file.tsv). Each sample is interpreted with both in a single pass, and the per-sample, per-drug differences in the genome summary are written to _rules_comparison.tsv, with aggregate counts in _rules_comparison_counts.tsv, instead of the usual reports. Samples are compared (and written out) one at a time, so all rows for a sample must be together in the input.')
+    parser.add_argument('--output-layout', choices=['combined', 'partitioned'], default='combined', help='combined (default): write one _interpreted.tsv and one _genome_summary.tsv for the whole run. partitioned: write a separate interpreted.tsv and genome_summary.tsv for each sample, in Hive-style OUTPUT_DIR/OUTPUT_PREFIX/organism=ORGANISM/sample=SAMPLE directories.')
+    parser.add_argument('--max-open-files', type=int, default=128, help='With --output-layout partitioned, the most per-sample report files to keep open at once. Default is 128.')
+    parser.add_argument('--ndjson', type=str, default=None, metavar='PATH', help="Also stream each sample's interpreted rows and genome summary entries as JSON lines to this file (or to standard output if PATH is -, with the progress messages sent to standard error), as soon as the sample has been interpreted. The stream is flushed at the end of each sample, so it can be tailed while the run is going. Each sample's rows must be together in the input.")
+    parser.add_argument('--sqlite', type=str, default=None, metavar='PATH', help='Also store the interpreted rows and genome summary entries in this SQLite database (created if needed), with the amrrules, rules, AMRFinderPlus and CARD versions and options of the run. Results are kept per sample and rules version: re-running a sample with the same rules replaces its earlier results, and results from other rule versions are kept. The results are indexed by sample, organism, drug, drug class, ruleID and clinical category.')
+    parser.add_argument('--cohort-summary', action='store_true', help='Write a _cohort_summary.tsv report of cohort-level aggregates of the genome summary: the number and prevalence of samples per organism with each clinical category for each drug, carrying each marker and hitting each rule. Reports from separate runs or shards of a cohort can be combined with amrrules merge-cohort.')
+    parser.add_argument('--rule-stats', action='store_true', help='Write a _rule_stats.tsv report counting how often each rule was hit and evaluated across the run (in total and per sample), grouped by how it was matched (nodeID, hierarchy, nucleotide/protein/HMM accession or combination), with a final row for all combination rule evaluations in the run.')
+    parser.add_argument('--metrics-json', type=str, default=None, help='Write a machine-readable run report (wall time and CPU time per stage, peak memory of the process as of the end of each stage and of the run, throughput and cache hit rates) to this JSON file.')
+    parser.add_argument('--trace', type=str, default=None, help='Write a Chrome trace-event JSON file of per-sample spans for this run, which can be opened in chrome://tracing or Perfetto.')
+    parser.add_argument('--checkpoint-dir', type=str, default=None, help='Directory to checkpoint a long run in. Outputs are saved there after each batch of samples, so that an interrupted run can be continued with --resume. The input must have all rows for a sample together.')
+    parser.add_argument('--checkpoint-batch-size', type=int, default=1000, help='Number of samples in each checkpointed batch. Default is 1000.')
+    parser.add_argument('--resume', action='store_true', help='Continue the run checkpointed in --checkpoint-dir, skipping the samples that were already completed. The input, options and resources must be the same as in the original run.')
     parser.add_argument('--download-resources', action='store_true', help='Download AMRFinderPlus resource files and exit.')
     parser.add_argument('--version', action='version', version=f"amrrules {__version__}")
+    return parser
+
+def build_watch_parser():
+    """
+    Build the argument parser for the watch subcommand (amrrules watch DIR), which keeps the rules and resources
+    loaded and interprets AMRFinderPlus files as they arrive in a directory.
+    """
+    parser = argparse.ArgumentParser(prog="amrrules watch", description="Watch a directory and interpret AMRFinderPlus files as they arrive.")
+    parser.add_argument('watch_dir', metavar='DIR', type=str, help='Directory to watch for AMRFinderPlus output files.')
+    parser.add_argument('--output-dir', '-d', type=str, default=os.getcwd(), help='Output directory. Each input file gets its own _interpreted.tsv and _genome_summary.tsv, named after the file, unless --rolling-prefix is used. Default is current working directory.')
+    parser.add_argument('--rolling-prefix', type=str, default=None, help='Append the results for each file to a single pair of rolling reports with this prefix, rather than writing per-file reports.')
 
+    org_args = parser.add_mutually_exclusive_group(required=True)
+    org_args.add_argument('--organism', '-o', type=str, help="Organism to interpret every file as.")
+    org_args.add_argument('--organism-file', '-of', type=str, help='Path to the organism file, as for the main command. It is re-read for each file, so new samples can be added to it as they arrive. Input files must then have a Name column.')
+    add_interpretation_options(parser)
+    parser.add_argument('--pattern', type=str, action='append', default=None, help='Filename pattern of the files to interpret. Can be given more than once. Default is *.tsv and *.tsv.gz.')
+    parser.add_argument('--settle-time', type=float, default=10, help="Seconds a file must go unmodified before it's considered complete and is interpreted. Default is 10.")
+    parser.add_argument('--poll-interval', type=float, default=5, help='Seconds between checks of the directory for new files. Default is 5.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of files to interpret at once, each worker keeping its own copy of the rules and resources. Default is 1.')
+    parser.add_argument('--log-interval', type=float, default=60, help='Seconds between throughput and lag log lines. Default is 60.')
+    parser.add_argument('--once', action='store_true', help='Interpret the files already in the directory (waiting for any still being written), then exit.')
+    return parser
+
+def watch_main(argv):
+    from amrrules import watch
+
+    parser = build_watch_parser()
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.watch_dir):
+        parser.error(f"{args.watch_dir} is not a directory.")
+    if args.workers < 1:
+        parser.error('--workers must be at least 1.')
+    if args.amr_tool != 'amrfp':
+        raise NotImplementedError("Currently only amrfp is supported. Please use amrfp as the AMR tool.")
+    if args.organism and args.organism not in get_supported_organisms():
+        parser.error(f"Invalid organism name. Must be one of:\n{'\n'.join(get_supported_organisms())}")
+    if not args.pattern:
+        args.pattern = ['*.tsv', '*.tsv.gz']
+    watch.watch(args)
+
+def build_index_parser():
+    """Build the argument parser for the index subcommand (amrrules index INPUT)."""
+    parser = argparse.ArgumentParser(prog="amrrules index", description="Index the samples in a large AMRFinderPlus file, so that amrrules --samples can read just their rows.")
+    parser.add_argument('input', metavar='INPUT', type=str, help='AMRFinderPlus file with a Name column. Can be gzipped; compress it with bgzip rather than gzip for fast random access.')
+    parser.add_argument('--output', type=str, default=None, help='Path to write the index to. Default is the input file name with .amrrules_index.json added.')
+    return parser
+
+def index_main(argv):
+    from amrrules.sample_index import build_index
+
+    parser = build_index_parser()
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.input):
+        parser.error(f"{args.input} does not exist.")
+    build_index(args.input, args.output)
+
+def build_merge_cohort_parser():
+    """Build the argument parser for the merge-cohort subcommand (amrrules merge-cohort REPORT...)."""
+    parser = argparse.ArgumentParser(prog="amrrules merge-cohort", description="Combine the _cohort_summary.tsv reports from separate runs or shards of a cohort.")
+    parser.add_argument('reports', metavar='REPORT', type=str, nargs='+', help='_cohort_summary.tsv reports to combine. Each sample should only be in one of them.')
+    parser.add_argument('--output-prefix', type=str, required=True, help='Prefix name for the combined _cohort_summary.tsv.')
+    parser.add_argument('--output-dir', '-d', type=str, default=os.getcwd(), help='Output directory. Default is current working directory.')
+    return parser
+
+def merge_cohort_main(argv):
+    from amrrules.cohort_summary import merge_cohort_summaries
+    from amrrules.output import write_cohort_summary
+
+    parser = build_merge_cohort_parser()
+    args = parser.parse_args(argv)
+    for report in args.reports:
+        if not os.path.isfile(report):
+            parser.error(f"{report} does not exist.")
+    cohort_summary = merge_cohort_summaries(args.reports)
+    cohort_summary_file = write_cohort_summary(cohort_summary, args.output_dir, args.output_prefix)
+    print(f"Combined {len(args.reports)} reports ({sum(cohort_summary.samples.values())} samples) into {cohort_summary_file}")
+
+def build_plan_parser():
+    """
+    Build the argument parser for the plan subcommand (amrrules plan --input INPUT ...), which estimates what a run
+    will cost from a sample of its input, and recommends how to shard it.
+    """
+    parser = argparse.ArgumentParser(prog="amrrules plan", description="Estimate the runtime, peak memory and output size of an amrrules run from a sample of its input, and recommend how many shards to split it into and how many to run at once.")
+    parser.add_argument('--input', type=str, required=True, help='Path to the AMRFinderPlus file the run will interpret. Can be gzipped; a file compressed with bgzip is sampled throughout, one compressed with gzip only from the start.')
+    org_args = parser.add_mutually_exclusive_group(required=True)
+    org_args.add_argument('--organism', '-o', type=str, help='Organism the run will interpret the input as.')
+    org_args.add_argument('--organism-file', '-of', type=str, help='Organism file the run will use, as for the main command.')
+    parser.add_argument('--annot-opts', '-a', type=str, default='minimal', choices=['minimal', 'full'], help='--annot-opts of the run. Default is minimal.')
+    parser.add_argument('--interpreted-layout', choices=['expanded', 'compact'], default='expanded', help='--interpreted-layout of the run. Default is expanded.')
+    parser.add_argument('--outputs', type=str, default='both', choices=['both', 'interpreted', 'summary'], help='--outputs of the run. Default is both.')
+    parser.add_argument('--print-non-amr', action='store_true', help='The run will use --print-non-amr.')
+    parser.add_argument('--checkpoint-dir', type=str, default=None, help='The run will be checkpointed in this directory.')
+    parser.add_argument('--checkpoint-batch-size', type=int, default=1000, help='--checkpoint-batch-size of the run. Default is 1000.')
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 1, help='Number of cores available to run shards on at once. Default is the number of cores on this machine.')
+    parser.add_argument('--memory', type=float, default=None, help='Memory available to run shards in at once, in GB. Default is no limit.')
+    parser.add_argument('--target-walltime', type=float, default=60, help='Longest each shard should run for, in minutes. Default is 60.')
+    parser.add_argument('--calibration', type=str, default=None, help='Per-row costs to predict with, from pytest benchmarks/bench_plan.py --update-plan-calibration run on the machine the job will run on. Default is the calibration packaged with amrrules.')
+    parser.add_argument('--json', type=str, default=None, metavar='PATH', help='Also write the estimates, predictions and recommendation to this JSON file.')
+    return parser
+
+def plan_main(argv):
+    import json
+    from amrrules.planner import plan, print_plan
+
+    parser = build_plan_parser()
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.input):
+        parser.error(f"{args.input} does not exist.")
+    if args.organism and args.organism not in get_supported_organisms():
+        parser.error(f"Invalid organism name. Must be one of:\n{'\n'.join(get_supported_organisms())}")
+    if args.cores < 1 or args.checkpoint_batch_size < 1:
+        parser.error('--cores and --checkpoint-batch-size must be at least 1.')
+    if args.target_walltime <= 0 or (args.memory is not None and args.memory <= 0):
+        parser.error('--target-walltime and --memory must be more than 0.')
+    result = plan(args)
+    print_plan(result, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+def main():
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        watch_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        index_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge-cohort':
+        merge_cohort_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'plan':
+        plan_main(sys.argv[2:])
+        return
+
+    # Get list of valid organism names
+    supported_organisms = get_supported_organisms()
+
+    parser = build_parser()
     args = parser.parse_args()
 
     if args.download_resources:
-        rules_engine.download_resources()
+        rules_engine.download_resources(args)
         return
     
     if args.list_organisms:
@@ -46,6 +212,29 @@ def main():
     if not args.input or not args.output_prefix or (not args.organism and not args.organism_file):
         parser.error('You must specify --input, --output-prefix, and --organism (or --organism_file) unless using --download-resources.')
 
+    if args.resume and not args.checkpoint_dir:
+        parser.error('--resume needs the --checkpoint-dir of the run to continue.')
+    if args.samples and args.sample_id:
+        parser.error('--samples selects samples by their Name column, so it cannot be used with --sample-id.')
+    if args.sample_index and not args.samples:
+        parser.error('--sample-index is only used with --samples.')
+    if args.compare_rules and (args.checkpoint_dir or args.rule_stats or args.cohort_summary):
+        parser.error('--compare-rules writes its own reports, so it cannot be used with --checkpoint-dir, --rule-stats or --cohort-summary.')
+    if args.cohort_summary and args.outputs == 'interpreted':
+        parser.error('--cohort-summary is built from the genome summary, so it cannot be used with --outputs interpreted.')
+    if args.compare_rules and not os.path.exists(os.path.join(args.compare_rules, 'rule_key_file.tsv')):
+        parser.error(f"--compare-rules directory {args.compare_rules} has no rule_key_file.tsv.")
+    if args.max_open_files < 1:
+        parser.error('--max-open-files must be at least 1.')
+    if args.compare_rules and args.output_layout == 'partitioned':
+        parser.error('--compare-rules writes its own reports, so it cannot be used with --output-layout partitioned.')
+    if args.sqlite and args.compare_rules:
+        parser.error('--compare-rules writes its own reports, so it cannot be used with --sqlite.')
+    if args.ndjson and (args.compare_rules or args.checkpoint_dir):
+        parser.error('--ndjson streams each sample as it is interpreted, so it cannot be used with --compare-rules or --checkpoint-dir.')
+    if args.checkpoint_batch_size < 1:
+        parser.error('--checkpoint-batch-size must be at least 1.')
+
     if args.amr_tool != 'amrfp':
         raise NotImplementedError("Currently only amrfp is supported. Please use amrfp as the AMR tool.")
     
@@ -59,4 +248,10 @@ def main():
             parser.error(f"Invalid organism name. Must be one of:\n{'\n'.join(supported_organisms)}")
 
 
-    rules_engine.run(args)
+    if args.ndjson == '-':
+        # the results are streamed to stdout, so everything else that would be printed goes to stderr
+        stdout = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            rules_engine.run(args, ndjson_stdout=stdout)
+    else:
+        rules_engine.run(args)
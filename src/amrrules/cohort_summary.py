@@ -0,0 +1,111 @@
+"""
+Cohort-level aggregates of the genome summary (--cohort-summary): how many samples of each organism have each
+clinical category for each drug, carry each marker, and hit each rule. The counts are updated as each sample is
+summarised, and can be merged across checkpoint batches, shards of a cohort or separate runs.
+"""
+
+import csv
+from collections import Counter
+
+COHORT_SUMMARY_COLUMNS = ['measure', 'organism', 'drug class', 'drug', 'value', 'samples', 'organism samples', 'prevalence']
+# summary entry attributes holding the markers, as written to the genome summary
+MARKER_ATTRS = ('markers_rule_nonS', 'markers_with_norule', 'markers_S')
+# ruleIDs values that aren't rules
+NOT_RULES = ('-', 'none (partial hits)')
+
+
+def _split(value):
+    return [item for item in value.split(';') if item and item not in NOT_RULES] if value else []
+
+
+class CohortSummary:
+    """Counts of samples per organism and per (organism, drug class, drug, category), marker and ruleID."""
+
+    def __init__(self):
+        self.samples = Counter() # key: organism
+        self.categories = Counter() # key: (organism, drug class, drug, clinical category)
+        self.markers = Counter() # key: (organism, marker)
+        self.rules = Counter() # key: (organism, ruleID)
+
+    def add_sample(self, organism, summary_entries):
+        """Add one sample's summary entries. Markers and rules are counted once per sample."""
+        self.samples[organism] += 1
+        markers = set()
+        rule_ids = set()
+        for entry in summary_entries:
+            self.categories[(organism, entry.drug_class, entry.drug, entry.category)] += 1
+            for attr in MARKER_ATTRS:
+                # the (core) label is only a flag on the marker, so count it with the marker
+                markers.update(marker.removesuffix(' (core)') for marker in _split(getattr(entry, attr, '-')))
+            rule_ids.update(_split(entry.ruleIDs))
+            rule_ids.update(entry.combo_ruleIDs)
+        self.markers.update((organism, marker) for marker in markers)
+        self.rules.update((organism, rule_id) for rule_id in rule_ids)
+
+    def merge(self, other):
+        """Add the counts from another CohortSummary (eg another batch or shard of the cohort) into this one."""
+        self.samples.update(other.samples)
+        self.categories.update(other.categories)
+        self.markers.update(other.markers)
+        self.rules.update(other.rules)
+
+    def as_dict(self):
+        """Return the counts as a JSON-serialisable dictionary, which can be read back with from_dict."""
+        return {
+            'samples': [[organism, n] for organism, n in self.samples.items()],
+            'categories': [list(key) + [n] for key, n in self.categories.items()],
+            'markers': [list(key) + [n] for key, n in self.markers.items()],
+            'rules': [list(key) + [n] for key, n in self.rules.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        cohort_summary = cls()
+        for name in ('samples', 'categories', 'markers', 'rules'):
+            counter = getattr(cohort_summary, name)
+            for *key, n in data[name]:
+                counter[key[0] if name == 'samples' else tuple(key)] += n
+        return cohort_summary
+
+    @classmethod
+    def from_tsv(cls, path):
+        """Read back a _cohort_summary.tsv, so that the reports from separate runs can be merged."""
+        cohort_summary = cls()
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                organism, n = row['organism'], int(row['samples'])
+                if row['measure'] == 'samples':
+                    cohort_summary.samples[organism] += n
+                elif row['measure'] == 'clinical category':
+                    cohort_summary.categories[(organism, row['drug class'], row['drug'], row['value'])] += n
+                elif row['measure'] == 'marker':
+                    cohort_summary.markers[(organism, row['value'])] += n
+                elif row['measure'] == 'ruleID':
+                    cohort_summary.rules[(organism, row['value'])] += n
+        return cohort_summary
+
+    def rows(self):
+        """
+        Return the counts as report rows: the number of samples of each organism, then the clinical categories
+        per drug, then the markers and rules (most common first), each with its prevalence within the organism.
+        """
+        def row(measure, organism, drug_class, drug, value, n):
+            total = self.samples[organism]
+            return {'measure': measure, 'organism': organism, 'drug class': drug_class, 'drug': drug, 'value': value,
+                    'samples': n, 'organism samples': total, 'prevalence': round(n / total, 4) if total else '-'}
+
+        rows = [row('samples', organism, '-', '-', '-', n) for organism, n in sorted(self.samples.items())]
+        rows += [row('clinical category', *key, n) for key, n in sorted(self.categories.items(), key=lambda item: tuple(map(str, item[0])))]
+        rows += [row('marker', organism, '-', '-', marker, n)
+                 for (organism, marker), n in sorted(self.markers.items(), key=lambda item: (item[0][0], -item[1], item[0][1]))]
+        rows += [row('ruleID', organism, '-', '-', rule_id, n)
+                 for (organism, rule_id), n in sorted(self.rules.items(), key=lambda item: (item[0][0], -item[1], item[0][1]))]
+        return rows
+
+
+def merge_cohort_summaries(paths):
+    """Merge several _cohort_summary.tsv reports (eg from shards of a cohort) into one CohortSummary."""
+    cohort_summary = CohortSummary()
+    for path in paths:
+        cohort_summary.merge(CohortSummary.from_tsv(path))
+    return cohort_summary
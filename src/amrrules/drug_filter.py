@@ -0,0 +1,66 @@
+"""
+Restrict a run to some drugs and/or drug classes (--drugs, --drug-classes), so that genotypes for anything
+else are never expanded, summarised or written out.
+"""
+
+from collections import defaultdict
+
+
+def _parse_names(value):
+    return {name.strip().lower() for name in value.split(',') if name.strip()} if value else set()
+
+
+class DrugFilter:
+    """
+    A genotype is kept if its drug is one of the drugs, or its drug class is one of the drug classes.
+    Class level genotypes (drug '-') are also kept for a sample if it has a kept genotype for a drug in that class,
+    because the class level rules are part of how that drug is interpreted in the summary.
+    """
+
+    def __init__(self, drugs=None, drug_classes=None):
+        self.drugs = _parse_names(drugs)
+        self.drug_classes = _parse_names(drug_classes)
+
+    @classmethod
+    def from_args(cls, args):
+        """Return a DrugFilter for the --drugs/--drug-classes options, or None if neither was given."""
+        drugs = getattr(args, 'drugs', None)
+        drug_classes = getattr(args, 'drug_classes', None)
+        if not drugs and not drug_classes:
+            return None
+        return cls(drugs, drug_classes)
+
+    def _wanted(self, drug, drug_class):
+        return drug.lower() in self.drugs or drug_class.lower() in self.drug_classes
+
+    def select(self, genotype_rows, genotype_templates):
+        """
+        Work out which of each row's matched rules (or AMRFP subclasses, if it has no rule) are kept, and store
+        them in its selected_rules and selected_subclasses. Only the drug and class are looked up here (from
+        their GenotypeTemplates), no Genotype objects are made.
+        """
+        # (row, rule or None, subclass or None, drug, drug class) for every expansion of every processed row
+        candidates = []
+        drug_level_classes = defaultdict(set) # key: sample name, value: classes of the selected drugs it has
+        for g in genotype_rows:
+            g.selected_rules = []
+            g.selected_subclasses = []
+            if not g.to_process:
+                continue
+            if g.matched_rules:
+                templates = [(rule, None, genotype_templates.rule_template(rule, g.amrfp_class)) for rule in g.matched_rules]
+            else:
+                templates = [(None, subclass, genotype_templates.subclass_template(subclass, g.variation_type, g.subtype, g.partial))
+                             for subclass in g.amrfp_subclass.split('/')]
+            expansions = [(rule, subclass, template.drug, template.drug_class) for rule, subclass, template in templates]
+            for rule, subclass, drug, drug_class in expansions:
+                if drug != '-' and drug.lower() in self.drugs:
+                    drug_level_classes[g.sample_name].add(drug_class)
+                candidates.append((g, rule, subclass, drug, drug_class))
+
+        for g, rule, subclass, drug, drug_class in candidates:
+            if self._wanted(drug, drug_class) or (drug == '-' and drug_class in drug_level_classes[g.sample_name]):
+                if rule is not None:
+                    g.selected_rules.append(rule)
+                else:
+                    g.selected_subclasses.append(subclass)
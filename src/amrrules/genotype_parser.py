@@ -1,7 +1,9 @@
-from typing import Any, Optional
+from typing import Any, NamedTuple, Optional
 import re
 from amrrules import __version__
 from amrrules.utils import aa_conversion, minimal_columns, full_columns
+from amrrules.mutation_ranges import parse_variant, parse_range_rule
+from amrrules.interpreted_report import InterpretedRow
 
 
 class GenoResult:
@@ -18,6 +20,9 @@ class GenoResult:
         self.mutation: Optional[str] = None # this will be the formatted AMRrules compliant mutation
         self.variation_type: Optional[str] = None  # type of AMR variant (Gene presence, protein variant, nucl variant etc)
         self.matched_rules: Optional[Any] = None  # will be filled with matched rules
+        self.hierarchy_depth: int = 0  # number of parent nodes walked up the hierarchy when matching rules
+        self.match_path: Optional[str] = None  # which check found the matching rules (nodeID, hierarchy, accession etc)
+        self.rules_scanned: int = 0  # number of rules looked at while looking for a match
 
         # option to process this row or just skip (eg virulence rows from AMRFP output)
         self.to_process: bool = False
@@ -213,7 +218,7 @@ class GenoResult:
             else:
                 return f"{self.gene_symbol}:{self.mutation}"
 
-    def _get_final_matches(self, matching_rules, guideline_pref = None):
+    def _get_final_matches(self, matching_rules, match_key, mutation_index=None, guideline_pref = None):
         #TODO MAKE THIS ITS OWN FUNCTION
         # we have multiple rules that match, and if there's a guideline preference
         # we need to pick one
@@ -229,20 +234,66 @@ class GenoResult:
             for rule in matching_rules:
                 if rule['mutation'] == self.mutation:
                     final_matching_rules.append(rule)
-            return final_matching_rules
-
-    def find_matching_rules(self, rules, amrfp_nodes, guideline_pref = None):
-
-        # select rules that match our variation type
-        rules_to_check = []
-        for rule in rules:
+            # exact matches take precedence, otherwise check for rules covering a range of positions
+            if final_matching_rules:
+                return final_matching_rules
+            return self._get_range_matches(matching_rules, match_key, mutation_index)
+        elif self.variation_type == 'Inactivating mutation detected':
+            # inactivating mutations can only be matched by range rules, eg p.(1_300)fs
+            return self._get_range_matches(matching_rules, match_key, mutation_index) or None
+
+    def _get_range_matches(self, matching_rules, match_key, mutation_index=None):
+        """
+        Return the rules that match the mutation by position range (eg p.(83_87)X), using the interval trees in
+        mutation_index if we have them, otherwise by checking each of the matching rules.
+        """
+        if mutation_index is not None:
+            # most genes have no range rules, so check that before parsing the mutation
+            if not mutation_index.has_rules(self.organism, self.variation_type, *match_key):
+                return []
+            variant = parse_variant(self.mutation)
+            return mutation_index.matches(self.organism, self.variation_type, *match_key, variant) if variant else []
+        variant = parse_variant(self.mutation)
+        if variant is None:
+            return []
+        range_matches = []
+        for rule in matching_rules:
+            range_rule = parse_range_rule(rule['mutation'])
+            if range_rule and range_rule.accepts(variant):
+                range_matches.append(rule)
+        return range_matches
+
+    def find_matching_rules(self, rules, amrfp_nodes, guideline_pref = None, mutation_index=None):
+        """
+        Find the rules for this genotype, from the organism's rules. The rules for the nodeID are checked first, then
+        each parent node up the hierarchy, then the nucleotide, protein and HMM accessions, and the first of these with
+        any rules is used. With mutation_index, the rules for each of these are looked up in it rather than scanned for,
+        so the organism's rules aren't needed (and can be None).
+        """
+        if mutation_index is None:
+            # select rules that match our variation type
+            rules_to_check = []
+            for rule in rules:
                 if rule['variation type'] == self.variation_type:
                     rules_to_check.append(rule)
+            # keep a cheap count of how much work each match takes, for the rule stats report
+            self.rules_scanned = len(rules)
+        else:
+            self.rules_scanned = 0
+
+        def candidates(field, value):
+            if mutation_index is not None:
+                found = mutation_index.candidates(self.organism, self.variation_type, field, value)
+                self.rules_scanned += len(found)
+                return found
+            self.rules_scanned += len(rules_to_check)
+            return [rule for rule in rules_to_check if rule.get(field) == value]
 
         # First we're going to check for the nodeID, and if we have one or matches, we we return that
-        matching_rules = [rule for rule in rules_to_check if rule.get('nodeID') == self.nodeID]
+        matching_rules = candidates('nodeID', self.nodeID)
         if len(matching_rules) > 0:
-            self.matched_rules = self._get_final_matches(matching_rules)
+            self.match_path = 'nodeID'
+            self.matched_rules = self._get_final_matches(matching_rules, ('nodeID', self.nodeID), mutation_index)
             return
 
         # Okay so nothing matched directly to the nodeID, or we would've returned out of the function. 
@@ -251,34 +302,39 @@ class GenoResult:
         # for that type of rule
         parent_node = amrfp_nodes.get(self.nodeID)
         while parent_node is not None and parent_node != 'AMR':
-            matching_rules = [rule for rule in rules_to_check if rule.get('nodeID') == parent_node]
+            self.hierarchy_depth += 1
+            matching_rules = candidates('nodeID', parent_node)
             if len(matching_rules) > 0:
-                self.matched_rules = self._get_final_matches(matching_rules)
+                self.match_path = 'hierarchy'
+                self.matched_rules = self._get_final_matches(matching_rules, ('nodeID', parent_node), mutation_index)
                 return
             parent_node = amrfp_nodes.get(parent_node)
 
         #Okay so using the nodeID didn't work, so now we need to check the sequence accession
         # start with the nucleotide accessions
-        matching_rules = [rule for rule in rules_to_check if rule.get('nucleotide accession') == self.closest_acc]
+        matching_rules = candidates('nucleotide accession', self.closest_acc)
         if len(matching_rules) > 0:
-            self.matched_rules = self._get_final_matches(matching_rules)
+            self.match_path = 'nucleotide accession'
+            self.matched_rules = self._get_final_matches(matching_rules, ('nucleotide accession', self.closest_acc), mutation_index)
             return
         # then check the protein accessions
-        matching_rules = [rule for rule in rules_to_check if rule.get('protein accession') == self.closest_acc]
+        matching_rules = candidates('protein accession', self.closest_acc)
         if len(matching_rules) > 0:
-            self.matched_rules = self._get_final_matches(matching_rules)
+            self.match_path = 'protein accession'
+            self.matched_rules = self._get_final_matches(matching_rules, ('protein accession', self.closest_acc), mutation_index)
             return
 
         #HMM accession check
-        matching_rules = [rule for rule in rules_to_check if rule.get('HMM accession') == self.hmm_acc]
+        matching_rules = candidates('HMM accession', self.hmm_acc)
         if len(matching_rules) > 0:
-            self.matched_rules = self._get_final_matches(matching_rules)
+            self.match_path = 'HMM accession'
+            self.matched_rules = self._get_final_matches(matching_rules, ('HMM accession', self.hmm_acc), mutation_index)
             return
 
         # if nothing matched, then we return and the value stays the default which is None
         return
     
-    def annotate_row(self, annot_opts: str):
+    def annotate_row(self, annot_opts: str, rules=None, fragments=None):
         """
         Annotate the base_row using the matched_rule(s) and store in annotated_row.
 
@@ -286,6 +342,10 @@ class GenoResult:
             annot_opts (str): Either 'minimal' or 'full'.
                 - 'minimal': Only minimal_columns are annotated.
                 - 'full': Both minimal_columns and full_columns are annotated.
+            rules (list): Optionally, annotate with only these of the matched rules (eg when filtering by drug).
+            fragments (AnnotationFragments): Optionally, the pre-rendered annotation columns of each rule for annot_opts,
+                in which case the rows for matched rules are InterpretedRows, reading through the input row and the
+                rule's annotation columns rather than copying them, and carrying their rendered annotation columns.
 
         Returns:
             List[Dict]: A list of dictionaries containing the annotated row(s).
@@ -314,11 +374,18 @@ class GenoResult:
 
         # One or more matching rules: create one annotated row per rule
         else:
-            if len(self.matched_rules) > 0:
+            if rules is not None:
+                rules_to_use = rules
+            elif len(self.matched_rules) > 0:
                 rules_to_use = self.matched_rules
             else:
                 rules_to_use = [self.matched_rule]
             for rule in rules_to_use:
+                if fragments is not None:
+                    # the input row and the rule's annotations are shared, not copied into each row
+                    annotated_rows.append(InterpretedRow(base_row, fragments.annotations(rule), self.organism,
+                                                         fragments.fragment(rule, self.organism)))
+                    continue
                 row = base_row.copy()
                 for col in cols:
                     row[col] = rule.get(col, '-')
@@ -330,6 +397,45 @@ class GenoResult:
         self.annotated_row = annotated_rows
         return annotated_rows
 
+def drug_from_rule(rule, card_drug_map, amrfp_class):
+    """Return the (drug, drug class) a genotype matched to this rule is summarised under."""
+    drug = rule.get('drug', '-')
+    if drug != '-':
+        # get the drug class from card
+        drug_class = card_drug_map.get(drug, '-')
+        # hardcode change for gentamicin
+        if drug == 'gentamicin':
+            drug_class = 'aminoglycoside antibiotic'
+    else:
+        drug_class = rule.get('drug class', '-')
+    
+    # if the drug and drug_class are '-', set to 'unassigned markers'
+    # but only if AMRFP hasn't found this to be efflux
+    if drug == '-' and drug_class == '-':
+        if amrfp_class == 'EFFLUX':
+            drug_class = 'antibiotic efflux'
+        else:
+            drug_class = 'unassigned markers'
+    
+    # hardcode change for penicillin
+    if drug_class == 'penicillin with extended spectrum':
+        drug_class = 'penicillin beta-lactam'
+    return drug, drug_class
+
+def drug_from_amrfp(amrfp_subclass, card_amrfp_conversion, variation_type, partial):
+    """Return the (drug, drug class) a genotype with no rule is summarised under, from its AMRFP subclass."""
+    drug = card_amrfp_conversion.get(amrfp_subclass).get('drug', '-')
+    drug_class = card_amrfp_conversion.get(amrfp_subclass).get('class', '-')
+    # if the drug_class is '-', set to 'unassigned markers'
+    if drug_class == '-':
+        drug_class = 'unassigned markers'
+    # if the marker is inactivated, and we have no assigned rule, set the class to 'partial'
+    # only do this for partial hits, not point_disrupts where we expect a phenotypic effect
+    if variation_type == "Inactivating mutation detected" and partial:
+        drug_class = 'partial'
+        drug = '-'
+    return drug, drug_class
+
 # we now need to take our genotype objects, and instead group them by drug (or class if no drug specified)
 # so each genotype object may have multiple drugs associated with it, regardless of whether it has a matched rule or not
 
@@ -342,118 +448,132 @@ class Genotype(GenoResult):
         self.drug_class: Optional[str] = None
     
     @classmethod
-    def from_result_row(cls, geno_result_obj, card_amrfp=None, card_map=None, rule=None, amrfp_subclass=None, no_rule_interp = None, duplicated=False):
+    def from_template(cls, geno_result_obj, template, rule=None, amrfp_subclass=None, duplicated=False):
         """
-        Create a Genotype instance from an existing GenoResult object,
-        copying all of its attributes.
+        Create a Genotype from an existing GenoResult object, copying all of its attributes, and the template for
+        its rule or AMRFP subclass (from GenotypeTemplates), which holds the drug, drug class and summary attributes.
         """
-        # Create an empty Genotype object without re-parsing anything
-        # by bypassing GenoResult.__init__
         new_obj = cls.__new__(cls)
-
-        # Copy all data from the GenoResult instance
-        new_obj.__dict__ = dict(geno_result_obj.__dict__)
-
-        # asign the new attributes
-        new_obj.rule = rule
-        new_obj.amrfp_subclass = amrfp_subclass
-        new_obj.has_rule = False
-        # save whether this genotype is duplicated or not
-        new_obj.duplicated_row = duplicated
-
-        # Assign drugs if the rule is provided
-        # also assign the important values from the rule that are relevant for our summary functions
-        if new_obj.rule:
-            new_obj._assign_drug_from_rule(card_map)
-            new_obj.has_rule = True
-            new_obj._assign_rule_attributes(rule)
-        elif new_obj.amrfp_subclass:
-            new_obj._assign_drug_from_amrfp(card_amrfp)
-            new_obj._assign_norule_attributes(no_rule_interp)
-
+        attrs = geno_result_obj.__dict__.copy()
+        attrs['rule'] = rule
+        attrs['amrfp_subclass'] = amrfp_subclass
+        attrs['has_rule'] = False
+        attrs['duplicated_row'] = duplicated
+        attrs.update(template.attrs)
+        new_obj.__dict__ = attrs
         return new_obj
 
-    def _assign_drug_from_rule(self, card_drug_map):
-        self.drug = self.rule.get('drug', '-')
-        if self.drug != '-':
-            # get the drug class from card
-            self.drug_class = card_drug_map.get(self.drug, '-')
-            # hardcode change for gentamicin
-            if self.drug == 'gentamicin':
-                self.drug_class = 'aminoglycoside antibiotic'
-        else:
-            self.drug_class = self.rule.get('drug class', '-')
-        
-        # if the drug and drug_class are '-', set to 'unassigned markers'
-        # but only if AMRFP hasn't found this to be efflux
-        if self.drug == '-' and self.drug_class == '-':
-            if self.amrfp_class == 'EFFLUX':
-                self.drug_class = 'antibiotic efflux'
-            else:
-                self.drug_class = 'unassigned markers'
-        
-        # hardcode change for penicillin
-        if self.drug_class == 'penicillin with extended spectrum':
-            self.drug_class = 'penicillin beta-lactam'
-    
-    def _assign_drug_from_amrfp(self, card_amrfp_conversion):
-        self.drug = card_amrfp_conversion.get(self.amrfp_subclass).get('drug', '-')
-        self.drug_class = card_amrfp_conversion.get(self.amrfp_subclass).get('class', '-')
-        # if the drug_class is '-', set to 'unassigned markers'
-        if self.drug_class == '-':
-            self.drug_class = 'unassigned markers'
-        # if the marker is inactivated, and we have no assigned rule, set the class to 'partial'
-        # only do this for partial hits, not point_disrupts where we expect a phenotypic effect
-        if self.variation_type == "Inactivating mutation detected" and self.partial:
-            self.drug_class = 'partial'
-            self.drug = '-'
-    
-    def _assign_rule_attributes(self, rule):
-        # assign other important attributes from the rule for summary purposes
-        self.gene_context = rule.get('gene context')
-        self.phenotype = rule.get('phenotype')
-        self.clinical_category = rule.get('clinical category')
-        self.evidence_grade = rule.get('evidence grade')
-        self.ruleID = rule.get('ruleID')
-    
-    def _assign_norule_attributes(self, no_rule_interpretation):
-        # assign default values when no rule is matched
-        # note that our interpretation depends on user choice
-        # AND also if the variation type is "Inactivating mutation detected" but we've got no rule
-
-        # only set phenotype to nonwildtype if the user has selected one of the nwt options, otherwise it's '-'
-        if no_rule_interpretation in ['nwtR', 'nwtS', 'nwt']:
-            self.phenotype = 'nonwildtype'
-        else:
-            self.phenotype = '-'
-        
-        # set clinical category to no interpretation if none or nwt, and evidence grade to '-'
-        if no_rule_interpretation in ['none', 'nwt']:
-            self.clinical_category = '-'
-            self.evidence_grade = '-'
-        # evidence grade is very low if we are giving a clinical category
-        elif no_rule_interpretation == 'nwtS':
-            self.clinical_category = 'S'
-            self.evidence_grade = 'none'
-        elif no_rule_interpretation == 'nwtR':
-            self.clinical_category = 'R'
-            self.evidence_grade = 'none'
-        
-        # However, if the variation type is inactivating, and we've got no rule
-        # then we treat it as though the gene isn't functional
-        if self.variation_type == "Inactivating mutation detected":
-            # the ONLY exception to this is if it's a POINT_DISRUPT, in which case the default interpretation should be R
-            # (if nwtR), as these are interruptions in core genes that are likely to cause resistance
-            if self.subtype == "POINT_DISRUPT" and no_rule_interpretation == 'nwtR':
-                self.clinical_category = 'R'
-        # otherwise the gene is considered functional, so we use what the user has selected
-        
-        # regardless of user choice, there is no ruleID to set
-        self.ruleID = None
-
-        # if the drug class is 'antibiotic efflux', 'unassigned markers', or 'partial', and we have no rule (which is why we're in this function)
-        # then we need to update phenotype, category and grade to be '-', as these are not being interpreted
-        if self.drug_class in ['antibiotic efflux', 'unassigned markers', 'partial']:
-            self.phenotype = '-'
-            self.clinical_category = '-'
-            self.evidence_grade = '-'
\ No newline at end of file
+
+def norule_attributes(no_rule_interpretation, variation_type, subtype, drug_class):
+    """Return the summary attributes (phenotype, category, grade, ruleID) of a genotype with no matched rule."""
+    attrs = {}
+    # assign default values when no rule is matched
+    # note that our interpretation depends on user choice
+    # AND also if the variation type is "Inactivating mutation detected" but we've got no rule
+
+    # only set phenotype to nonwildtype if the user has selected one of the nwt options, otherwise it's '-'
+    if no_rule_interpretation in ['nwtR', 'nwtS', 'nwt']:
+        attrs['phenotype'] = 'nonwildtype'
+    else:
+        attrs['phenotype'] = '-'
+
+    # set clinical category to no interpretation if none or nwt, and evidence grade to '-'
+    if no_rule_interpretation in ['none', 'nwt']:
+        attrs['clinical_category'] = '-'
+        attrs['evidence_grade'] = '-'
+    # evidence grade is very low if we are giving a clinical category
+    elif no_rule_interpretation == 'nwtS':
+        attrs['clinical_category'] = 'S'
+        attrs['evidence_grade'] = 'none'
+    elif no_rule_interpretation == 'nwtR':
+        attrs['clinical_category'] = 'R'
+        attrs['evidence_grade'] = 'none'
+
+    # However, if the variation type is inactivating, and we've got no rule
+    # then we treat it as though the gene isn't functional
+    if variation_type == "Inactivating mutation detected":
+        # the ONLY exception to this is if it's a POINT_DISRUPT, in which case the default interpretation should be R
+        # (if nwtR), as these are interruptions in core genes that are likely to cause resistance
+        if subtype == "POINT_DISRUPT" and no_rule_interpretation == 'nwtR':
+            attrs['clinical_category'] = 'R'
+    # otherwise the gene is considered functional, so we use what the user has selected
+
+    # regardless of user choice, there is no ruleID to set
+    attrs['ruleID'] = None
+
+    # if the drug class is 'antibiotic efflux', 'unassigned markers', or 'partial', and we have no rule (which is why we're in this function)
+    # then we need to update phenotype, category and grade to be '-', as these are not being interpreted
+    if drug_class in ['antibiotic efflux', 'unassigned markers', 'partial']:
+        attrs['phenotype'] = '-'
+        attrs['clinical_category'] = '-'
+        attrs['evidence_grade'] = '-'
+    return attrs
+
+
+class GenotypeTemplate(NamedTuple):
+    """The attributes of a genotype that are fixed by its rule (or AMRFP subclass), worked out once rather than per hit."""
+    drug: Optional[str]
+    drug_class: Optional[str]
+    attrs: tuple # (attribute, value) pairs to set on the Genotype, including the drug and drug class
+
+
+# a genotype with an empty subclass gets no drug or interpretation at all
+NO_TEMPLATE = GenotypeTemplate(None, None, ())
+INACTIVATING = "Inactivating mutation detected"
+
+
+class GenotypeTemplates:
+    """
+    Read-only records of the attributes a Genotype gets from its matched rule (drug, drug class and the rule's
+    interpretation), or from its AMRFP subclass when it has no rule (drug, drug class and the --no-rule-interpretation
+    defaults). These only depend on the rule, or on the subclass, variation type, subtype and whether the hit is
+    partial, so each is worked out once: for the loaded rules and every known subclass at startup (prepare), and
+    for anything else the first time it's seen.
+    """
+
+    def __init__(self, card_drug_map, card_amrfp_conversion, no_rule_interpretation):
+        self.card_drug_map = card_drug_map
+        self.card_amrfp_conversion = card_amrfp_conversion
+        self.no_rule_interpretation = no_rule_interpretation
+        self._rule_templates = {} # key: (id(rule), efflux), value: (rule, template), keeping the rule so its id isn't reused
+        self._subclass_templates = {} # key: (subclass, inactivating, point disrupt, partial), value: template
+
+    def prepare(self, *rulesets):
+        """Work out the templates for every rule in rulesets and every subclass in the CARD conversion."""
+        for rules in rulesets:
+            for rule in rules:
+                for amrfp_class in (None, 'EFFLUX'):
+                    self.rule_template(rule, amrfp_class)
+        for subclass, conversion in self.card_amrfp_conversion.items():
+            if conversion is None:
+                continue
+            for variation_type in (None, INACTIVATING):
+                for subtype in (None, 'POINT_DISRUPT'):
+                    for partial in (False, True):
+                        self.subclass_template(subclass, variation_type, subtype, partial)
+        return self
+
+    def rule_template(self, rule, amrfp_class):
+        # the AMRFP class only matters for rules with no drug or drug class
+        key = (id(rule), amrfp_class == 'EFFLUX')
+        entry = self._rule_templates.get(key)
+        if entry is None:
+            drug, drug_class = drug_from_rule(rule, self.card_drug_map, amrfp_class)
+            attrs = {'drug': drug, 'drug_class': drug_class, 'has_rule': True,
+                     'gene_context': rule.get('gene context'), 'phenotype': rule.get('phenotype'),
+                     'clinical_category': rule.get('clinical category'), 'evidence_grade': rule.get('evidence grade'),
+                     'ruleID': rule.get('ruleID')}
+            entry = self._rule_templates[key] = (rule, GenotypeTemplate(drug, drug_class, tuple(attrs.items())))
+        return entry[1]
+
+    def subclass_template(self, subclass, variation_type, subtype, partial):
+        if not subclass:
+            return NO_TEMPLATE
+        key = (subclass, variation_type == INACTIVATING, subtype == 'POINT_DISRUPT', bool(partial))
+        template = self._subclass_templates.get(key)
+        if template is None:
+            drug, drug_class = drug_from_amrfp(subclass, self.card_amrfp_conversion, variation_type, partial)
+            attrs = {'drug': drug, 'drug_class': drug_class,
+                     **norule_attributes(self.no_rule_interpretation, variation_type, subtype, drug_class)}
+            template = self._subclass_templates[key] = GenotypeTemplate(drug, drug_class, tuple(attrs.items()))
+        return template
@@ -0,0 +1,196 @@
+"""
+Writing the interpreted report. Each rule's annotation columns (for --annot-opts minimal or full) are rendered into
+a TSV fragment once, and each interpreted row carries its fragment, so a row is written by joining its input columns
+(rendered once per hit, however many rules it matched) with the fragment, rather than re-serialising the same rule
+text (curation notes, PMIDs, breakpoints) for every row.
+
+With --interpreted-layout compact, the rows of a hit that matched several rules are written as one row, with the
+annotation columns that differ between the rules joined with ';' in rule order.
+"""
+
+import csv
+import io
+from collections.abc import Mapping
+
+from amrrules import __version__
+from amrrules.utils import minimal_columns, full_columns, required_cols
+
+
+def annotation_columns(annot_opts):
+    """The annotation columns added to each input row for --annot-opts."""
+    return minimal_columns if annot_opts == 'minimal' else minimal_columns + full_columns
+
+
+class InterpretedRow(Mapping):
+    """
+    An interpreted report row, read as a dict of the input row of the hit it was made from (base, shared by all the
+    rows of the hit) updated with a rule's annotation columns (annotations, shared by every row for the rule) and the
+    hit's organism, without copying either into a new dict. Also carries the annotation columns already rendered as
+    TSV (fragment). Rows are read-only, as every row of the hit shares base.
+    """
+    __slots__ = ('base', 'annotations', 'organism', 'fragment')
+
+    def __init__(self, base, annotations, organism, fragment):
+        self.base = base
+        self.annotations = annotations
+        self.organism = organism
+        self.fragment = fragment
+
+    def __getitem__(self, key):
+        if key == 'organism':
+            return self.organism
+        if key in self.annotations:
+            return self.annotations[key]
+        return self.base[key]
+
+    def get(self, key, default=None):
+        if key == 'organism':
+            return self.organism
+        if key in self.annotations:
+            return self.annotations[key]
+        return self.base.get(key, default)
+
+    def __contains__(self, key):
+        return key == 'organism' or key in self.annotations or key in self.base
+
+    def __iter__(self):
+        # in the order of a copy of base updated with the annotations and then the organism
+        yield from self.base
+        for key in self.annotations:
+            if key not in self.base:
+                yield key
+        if 'organism' not in self.base and 'organism' not in self.annotations:
+            yield 'organism'
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class TsvRenderer:
+    """Renders a list of values as a line of the report (without the line ending), quoted as csv.DictWriter would."""
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter='\t')
+
+    def render(self, values):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.writerow(values)
+        return self.buffer.getvalue()[:-len(self.writer.dialect.lineterminator)]
+
+
+class AnnotationFragments:
+    """
+    The annotation columns of each rule for one --annot-opts mode, as the values set on each row and as a rendered
+    fragment per organism (the organism column is the hit's, not the rule's). Worked out for the loaded rules at
+    startup (prepare), and for anything else the first time it's seen.
+    """
+
+    def __init__(self, annot_opts):
+        self.columns = annotation_columns(annot_opts)
+        self._renderer = TsvRenderer()
+        self._annotations = {} # key: id(rule), value: (rule, annotations), keeping the rule so its id isn't reused
+        self._fragments = {} # key: (id(rule), organism), value: fragment
+
+    def prepare(self, *rulesets):
+        for rules in rulesets:
+            for rule in rules:
+                self.annotations(rule)
+        return self
+
+    def annotations(self, rule):
+        """The annotation column values a row gets from this rule (the organism is then set from the hit)."""
+        entry = self._annotations.get(id(rule))
+        if entry is None:
+            annotations = {col: rule.get(col, '-') for col in self.columns}
+            annotations['version'] = __version__
+            entry = self._annotations[id(rule)] = (rule, annotations)
+        return entry[1]
+
+    def fragment(self, rule, organism):
+        key = (id(rule), organism)
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            annotations = self.annotations(rule)
+            fragment = self._fragments[key] = self._renderer.render(
+                [organism if col == 'organism' else annotations[col] for col in self.columns])
+        return fragment
+
+
+def _aggregate(group, columns):
+    if len(group) == 1:
+        return group[0]
+    row = dict(group[0])
+    for col in columns:
+        values = [r.get(col) for r in group]
+        if any(value != values[0] for value in values):
+            row[col] = ';'.join('' if value is None else str(value) for value in values)
+    return row
+
+
+def compact_rows(rows, columns):
+    """
+    Aggregate the consecutive rows of each hit (the rows made from the same input row) into one row, with any
+    of the given columns that differ between them joined with ';'.
+    """
+    group = []
+    for row in rows:
+        base = getattr(row, 'base', None)
+        if group and base is not None and base is getattr(group[0], 'base', None):
+            group.append(row)
+            continue
+        if group:
+            yield _aggregate(group, columns)
+        group = [row]
+    if group:
+        yield _aggregate(group, columns)
+
+
+def layout_rows(args, rows):
+    """The interpreted rows as they're laid out in the report for --interpreted-layout."""
+    if getattr(args, 'interpreted_layout', 'expanded') == 'compact':
+        return compact_rows(rows, annotation_columns(args.annot_opts))
+    return rows
+
+
+class InterpretedWriter:
+    """
+    Writes interpreted rows to a report with the given columns: rows with a rendered fragment as their input
+    columns (base_columns) joined with the fragment, anything else (eg hits with no rule, which are the input row
+    itself rather than a copy of it) with csv.DictWriter.
+    """
+
+    def __init__(self, f, fieldnames, base_columns):
+        self.f = f
+        self.dict_writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter='\t')
+        self.base_columns = base_columns
+        self.line_ending = self.dict_writer.writer.dialect.lineterminator
+        # fragments only line up with the columns if each column is there once, ie the input has no annotation columns of its own
+        self.use_fragments = len(set(fieldnames)) == len(fieldnames)
+        self._renderer = TsvRenderer()
+        self._last_base = None
+        self._base_line = None
+
+    def writeheader(self):
+        self.dict_writer.writeheader()
+
+    def writerow(self, row):
+        fragment = getattr(row, 'fragment', None)
+        # rows with values beyond the input's columns (None key) are left to DictWriter, which raises for them
+        if fragment is None or not self.use_fragments or None in row:
+            self.dict_writer.writerow(row)
+            return
+        if row.base is not self._last_base:
+            self._last_base = row.base
+            self._base_line = self._renderer.render([row.base.get(col) for col in self.base_columns])
+        self.f.write(self._base_line + '\t' + fragment + self.line_ending)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+def interpreted_base_columns(base_fieldnames):
+    """The columns of the interpreted report that come from the input row (and the parsed marker), not the rule."""
+    return base_fieldnames + required_cols
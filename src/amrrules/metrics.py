@@ -0,0 +1,241 @@
+"""Per-stage timing and throughput metrics for a single AMRrules run."""
+
+import json
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from amrrules import __version__
+
+try:
+    import resource
+except ImportError:  # resource is not available on Windows
+    resource = None
+
+# shared no-op context, so timing a stage costs almost nothing when metrics are disabled
+_NULL_STAGE = nullcontext()
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process in MB, or None if it can't be determined.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS, but in kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return round(peak / (1024 * 1024), 2)
+    return round(peak / 1024, 2)
+
+
+class RunMetrics:
+    """
+    Collects wall time and CPU time for each stage of a run, along with
+    row/sample counts and cache hit rates, and writes them out as a JSON run report.
+
+    A stage can be entered many times (eg once per input row), in which case the
+    times are summed and the number of calls is recorded. Each stage also records
+    process_peak_rss_mb_after, the peak RSS of the whole process as of the end of
+    the stage. This is cumulative (a stage after the largest one reports the same
+    value), so it shows where the peak was reached rather than what each stage used.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {} # key: stage name, value: dict of accumulated timings
+        self.counts = {} # key: count name, value: int
+        self.unrated_counts = set() # counts that aren't a throughput (eg per-sample tallies), so get no _per_sec rate
+        self.caches = {} # key: cache name, value: dict of hits and misses
+        self.options = {}
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def stage(self, name):
+        """Return a context manager that times the enclosed block under the given stage name."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'wall_s': 0.0, 'cpu_s': 0.0, 'calls': 0, 'process_peak_rss_mb_after': None}
+            stage['wall_s'] += time.perf_counter() - wall_start
+            stage['cpu_s'] += time.process_time() - cpu_start
+            stage['calls'] += 1
+            # the peak is over the whole process so far (and stages at startup overlap), not the stage's own peak
+            stage['process_peak_rss_mb_after'] = peak_rss_mb()
+
+    def add_count(self, name, n=1, rate=True):
+        """Increase a named counter (eg rows, samples) by n. With rate=False, no throughput is reported for it."""
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+            if not rate:
+                self.unrated_counts.add(name)
+
+    def add_cache_stats(self, name, hits, misses):
+        """Record the number of hits and misses for a named cache."""
+        if self.enabled:
+            cache = self.caches.setdefault(name, {'hits': 0, 'misses': 0})
+            cache['hits'] += hits
+            cache['misses'] += misses
+
+    def as_dict(self):
+        """Return the run report as a dictionary, ready to be serialised to JSON."""
+        wall = time.perf_counter() - self._wall_start
+        cpu = time.process_time() - self._cpu_start
+
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = {
+                'wall_s': round(stage['wall_s'], 6),
+                'cpu_s': round(stage['cpu_s'], 6),
+                'calls': stage['calls'],
+                'process_peak_rss_mb_after': stage['process_peak_rss_mb_after'],
+            }
+
+        # throughput is calculated over the whole run, so it reflects what a user actually waits for
+        throughput = {}
+        for name, n in self.counts.items():
+            if name in self.unrated_counts:
+                continue
+            throughput[f"{name}_per_sec"] = round(n / wall, 2) if wall > 0 else None
+
+        caches = {}
+        for name, cache in self.caches.items():
+            lookups = cache['hits'] + cache['misses']
+            caches[name] = {
+                'hits': cache['hits'],
+                'misses': cache['misses'],
+                'hit_rate': round(cache['hits'] / lookups, 4) if lookups else None,
+            }
+
+        return {
+            'amrrules_version': __version__,
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'options': self.options,
+            'total': {'wall_s': round(wall, 6), 'cpu_s': round(cpu, 6), 'peak_rss_mb': peak_rss_mb()},
+            'stages': stages,
+            'counts': dict(self.counts),
+            'throughput': throughput,
+            'caches': caches,
+        }
+
+    def write_json(self, path):
+        """Write the run report to the given path."""
+        with open(path, 'w') as out:
+            json.dump(self.as_dict(), out, indent=2)
+            out.write('\n')
+        return path
+
+
+# ruleID of the run-level row of the rule stats report, with the combination rule evaluations for the whole run
+ALL_COMBINATION_RULES = 'all combination rules'
+
+
+class RuleStats:
+    """
+    Cheap aggregate counters describing which rules are hit across a cohort, and how
+    much work it took to find them. Keyed by (ruleID, match path).
+    """
+
+    def __init__(self):
+        # key: (ruleID, match path), value: [hits, evaluations, total hierarchy depth, total rules scanned]
+        self.counters = {}
+        self.samples = 0
+        self.combination_evaluations = 0
+
+    def _counter(self, rule_id, match_path):
+        key = (rule_id, match_path)
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = [0, 0, 0, 0]
+        return counter
+
+    def record_match(self, geno_result):
+        """Record the outcome of find_matching_rules for a single GenoResult row."""
+        match_path = geno_result.match_path or 'none'
+        rules = geno_result.matched_rules or [{'ruleID': '-'}]
+        for rule in rules:
+            counter = self._counter(rule.get('ruleID', '-'), match_path)
+            counter[0] += 1 if geno_result.matched_rules else 0
+            counter[1] += 1
+            counter[2] += geno_result.hierarchy_depth
+            counter[3] += geno_result.rules_scanned
+
+    def record_combinations(self, combo_rules, matched_rule_ids):
+        """Record the evaluation of a set of combination rules, and which of them matched."""
+        self.combination_evaluations += len(combo_rules)
+        for rule in combo_rules:
+            counter = self._counter(rule.get('ruleID', '-'), 'combination')
+            counter[1] += 1
+            if rule.get('ruleID') in matched_rule_ids:
+                counter[0] += 1
+
+    def merge(self, other):
+        """Add the counters from another RuleStats (eg from an earlier batch of the same run) into this one."""
+        for key, values in other.counters.items():
+            counter = self._counter(*key)
+            for i, value in enumerate(values):
+                counter[i] += value
+        self.samples += other.samples
+        self.combination_evaluations += other.combination_evaluations
+
+    def as_dict(self):
+        """Return the counters as a JSON-serialisable dictionary, which can be read back with from_dict."""
+        return {
+            'counters': [[rule_id, match_path] + values for (rule_id, match_path), values in self.counters.items()],
+            'samples': self.samples,
+            'combination_evaluations': self.combination_evaluations,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        rule_stats = cls()
+        for rule_id, match_path, *values in data['counters']:
+            rule_stats.counters[(rule_id, match_path)] = values
+        rule_stats.samples = data['samples']
+        rule_stats.combination_evaluations = data['combination_evaluations']
+        return rule_stats
+
+    def evaluations_per_sample(self, evaluations):
+        return round(evaluations / self.samples, 3) if self.samples else '-'
+
+    def rows(self):
+        """
+        Return the counters as a list of report rows, sorted by hits (highest first) then ruleID, followed by a
+        run-level row (ruleID ALL_COMBINATION_RULES) totalling the combination rule evaluations.
+        """
+        rows = []
+        combination_hits = 0
+        for (rule_id, match_path), (hits, evaluations, depth, scanned) in self.counters.items():
+            is_match = match_path != 'combination'
+            if not is_match:
+                combination_hits += hits
+            rows.append({
+                'ruleID': rule_id,
+                'match path': match_path,
+                'hits': hits,
+                'evaluations': evaluations,
+                'evaluations per sample': self.evaluations_per_sample(evaluations),
+                'mean hierarchy depth': round(depth / evaluations, 3) if is_match and evaluations else '-',
+                'mean rules scanned': round(scanned / evaluations, 1) if is_match and evaluations else '-',
+            })
+        rows.sort(key=lambda r: (-r['hits'], r['ruleID'], r['match path']))
+        rows.append({
+            'ruleID': ALL_COMBINATION_RULES,
+            'match path': 'combination',
+            'hits': combination_hits,
+            'evaluations': self.combination_evaluations,
+            'evaluations per sample': self.evaluations_per_sample(self.combination_evaluations),
+            'mean hierarchy depth': '-',
+            'mean rules scanned': '-',
+        })
+        return rows
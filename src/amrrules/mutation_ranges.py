@@ -0,0 +1,233 @@
+"""
+Rules for any variant in a range of positions, rather than one exact mutation. These use the unknown range syntax
+from the specification, eg p.(83_87)X for any substitution in codons 83-87, or p.(1_300)fs for any frameshift in
+the first 300 codons. Range rules are indexed per gene in interval trees when the rules are loaded, so matching a
+variant against them doesn't get slower as the number of rules for a gene grows. The same index also holds every
+rule by the gene it is for, so the candidate rules for a genotype are looked up rather than scanned for.
+"""
+
+import re
+from collections import defaultdict
+from functools import lru_cache
+
+# variant classes, and the mutation suffixes used for them in range rules
+# (a range with no suffix, eg p.(1_100), matches any kind of variant in the range)
+ANY = 'any'
+SUBSTITUTION = 'sub'
+DELETION = 'del'
+INSERTION = 'ins'
+FRAMESHIFT = 'fs'
+NONSENSE = 'Ter'
+
+# the rule fields used to find the candidate rules for a genotype (see GenoResult.find_matching_rules)
+MATCH_FIELDS = ('nodeID', 'nucleotide accession', 'protein accession', 'HMM accession')
+
+_AA = r'[A-Z][a-z]{2}'
+RANGE_RULE = re.compile(r'^([pc])\.\((-?\d+)(?:_(-?\d+))?\)(.*)$')
+
+# AMRrules mutations as produced by GenoResult._parse_mutation
+PROTEIN_VARIANTS = [
+    (re.compile(rf'^p\.{_AA}(\d+)()Ter$'), NONSENSE),
+    (re.compile(rf'^p\.{_AA}(\d+)(){_AA}fs(?:Ter\d+)?$'), FRAMESHIFT),
+    (re.compile(rf'^p\.{_AA}(\d+)()({_AA})$'), SUBSTITUTION),
+    (re.compile(r'^p\.(\d+)_(\d+)ins([A-Za-z]+)$'), INSERTION),
+    (re.compile(rf'^p\.{_AA}(\d+)(?:_{_AA}(\d+))?del$'), DELETION),
+]
+NUCLEOTIDE_VARIANTS = [
+    (re.compile(r'^c\.(-?\d+)()([A-Za-z]+>[A-Za-z]+)$'), SUBSTITUTION),
+    (re.compile(r'^c\.(-?\d+)_(-?\d+)ins([A-Za-z]+)$'), INSERTION),
+    (re.compile(r'^c\.(-?\d+)([A-Za-z]+)del$'), DELETION),
+]
+
+
+class Variant:
+    """The position(s) and class of a detected mutation, eg p.Ser83Leu is a protein substitution at 83, to Leu."""
+
+    def __init__(self, kind, start, end, variant_class, detail=''):
+        self.kind = kind # p (protein) or c (coding sequence)
+        self.start = start
+        self.end = end
+        self.variant_class = variant_class
+        self.detail = detail # the new residue(s) for a substitution, or the inserted sequence
+
+
+class RangeRule:
+    """A parsed range rule mutation, eg p.(83_87)X."""
+
+    def __init__(self, kind, start, end, variant_class, detail=''):
+        self.kind = kind
+        self.start = min(start, end)
+        self.end = max(start, end)
+        self.variant_class = variant_class
+        self.detail = detail # optional: the substitution or inserted sequence the variant must have
+
+    def accepts(self, variant):
+        """Whether the variant is of the right kind and class, and overlaps the range."""
+        if variant.kind != self.kind or variant.end < self.start or variant.start > self.end:
+            return False
+        if self.variant_class == ANY:
+            return True
+        if self.variant_class != variant.variant_class:
+            return False
+        if not self.detail:
+            return True
+        if self.variant_class == SUBSTITUTION and self.kind == 'c':
+            # eg N>T, any base to T
+            rule_ref, rule_alt = self.detail.split('>')
+            ref, alt = variant.detail.split('>')
+            return rule_ref in ('N', ref) and rule_alt in ('N', alt)
+        return self.detail == variant.detail
+
+
+@lru_cache(maxsize=None)
+def parse_range_rule(mutation):
+    """Parse a range rule mutation (eg p.(83_87)X), or return None if it isn't one."""
+    if not mutation:
+        return None
+    m = RANGE_RULE.match(mutation)
+    if not m:
+        return None
+    kind, start, end, suffix = m.groups()
+    start = int(start)
+    end = int(end) if end is not None else start
+    if suffix == '':
+        return RangeRule(kind, start, end, ANY)
+    if suffix == 'del':
+        return RangeRule(kind, start, end, DELETION)
+    if suffix.startswith('ins'):
+        return RangeRule(kind, start, end, INSERTION, suffix[3:])
+    if kind == 'p':
+        if suffix in ('fs', 'fsTer'):
+            return RangeRule(kind, start, end, FRAMESHIFT)
+        if suffix == 'Ter':
+            return RangeRule(kind, start, end, NONSENSE)
+        if suffix in ('X', 'Xaa'):
+            return RangeRule(kind, start, end, SUBSTITUTION)
+        if re.fullmatch(_AA, suffix):
+            return RangeRule(kind, start, end, SUBSTITUTION, suffix)
+    elif re.fullmatch(r'[ACGTN]>[ACGTN]', suffix):
+        return RangeRule(kind, start, end, SUBSTITUTION, suffix)
+    return None
+
+
+def parse_variant(mutation):
+    """Parse the AMRrules mutation of a genotype into a Variant, or return None if it can't be placed."""
+    if not mutation or mutation == '-':
+        return None
+    patterns = PROTEIN_VARIANTS if mutation.startswith('p.') else NUCLEOTIDE_VARIANTS
+    for pattern, variant_class in patterns:
+        m = pattern.match(mutation)
+        if m:
+            groups = m.groups()
+            start = int(groups[0])
+            if variant_class == DELETION and mutation.startswith('c.'):
+                # c.-53Adel, the deleted bases start at the position
+                end = start + len(groups[1]) - 1
+                detail = ''
+            else:
+                end = int(groups[1]) if groups[1] else start
+                detail = groups[2] if len(groups) > 2 and groups[2] else ''
+            return Variant(mutation[0], start, end, variant_class, detail)
+    return None
+
+
+class IntervalTree:
+    """
+    A static centred interval tree over closed intervals (start, end, value), returning the values whose
+    intervals overlap a query range in O(log n + hits).
+    """
+
+    def __init__(self, intervals):
+        self.center = None
+        self.by_start = [] # intervals containing the centre, sorted by start
+        self.by_end = [] # the same intervals, sorted by end (descending)
+        self.left = self.right = None
+        if not intervals:
+            return
+        points = sorted(p for start, end, _ in intervals for p in (start, end))
+        self.center = points[len(points) // 2]
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                left.append(interval)
+            elif interval[0] > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        self.by_start = sorted(here, key=lambda i: i[0])
+        self.by_end = sorted(here, key=lambda i: i[1], reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def overlapping(self, start, end):
+        """Values of all intervals overlapping [start, end]."""
+        found = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.center is None:
+                continue
+            if end < node.center:
+                # everything here ends at or after the centre, so overlaps if it starts by the end of the query
+                for s, _, value in node.by_start:
+                    if s > end:
+                        break
+                    found.append(value)
+                if node.left:
+                    stack.append(node.left)
+            elif start > node.center:
+                for _, e, value in node.by_end:
+                    if e < start:
+                        break
+                    found.append(value)
+                if node.right:
+                    stack.append(node.right)
+            else:
+                found.extend(value for _, _, value in node.by_start)
+                if node.left:
+                    stack.append(node.left)
+                if node.right:
+                    stack.append(node.right)
+        return found
+
+
+class MutationRuleIndex:
+    """
+    The rules for each organism, variation type and gene (ie each value of the nodeID and accession fields that
+    rules are matched on), in the order they are in the rules files, and interval trees of the range rules for
+    each of these, built once when the rules are loaded.
+    """
+
+    def __init__(self, rules):
+        self.rules = defaultdict(list)
+        grouped = defaultdict(list)
+        for order, rule in enumerate(rules):
+            for field in MATCH_FIELDS:
+                self.rules[(rule.get('organism'), rule.get('variation type'), field, rule.get(field))].append(rule)
+            range_rule = parse_range_rule(rule.get('mutation'))
+            if range_rule is None:
+                continue
+            for field in MATCH_FIELDS:
+                value = rule.get(field)
+                if value and value != '-':
+                    key = (rule.get('organism'), rule.get('variation type'), field, value)
+                    grouped[key].append((range_rule.start, range_rule.end, (order, rule, range_rule)))
+        self.trees = {key: IntervalTree(intervals) for key, intervals in grouped.items()}
+
+    def __len__(self):
+        return len(self.trees)
+
+    def candidates(self, organism, variation_type, field, value):
+        """The rules with this value for field (eg the nodeID of a genotype), for the organism and variation type."""
+        return list(self.rules.get((organism, variation_type, field, value), ()))
+
+    def has_rules(self, organism, variation_type, field, value):
+        return (organism, variation_type, field, value) in self.trees
+
+    def matches(self, organism, variation_type, field, value, variant):
+        """The range rules for this gene that accept the variant, in the order they are in the rules file."""
+        tree = self.trees.get((organism, variation_type, field, value))
+        if tree is None:
+            return []
+        hits = sorted(tree.overlapping(variant.start, variant.end), key=lambda hit: hit[0])
+        return [rule for _, rule, range_rule in hits if range_rule.accepts(variant)]
@@ -0,0 +1,65 @@
+"""
+Streaming results as newline-delimited JSON (--ndjson): each sample's interpreted rows and genome summary entries
+are written as JSON lines as soon as the sample has been interpreted, and the stream is flushed at the end of each
+sample, so downstream consumers can tail it while a long run is still going.
+
+Each line is a JSON object with a "record" field:
+    interpreted: one row of the interpreted report, with the same columns, under "fields"
+    summary: one row of the genome summary report, with the same columns, under "fields"
+    sample_end: the sample is finished, with the number of interpreted and summary lines written for it
+"""
+
+import json
+import sys
+
+from amrrules.output import interpreted_columns, summary_rows
+
+
+_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def _interpreted_fields(row, columns):
+    # the row as it's written to the interpreted report, ie with any missing values (eg from short input rows) empty
+    fields = {col: row.get(col, '') for col in columns}
+    if None in fields.values():
+        fields = {col: '' if value is None else value for col, value in fields.items()}
+    return fields
+
+
+class NdjsonWriter:
+
+    def __init__(self, stream, args, base_fieldnames, close_stream=True):
+        self.stream = stream
+        self.args = args
+        self.interpreted_fields = interpreted_columns(args, base_fieldnames)
+        self.close_stream = close_stream
+        self.samples = 0
+
+    @classmethod
+    def open(cls, path, args, base_fieldnames, stdout=None):
+        """Open the NDJSON output: a file, or standard output (or the stream given as stdout) if path is '-'."""
+        if path == '-':
+            return cls(stdout or sys.stdout, args, base_fieldnames, close_stream=False)
+        return cls(open(path, 'w'), args, base_fieldnames)
+
+    def write_sample(self, sample, result):
+        """Write one sample's interpreted rows and summary entries (from process_rows), then flush."""
+        lines = [_encode({'record': 'interpreted', 'sample': sample, 'fields': _interpreted_fields(row, self.interpreted_fields)})
+                 for row in result['output_rows']]
+        n_summary = 0
+        for sample_name, objs in result['summary_entry_dict'].items():
+            rows = summary_rows(objs)
+            lines.extend(_encode({'record': 'summary', 'sample': sample_name, 'fields': row}) for row in rows)
+            n_summary += len(rows)
+        lines.append(_encode({'record': 'sample_end', 'sample': sample, 'interpreted_rows': len(result['output_rows']),
+                              'summary_entries': n_summary}))
+        self.stream.write('\n'.join(lines) + '\n')
+        # at the sample boundary, so a consumer tailing the stream always sees whole samples
+        self.stream.flush()
+        self.samples += 1
+
+    def close(self):
+        if self.close_stream:
+            self.stream.close()
+        else:
+            self.stream.flush()
@@ -2,52 +2,104 @@ import os
 import csv
 from amrrules import __version__
 from amrrules.utils import required_cols, minimal_columns, full_columns
+from amrrules.interpreted_report import InterpretedWriter, interpreted_base_columns, layout_rows
 
-def write_genotype_report(args, output_rows, unmatched_hits, matched_hits, base_fieldnames):
-     # write the output files
-    interpreted_output_file = os.path.join(args.output_dir, args.output_prefix + '_interpreted.tsv')
-    #summary_output_file = os.path.join(args.output_dir, args.output_prefix + '_summary.tsv')
+def wants_output(args, report):
+    """True if the run writes the given report ('interpreted' or 'summary'), as chosen with --outputs."""
+    return getattr(args, 'outputs', 'both') in ('both', report)
+
+def is_partitioned(args):
+    """True if the reports are written per sample, as chosen with --output-layout."""
+    return getattr(args, 'output_layout', 'combined') == 'partitioned'
+
+def row_sample(args, row):
+    """The sample an interpreted row belongs to, named in the same way as by GenoResult."""
+    if args.sample_id:
+        return args.sample_id
+    return row.get('Name') or 'sample'
 
+def sample_organism(organism_dict, sample):
+    """The organism of a sample: the same one for every sample, or by sample name from the organism file."""
+    if len(organism_dict) == 1:
+        return organism_dict.get('')
+    return organism_dict.get(sample)
+
+def interpreted_columns(args, base_fieldnames):
+    """The columns of the interpreted report: the input columns, then the annotation columns for --annot-opts."""
     if args.annot_opts == 'minimal':
         interpreted_output_cols = required_cols + minimal_columns
     elif args.annot_opts == 'full':
         interpreted_output_cols = required_cols + minimal_columns + full_columns
+    return base_fieldnames + interpreted_output_cols
+
+def write_genotype_report(args, output_rows, unmatched_hits, matched_hits, base_fieldnames):
+     # write the output files
+    interpreted_output_file = os.path.join(args.output_dir, args.output_prefix + '_interpreted.tsv')
+    #summary_output_file = os.path.join(args.output_dir, args.output_prefix + '_summary.tsv')
 
     with open(interpreted_output_file, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=base_fieldnames + interpreted_output_cols, delimiter='\t')
+        writer = InterpretedWriter(f, interpreted_columns(args, base_fieldnames), interpreted_base_columns(base_fieldnames))
         writer.writeheader()
-        writer.writerows(output_rows)
+        writer.writerows(layout_rows(args, output_rows))
     return interpreted_output_file
 
 
+# summary entry attributes written to the genome summary report, and their column names
+summary_output_header = ['sample_name', 'drug', 'drug_class', 'category', 'phenotype', 'evidence_grade', 'markers_rule_nonS', 'markers_with_norule', 'markers_S', 'ruleIDs', 'combo_rules', 'organism']
+header_mapping = {
+'sample_name': 'sample',
+'drug': 'drug',
+'drug_class': 'drug class',
+'category': 'clinical category',
+'phenotype': 'phenotype',
+'evidence_grade': 'evidence grade',
+'markers_rule_nonS': 'markers (non-S)',
+'markers_with_norule': 'markers (no rule)',
+'markers_S': 'markers (S)',
+'ruleIDs': 'ruleIDs',
+'combo_rules': 'combo rules',
+'organism': 'organism'   
+}
+summary_csv_header = [header_mapping.get(attr, attr.replace("_", " ").title()) for attr in summary_output_header]
+
+def summary_rows(objs):
+    """The genome summary report rows for a sample's summary entries."""
+    # Build each row using a dict comprehension, mapping attribute -> CSV header
+    return [{summary_csv_header[i]: getattr(o, attr, '-') for i, attr in enumerate(summary_output_header)} for o in objs]
+
 def write_genome_report(summary_entry_dict, out_dir, out_prefix):
 
     # now we want to write out the summary entry report
     # we have all the values we need in each row, under each sample
     summary_output_file = os.path.join(out_dir, out_prefix + '_genome_summary.tsv')
-    summary_output_header = ['sample_name', 'drug', 'drug_class', 'category', 'phenotype', 'evidence_grade', 'markers_rule_nonS', 'markers_with_norule', 'markers_S', 'ruleIDs', 'combo_rules', 'organism']
-    header_mapping = {
-    'sample_name': 'sample',
-    'drug': 'drug',
-    'drug_class': 'drug class',
-    'category': 'clinical category',
-    'phenotype': 'phenotype',
-    'evidence_grade': 'evidence grade',
-    'markers_rule_nonS': 'markers (non-S)',
-    'markers_with_norule': 'markers (no rule)',
-    'markers_S': 'markers (S)',
-    'ruleIDs': 'ruleIDs',
-    'combo_rules': 'combo rules',
-    'organism': 'organism'   
-    }
-    csv_header = [header_mapping.get(attr, attr.replace("_", " ").title()) for attr in summary_output_header]
 
     with open(summary_output_file, 'w', newline='') as out:
-        writer = csv.DictWriter(out, fieldnames=csv_header, delimiter='\t')
+        writer = csv.DictWriter(out, fieldnames=summary_csv_header, delimiter='\t')
         writer.writeheader()
         for sample, objs in summary_entry_dict.items():
-        # Build each row using a dict comprehension, mapping attribute -> CSV header
-            rows = [{csv_header[i]: getattr(o, attr, '-') for i, attr in enumerate(summary_output_header)} for o in objs]
-            writer.writerows(rows)
+            writer.writerows(summary_rows(objs))
     
-    return summary_output_file
\ No newline at end of file
+    return summary_output_file
+
+def write_cohort_summary(cohort_summary, out_dir, out_prefix):
+    """Write the cohort-level aggregates to <prefix>_cohort_summary.tsv, returning the path."""
+    from amrrules.cohort_summary import COHORT_SUMMARY_COLUMNS
+    cohort_summary_file = os.path.join(out_dir, out_prefix + '_cohort_summary.tsv')
+    with open(cohort_summary_file, 'w', newline='') as out:
+        writer = csv.DictWriter(out, fieldnames=COHORT_SUMMARY_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(cohort_summary.rows())
+    return cohort_summary_file
+
+def write_rule_stats(rule_stats, out_dir, out_prefix):
+
+    # write out the rule hit and cost counters collected during the run, one row per ruleID and match path
+    rule_stats_file = os.path.join(out_dir, out_prefix + '_rule_stats.tsv')
+    rule_stats_header = ['ruleID', 'match path', 'hits', 'evaluations', 'evaluations per sample', 'mean hierarchy depth', 'mean rules scanned']
+
+    with open(rule_stats_file, 'w', newline='') as out:
+        writer = csv.DictWriter(out, fieldnames=rule_stats_header, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rule_stats.rows())
+
+    return rule_stats_file
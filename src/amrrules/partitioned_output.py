@@ -0,0 +1,106 @@
+"""
+Partitioned output layout (--output-layout partitioned): rather than one interpreted report and one genome summary
+for the whole run, each sample gets its own pair of reports in a Hive-style directory,
+<output dir>/<prefix>/organism=<organism>/sample=<sample>/, so downstream jobs can read just the samples they need.
+"""
+
+import csv
+import os
+from collections import OrderedDict
+
+from amrrules.interpreted_report import layout_rows
+from amrrules.output import interpreted_columns, row_sample, sample_organism, summary_csv_header, summary_rows, wants_output
+
+INTERPRETED_FILE = 'interpreted.tsv'
+SUMMARY_FILE = 'genome_summary.tsv'
+# characters that can't be used as-is in a partition directory name, escaped as %XX like Hive does
+_UNSAFE = set('%/\\=:*?"<>|')
+
+
+def partition_value(value):
+    """Escape an organism or sample name for use in a partition directory name."""
+    if value is None or value == '':
+        return 'unknown'
+    escaped = ''.join(f"%{ord(c):02X}" if c in _UNSAFE or ord(c) < 32 else c for c in value)
+    return escaped if escaped not in ('.', '..') else escaped.replace('.', '%2E')
+
+
+def partition_dir(base_dir, organism, sample):
+    return os.path.join(base_dir, f"organism={partition_value(organism)}", f"sample={partition_value(sample)}")
+
+
+class WriterCache:
+    """
+    An LRU of open csv writers, so that no more than max_open files are open at once however many samples there
+    are. A file is truncated (and its header written) the first time it's opened, and appended to if it's opened
+    again after being closed.
+    """
+
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.open_files = OrderedDict() # key: path, value: (file, writer)
+        self.started = set() # paths that have been opened at least once
+        self.reopened = 0 # number of times a closed file had to be opened again
+
+    def writer(self, path, fieldnames):
+        entry = self.open_files.get(path)
+        if entry is not None:
+            self.open_files.move_to_end(path)
+            return entry[1]
+        if len(self.open_files) >= self.max_open:
+            _, (oldest, _) = self.open_files.popitem(last=False)
+            oldest.close()
+        if path in self.started:
+            f = open(path, 'a', newline='')
+            writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter='\t')
+            self.reopened += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(path, 'w', newline='')
+            writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter='\t')
+            writer.writeheader()
+            self.started.add(path)
+        self.open_files[path] = (f, writer)
+        return writer
+
+    def close(self):
+        for f, _ in self.open_files.values():
+            f.close()
+        self.open_files.clear()
+
+
+class PartitionedOutput:
+    """
+    Writes the interpreted rows and summary entries of a run (or of one checkpoint batch, as batches never split
+    a sample) into the per-sample partitions under <output dir>/<prefix>.
+    """
+
+    def __init__(self, args, organism_dict):
+        self.args = args
+        self.organism_dict = organism_dict
+        self.base_dir = os.path.join(args.output_dir, args.output_prefix)
+        self.writers = WriterCache(args.max_open_files)
+        self.samples = set()
+
+    def write_interpreted(self, output_rows, base_fieldnames):
+        if not wants_output(self.args, 'interpreted'):
+            return
+        fieldnames = interpreted_columns(self.args, base_fieldnames)
+        for row in layout_rows(self.args, output_rows):
+            sample = row_sample(self.args, row)
+            path = os.path.join(partition_dir(self.base_dir, sample_organism(self.organism_dict, sample), sample), INTERPRETED_FILE)
+            self.writers.writer(path, fieldnames).writerow(row)
+            self.samples.add(sample)
+
+    def write_summary(self, summary_entry_dict):
+        if not wants_output(self.args, 'summary'):
+            return
+        for sample, objs in summary_entry_dict.items():
+            if not objs:
+                continue
+            path = os.path.join(partition_dir(self.base_dir, objs[0].organism, sample), SUMMARY_FILE)
+            self.writers.writer(path, summary_csv_header).writerows(summary_rows(objs))
+            self.samples.add(sample)
+
+    def close(self):
+        self.writers.close()
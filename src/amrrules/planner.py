@@ -0,0 +1,431 @@
+"""
+Planning a run (amrrules plan): estimate what interpreting an input file will cost before the job is submitted,
+from a sample of the input rather than a full pass over it.
+
+The header and the first PREFIX_BYTES of the input are read, along with PROBES short reads spread evenly through
+the rest of the file, which is enough to estimate the number of rows and samples, the rows per sample, the
+organisms involved and the fraction of rows that are AMR hits (the rows that are matched against rules). For a BGZF
+file (eg compressed with bgzip) each probe seeks to the next block and decompresses from there, and the uncompressed
+size is worked out from the compression ratio of the blocks read. A file compressed with plain gzip can only be read
+from the start, so its estimates come from the prefix, and its uncompressed size from the gzip trailer.
+
+The estimates are combined with per-row, per-AMR-row and per-sample costs measured by the benchmark suite
+(plan_calibration.json, refreshed with pytest benchmarks/bench_plan.py --update-plan-calibration) to predict the
+runtime, peak memory and output size of the run, and to recommend how many shards to split it into and how many of
+those to run at once.
+"""
+
+import csv
+import json
+import math
+import os
+import zlib
+from collections import Counter
+from itertools import pairwise
+from importlib import resources
+
+from amrrules.rules_io import get_rule_files, parse_rules_file
+from amrrules.sample_index import GZIP_WBITS, _is_gzip
+from amrrules.utils import get_organisms
+
+PREFIX_BYTES = 4 * 1024 * 1024
+PROBES = 16
+PROBE_BYTES = 256 * 1024
+# gzip member header of a BGZF block, as written by bgzip (FEXTRA set, with the BC subfield first)
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_MAX_BLOCK = 64 * 1024
+CALIBRATION_FILE = 'plan_calibration.json'
+# don't recommend splitting a run into shards with less than this much work each, as every shard pays the startup cost again
+MIN_SHARD_WORK_S = 60
+# recommend checkpointing a shard that runs for longer than this, so an interrupted shard doesn't start again from scratch
+CHECKPOINT_AFTER_S = 30 * 60
+# organisms listed in the printed plan (all of them are in the JSON)
+SHOW_ORGANISMS = 5
+
+
+def load_calibration(path=None):
+    """The per-row costs used by the planner: the packaged calibration, or the one in path."""
+    if path:
+        with open(path, 'r') as f:
+            return json.load(f)
+    return json.loads(resources.files('amrrules').joinpath(CALIBRATION_FILE).read_text())
+
+
+# reading the sample
+
+def _complete_lines(data, at_start, at_end):
+    # the whole lines in a read from somewhere in the file: a read that doesn't start at the start of the file may
+    # have started part way through a line, and one that doesn't reach the end may stop part way through one
+    lines = data.split(b'\n')
+    tail = lines.pop()
+    if tail and at_end:
+        lines.append(tail)
+    if not at_start and lines:
+        lines.pop(0)
+    return lines
+
+
+def _probe_offsets(start, size, probes):
+    return [start + (size - start) * i // probes for i in range(probes)]
+
+
+def _read_plain(path, prefix_bytes, probes, probe_bytes):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if size <= prefix_bytes + probes * probe_bytes:
+            # small enough to just read the lot
+            return [(f.read(), True, True)], size, True
+        reads = [(f.read(prefix_bytes), True, False)]
+        for offset in _probe_offsets(prefix_bytes, size, probes):
+            f.seek(offset)
+            data = f.read(probe_bytes)
+            reads.append((data, False, offset + len(data) >= size))
+    return reads, size, False
+
+
+def _is_bgzf_header(header):
+    return len(header) >= 18 and header[:4] == BGZF_MAGIC and header[10:12] == b'\x06\x00' and header[12:14] == b'BC'
+
+
+def _is_bgzf(path):
+    with open(path, 'rb') as f:
+        return _is_bgzf_header(f.read(18))
+
+
+def _read_bgzf_blocks(f, want):
+    """Decompress whole BGZF blocks from the current position until want bytes are read. Returns (data, compressed bytes, hit the end)."""
+    out = []
+    got = compressed = 0
+    while got < want:
+        header = f.read(18)
+        if not _is_bgzf_header(header):
+            return b''.join(out), compressed, True
+        bsize = int.from_bytes(header[16:18], 'little') + 1
+        data = zlib.decompress(header + f.read(bsize - 18), GZIP_WBITS)
+        out.append(data)
+        got += len(data)
+        compressed += bsize
+        if not data:
+            # the empty block bgzip ends the file with
+            return b''.join(out), compressed, True
+    return b''.join(out), compressed, False
+
+
+def _next_bgzf_block(f, offset):
+    # the start of the first block at or after offset, found by its header
+    f.seek(offset)
+    window = f.read(BGZF_MAX_BLOCK + 18)
+    start = window.find(BGZF_MAGIC)
+    while start >= 0:
+        if _is_bgzf_header(window[start:start + 18]):
+            return offset + start
+        start = window.find(BGZF_MAGIC, start + 1)
+    return None
+
+
+def _read_bgzf(path, prefix_bytes, probes, probe_bytes):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        data, compressed, at_end = _read_bgzf_blocks(f, prefix_bytes)
+        reads = [(data, True, at_end)]
+        if at_end:
+            return reads, len(data), True
+        uncompressed = len(data)
+        read_to = f.tell()
+        for offset in _probe_offsets(read_to, size, probes):
+            # probes read whole blocks, so on a small file they can run into the next one
+            block = _next_bgzf_block(f, max(offset, read_to))
+            if block is None:
+                continue
+            f.seek(block)
+            data, probe_compressed, at_end = _read_bgzf_blocks(f, probe_bytes)
+            read_to = f.tell()
+            reads.append((data, False, at_end))
+            uncompressed += len(data)
+            compressed += probe_compressed
+    return reads, round(size * uncompressed / max(compressed, 1)), False
+
+
+def _read_gzip(path, prefix_bytes):
+    size = os.path.getsize(path)
+    out = []
+    got = 0
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    pending = b''
+    with open(path, 'rb') as f:
+        while got < prefix_bytes:
+            if not pending:
+                pending = f.read(BGZF_MAX_BLOCK)
+                if not pending:
+                    data = b''.join(out)
+                    return [(data, True, True)], len(data), True
+            data = decompressor.decompress(pending, prefix_bytes - got)
+            out.append(data)
+            got += len(data)
+            if decompressor.eof:
+                # the rest is the next member, if there is one
+                pending = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+            else:
+                pending = decompressor.unconsumed_tail
+        compressed = f.tell() - len(pending)
+        f.seek(size - 4)
+        isize = int.from_bytes(f.read(4), 'little')
+    data = b''.join(out)
+    # the trailer only has the size mod 2**32 (and only of the last member), so use the compression ratio of the
+    # prefix to pick which multiple of 2**32 it is, or instead of it if it can't be right
+    estimate = size * got / max(compressed, 1)
+    uncompressed = isize + max(0, round((estimate - isize) / 2**32)) * 2**32
+    if uncompressed < got or abs(uncompressed - estimate) > estimate:
+        uncompressed = round(estimate)
+    return [(data, True, False)], uncompressed, False
+
+
+def sample_input(path, prefix_bytes=PREFIX_BYTES, probes=PROBES, probe_bytes=PROBE_BYTES):
+    """
+    Read a sample of the input: the header, a prefix, and (unless it's plain gzip) probes spread through the rest.
+    Returns a dict with the compression, the input columns, the sampled rows in runs of consecutive rows, the
+    bytes and rows sampled, the file and (estimated) uncompressed sizes, and whether the whole file was read.
+    """
+    if not _is_gzip(path):
+        compression = 'none'
+        reads, uncompressed, exact = _read_plain(path, prefix_bytes, probes, probe_bytes)
+    elif _is_bgzf(path):
+        compression = 'bgzf'
+        reads, uncompressed, exact = _read_bgzf(path, prefix_bytes, probes, probe_bytes)
+    else:
+        compression = 'gzip'
+        reads, uncompressed, exact = _read_gzip(path, prefix_bytes)
+
+    runs = []
+    sampled_bytes = sampled_rows = header_bytes = amr_bytes = amr_rows = 0
+    fieldnames = None
+    type_col = None
+    for data, at_start, at_end in reads:
+        lines = _complete_lines(data, at_start, at_end)
+        if at_start and lines:
+            header = lines.pop(0)
+            header_bytes = len(header) + 1
+            fieldnames = header.decode('utf-8', errors='replace').rstrip('\r').split('\t')
+            # the column that says whether a row is an AMR hit, as GenoResult reads it
+            type_col = next((fieldnames.index(col) for col in ('Element type', 'Type') if col in fieldnames), None)
+        if not lines or fieldnames is None:
+            continue
+        sampled_bytes += sum(len(line) + 1 for line in lines)
+        sampled_rows += len(lines)
+        if type_col is not None:
+            for line in lines:
+                fields = line.split(b'\t', type_col + 1)
+                if len(fields) > type_col and fields[type_col].rstrip(b'\r') == b'AMR':
+                    amr_bytes += len(line) + 1
+                    amr_rows += 1
+        text = [line.decode('utf-8', errors='replace').rstrip('\r') for line in lines]
+        runs.append(list(csv.DictReader(text, fieldnames=fieldnames, delimiter='\t')))
+    if fieldnames is None:
+        raise ValueError(f"Input file {path} is empty.")
+    return {'compression': compression, 'fieldnames': fieldnames, 'runs': runs, 'sampled_bytes': sampled_bytes,
+            'sampled_rows': sampled_rows, 'amr_bytes': amr_bytes, 'amr_rows': amr_rows,
+            'header_bytes': header_bytes, 'file_bytes': os.path.getsize(path),
+            'uncompressed_bytes': uncompressed, 'exact': exact}
+
+
+# estimates from the sample
+
+def estimate_input(sample, organism_dict):
+    """
+    Estimate the size and make up of the whole input from a sample of it (from sample_input). organism_dict is
+    as for a run: sample names to organisms, or {'': organism} for a single organism.
+    """
+    rows = [row for run in sample['runs'] for row in run]
+    n_sampled = max(len(rows), 1)
+    bytes_per_row = sample['sampled_bytes'] / n_sampled
+    if sample['exact']:
+        n_rows = len(rows)
+    else:
+        n_rows = round((sample['uncompressed_bytes'] - sample['header_bytes']) / max(bytes_per_row, 1))
+
+    if 'Name' in sample['fieldnames']:
+        names = [[row.get('Name') for row in run] for run in sample['runs']]
+        seen = {name for run in names for name in run}
+        if sample['exact']:
+            n_samples = len(seen)
+        else:
+            # each change of Name between consecutive rows starts a new sample
+            pairs = sum(max(len(run) - 1, 0) for run in names)
+            changes = sum(a != b for run in names for a, b in pairwise(run))
+            n_samples = max(len(seen), round(n_rows * changes / pairs) if pairs and changes else len(seen))
+    else:
+        # a single genome, unless it's split up with --sample-id
+        n_samples = 1
+
+    if len(organism_dict) == 1:
+        organisms = Counter({next(iter(organism_dict.values())): len(rows)})
+    else:
+        organisms = Counter(organism_dict.get(row.get('Name'), 'not in organism file') for row in rows)
+    amr_fraction = sample['amr_rows'] / n_sampled
+    return {
+        'compression': sample['compression'],
+        'file_bytes': sample['file_bytes'],
+        'uncompressed_bytes': sample['uncompressed_bytes'],
+        'exact': sample['exact'],
+        'sampled_rows': len(rows),
+        'rows': n_rows,
+        'samples': n_samples,
+        'rows_per_sample': n_rows / max(n_samples, 1),
+        'amr_fraction': amr_fraction,
+        'amr_rows': round(n_rows * amr_fraction),
+        'bytes_per_row': bytes_per_row,
+        'amr_bytes_per_row': sample['amr_bytes'] / sample['amr_rows'] if sample['amr_rows'] else bytes_per_row,
+        'organisms': {organism: count / n_sampled for organism, count in organisms.most_common()},
+    }
+
+
+# predictions
+
+def predict_run(estimate, calibration, args, rows=None, samples=None):
+    """
+    Predict the runtime (seconds), peak memory (MB) and output sizes (bytes) of a run over the estimated input,
+    or over rows and samples of it (eg one shard).
+    """
+    rows = estimate['rows'] if rows is None else rows
+    samples = estimate['samples'] if samples is None else samples
+    amr_rows = rows * estimate['amr_fraction']
+    printed_rows = rows if args.print_non_amr else amr_rows
+
+    interpreted_rows = summary_bytes = interpreted_bytes = 0
+    if args.outputs in ('both', 'interpreted'):
+        # non-AMR rows are written as they are, AMR rows once per matched rule (or once per hit if compact)
+        interpreted_rows = amr_rows * calibration['interpreted_rows_per_amr_row'][args.interpreted_layout] + (printed_rows - amr_rows)
+        interpreted_bytes = interpreted_rows * (estimate['amr_bytes_per_row'] + calibration['annotation_bytes_per_row'][args.annot_opts])
+    if args.outputs in ('both', 'summary'):
+        summary_bytes = samples * calibration['summary_bytes_per_sample']
+    output_mb = (interpreted_bytes + summary_bytes) / 1e6
+
+    runtime = (calibration['fixed_s'] + rows * calibration['row_s']
+               + amr_rows * calibration['amr_row_s']
+               + samples * calibration['sample_s'] + output_mb * calibration['write_s_per_mb'])
+
+    # results are held in memory until they're written, for the whole run or for each checkpointed batch
+    held_rows = rows
+    if args.checkpoint_dir:
+        held_rows = min(rows, args.checkpoint_batch_size * estimate['rows_per_sample'])
+    peak_mb = calibration['base_rss_mb'] + held_rows * calibration['rss_bytes_per_row'] / (1024 * 1024)
+    return {'runtime_s': runtime, 'peak_rss_mb': peak_mb, 'interpreted_rows': round(interpreted_rows),
+            'interpreted_bytes': round(interpreted_bytes), 'summary_bytes': round(summary_bytes)}
+
+
+def recommend(estimate, calibration, args):
+    """
+    Recommend how to split the run up: the number of shards (each a separate amrrules run over some of the
+    samples, see amrrules index and --samples) and the number of them to run at once (-j) on a node with
+    args.cores cores and args.memory GB of memory, so that each shard finishes within args.target_walltime minutes.
+    """
+    whole = predict_run(estimate, calibration, args)
+    work = max(whole['runtime_s'] - calibration['fixed_s'], 0)
+    target = args.target_walltime * 60
+    memory_mb = args.memory * 1024 if args.memory else None
+    max_shards = max(estimate['samples'], 1)
+
+    # enough shards to fit the walltime, and to use the cores while each shard still has a worthwhile amount of work
+    shards = math.ceil(work / max(target - calibration['fixed_s'], 1))
+    shards = max(shards, min(args.cores, int(work // MIN_SHARD_WORK_S)), 1)
+    checkpoint_batch = None
+    while True:
+        shards = min(shards, max_shards)
+        shard = predict_run(estimate, calibration, args, rows=estimate['rows'] / shards,
+                            samples=estimate['samples'] / shards)
+        if memory_mb is None or shard['peak_rss_mb'] <= memory_mb or shards >= max_shards:
+            break
+        # a shard holds all its results in memory until the end, so either checkpoint it (which bounds memory by
+        # the batch size) or split further
+        bytes_per_sample = calibration['rss_bytes_per_row'] * estimate['rows_per_sample']
+        fit = int((memory_mb - calibration['base_rss_mb']) * 1024 * 1024 // max(bytes_per_sample, 1))
+        if fit >= 1 and (not args.checkpoint_dir or args.checkpoint_batch_size > fit):
+            checkpoint_batch = min(fit, args.checkpoint_batch_size)
+            args = _with(args, checkpoint_dir=args.checkpoint_dir or 'CHECKPOINT_DIR', checkpoint_batch_size=checkpoint_batch)
+            continue
+        shards *= 2
+
+    jobs = min(shards, args.cores)
+    if memory_mb is not None:
+        jobs = max(min(jobs, int(memory_mb // max(shard['peak_rss_mb'], 1))), 1)
+    if checkpoint_batch is None and shard['runtime_s'] > CHECKPOINT_AFTER_S:
+        checkpoint_batch = args.checkpoint_batch_size
+    return {'shards': shards, 'jobs': jobs, 'checkpoint_batch_size': checkpoint_batch, 'shard': shard,
+            'wall_s': math.ceil(shards / jobs) * shard['runtime_s']}
+
+
+def _with(args, **changes):
+    # a copy of the options with some changed, to predict the run as it would be with them
+    return type(args)(**{**vars(args), **changes})
+
+
+def plan(args):
+    """Sample the input and put together the plan for a run over it with these options (from the plan subcommand)."""
+    if args.organism_file:
+        organism_dict, _ = get_organisms(args.organism_file)
+    else:
+        organism_dict = {'': args.organism}
+    calibration = load_calibration(args.calibration)
+    sample = sample_input(args.input)
+    estimate = estimate_input(sample, organism_dict)
+    # a run loads the rules of every organism in the organism file (matching looks each row's rules up by gene,
+    # so the number of rules only adds to the startup time)
+    n_rules = len(parse_rules_file(get_rule_files(organism_dict.values())))
+    return {
+        'input': args.input,
+        'estimate': estimate,
+        'rules_loaded': n_rules,
+        'run': predict_run(estimate, calibration, args),
+        'recommendation': recommend(estimate, calibration, args),
+        'calibration': calibration.get('calibrated_with', {}),
+    }
+
+
+def _size(n_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n_bytes < 1000:
+            return f"{n_bytes:.0f} {unit}" if unit == 'B' else f"{n_bytes:.1f} {unit}"
+        n_bytes /= 1000
+    return f"{n_bytes:.1f} TB"
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+def print_plan(result, args):
+    estimate = result['estimate']
+    run = result['run']
+    rec = result['recommendation']
+    about = '' if estimate['exact'] else '~'
+    sampled = 'read in full' if estimate['exact'] else f"{estimate['sampled_rows']:,} rows sampled"
+    print(f"Input: {result['input']} ({_size(estimate['file_bytes'])}, compression: {estimate['compression']}, {sampled})")
+    print(f"  rows: {about}{estimate['rows']:,} ({estimate['amr_fraction']:.0%} AMR)")
+    print(f"  samples: {about}{estimate['samples']:,} ({estimate['rows_per_sample']:.1f} rows per sample)")
+    organisms = list(estimate['organisms'].items())
+    others = f", and {len(organisms) - SHOW_ORGANISMS} more" if len(organisms) > SHOW_ORGANISMS else ''
+    print("  organisms: " + ", ".join(f"{organism} ({share:.0%})" for organism, share in organisms[:SHOW_ORGANISMS]) + others)
+    print(f"  rules loaded: {result['rules_loaded']}")
+    print(f"As a single run: {_duration(run['runtime_s'])}, peak memory {run['peak_rss_mb']:,.0f} MB, "
+          f"interpreted report {_size(run['interpreted_bytes'])} ({run['interpreted_rows']:,} rows), "
+          f"genome summary {_size(run['summary_bytes'])}")
+    shard = rec['shard']
+    print(f"Recommended: {rec['shards']} shard{'s' if rec['shards'] > 1 else ''}, {rec['jobs']} at a time (-j {rec['jobs']}), "
+          f"each {_duration(shard['runtime_s'])} with peak memory {shard['peak_rss_mb']:,.0f} MB, "
+          f"{_duration(rec['wall_s'])} in all")
+    if rec['shards'] > 1:
+        print(f"  Split the samples into {rec['shards']} lists (eg split -n l/{rec['shards']} on the organism file), index the input "
+              f"with amrrules index {args.input}, and run each shard with --samples LIST. Combine the shards' cohort "
+              f"summaries with amrrules merge-cohort.")
+    if rec['checkpoint_batch_size']:
+        print(f"  Run each shard with --checkpoint-dir and --checkpoint-batch-size {rec['checkpoint_batch_size']}, "
+              f"so it can be resumed if it's interrupted and holds fewer results in memory at once.")
+    calibrated_with = result['calibration']
+    if calibrated_with:
+        print(f"Costs calibrated on a {calibrated_with.get('samples', '?')} sample cohort with Python {calibrated_with.get('python', '?')}; "
+              f"times on other machines will differ.")
@@ -1,34 +1,375 @@
 """Resource management for AMRFinderPlus data files."""
 
 import csv
+import errno
+import io
+import os
+import re
+import shutil
+import threading
 import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
-import re
-import obonet
+from typing import Callable, Dict, List, Optional
+from amrrules.shared_tables import load_shared_table
 import tempfile
 import tarfile
 
+# size of each chunk copied to disk when streaming downloads and archive members
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# environment variable that can be used to point all runs at a shared resource store
+RESOURCE_DIR_ENV = "AMRRULES_RESOURCE_DIR"
+# files that make up a complete installed version of each database
+AMRFP_FILES = ["ReferenceGeneHierarchy.txt", "version.txt"]
+CARD_ONTOLOGY_FILES = ["aro.obo", "ncbi_taxonomy.tsv"]
+CARD_DATA_FILES = ["aro_categories.tsv"]
+# specific betalactam (and other) CARD terms used as drug classes for their children, as well as the Drug Class categories
+CARD_BETALACTAM_AROS = [
+    'ARO:3009105', 'ARO:3009106', 'ARO:3009107', 'ARO:3009108',
+    'ARO:3009109', 'ARO:3009123', 'ARO:3009124', 'ARO:3009125',
+    'ARO:3000035', 'ARO:3007783', 'ARO:0000022', 'ARO:3007629',
+    'ARO:3000707'
+]
+# CARD term names with a synonym that rules use as the drug name, eg rule drug "kanamycin" is CARD "kanamycin A"
+CARD_DRUG_ALIASES = {'kanamycin A': 'kanamycin'}
+# the value of an obo tag line (after the tag and colon), without any trailing {modifier} or ! comment
+OBO_TAG_VALUE = re.compile(r'\s*(.*?)(?:\s\{[^{}]*\})?(?:\s![^\n]*)?\s*$')
+
+
+class ResourceStore:
+    """
+    A directory holding one immutable sub-directory per downloaded database version, eg:
+
+        <root>/amrfp/2025-07-16.1/ReferenceGeneHierarchy.txt
+        <root>/amrfp/LATEST          (contains the name of the most recently installed version)
+        <root>/card/4.0.1/aro.obo
+
+    New versions are downloaded into a temporary directory next to their final location and then
+    renamed into place, so a run that is reading one version is never affected by a download of another,
+    and several nodes can share the same store.
+    """
+
+    def __init__(self, root=None):
+        if root is None:
+            root = os.environ.get(RESOURCE_DIR_ENV) or Path(__file__).parent / "resources"
+        self.root = Path(root)
+
+    def version_dir(self, database: str, version: str) -> Path:
+        return self.root / database / version
+
+    def installed_versions(self, database: str) -> List[str]:
+        """Return the installed versions of a database, ignoring any partially downloaded ones."""
+        database_dir = self.root / database
+        if not database_dir.is_dir():
+            return []
+        return sorted(d.name for d in database_dir.iterdir() if d.is_dir() and not d.name.startswith('.'))
+
+    def latest_version(self, database: str) -> Optional[str]:
+        """Return the most recently installed version of a database, or None if nothing is installed."""
+        latest_file = self.root / database / "LATEST"
+        if latest_file.exists():
+            version = latest_file.read_text().strip()
+            if self.version_dir(database, version).is_dir():
+                return version
+        return None
+
+    def resolve(self, database: str, version: Optional[str] = 'latest') -> Optional[Path]:
+        """
+        Return the directory for the requested version of a database ('latest' or None for the most recent).
+        Returns None if nothing is installed in the store. Raises FileNotFoundError if a specific version was
+        requested but isn't installed.
+        """
+        if version in (None, 'latest'):
+            latest = self.latest_version(database)
+            return self.version_dir(database, latest) if latest else None
+        version_dir = self.version_dir(database, version)
+        if not version_dir.is_dir():
+            installed = ', '.join(self.installed_versions(database)) or 'none'
+            raise FileNotFoundError(
+                errno.ENOENT, f"{database} version {version} is not installed (installed: {installed})", str(version_dir))
+        return version_dir
+
+    def new_version_dir(self, database: str) -> Path:
+        """Create an empty temporary directory to download a new version into, on the same filesystem as the store."""
+        database_dir = self.root / database
+        database_dir.mkdir(parents=True, exist_ok=True)
+        temp_dir = Path(tempfile.mkdtemp(dir=database_dir, prefix=".download-"))
+        temp_dir.chmod(0o755)
+        return temp_dir
+
+    def install(self, database: str, version: str, temp_dir: Path) -> Path:
+        """
+        Move a fully downloaded temporary directory into place as the given version, and mark it as the latest.
+        If another process installed the same version first, its copy is kept and ours is discarded.
+        """
+        version_dir = self.version_dir(database, version)
+        try:
+            os.rename(temp_dir, version_dir)
+        except OSError:
+            if not version_dir.is_dir():
+                raise
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.set_latest(database, version)
+        return version_dir
+
+    def set_latest(self, database: str, version: str):
+        _write_atomic(self.root / database / "LATEST", (version + '\n').encode('utf-8'))
+
+
+class ResourceRegistry:
+    """
+    Process-wide cache of parsed resource structures (eg hierarchy dicts and CARD drug maps), keyed by the
+    version directory they were loaded from. Structures are loaded on first use and the least recently used
+    ones are evicted once more than max_entries are held, so a long-running process can serve inputs that
+    use different database versions without holding every version in memory.
+    """
+
+    def __init__(self, max_entries: int = 4):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, object]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, loader: Callable[[], object]):
+        """Return the structure for key, calling loader to build it if it isn't already held."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        # load outside the lock, so slow loads of different structures don't block each other
+        value = loader()
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_registry = ResourceRegistry()
+
+def get_registry() -> ResourceRegistry:
+    """Return the process-wide resource registry."""
+    return _registry
+
+
+def _stream_to_file(source, target_path: Path):
+    """Copy a file-like object to target_path in chunks, via a temporary file that is renamed into place."""
+    fd, temp_path = tempfile.mkstemp(dir=target_path.parent, prefix=f".{target_path.name}.", suffix=".part")
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(source, out, DOWNLOAD_CHUNK_SIZE)
+        # http responses count down the bytes still due from their Content-Length, and just stop if the connection drops
+        if getattr(source, 'length', None):
+            raise IOError(f"download of {target_path.name} ended with {source.length} bytes still to come")
+        # mkstemp creates files that only we can read, but resources may be shared with other users
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+
+def _write_atomic(target_path: Path, content: bytes):
+    """Write content to target_path via a temporary file that is renamed into place."""
+    _stream_to_file(io.BytesIO(content), target_path)
+
+
+_MISSING = object()
+
+
+class CardDrugIndex:
+    """
+    An index of the CARD ontology built in one pass over aro.obo: the ids of the terms with each name (or aliased
+    synonym) and each term's direct is_a parents. Drug names are resolved to their drug class on demand, and each
+    resolution is memoised, so a run only resolves the drugs in its rules rather than every drug in CARD. The full
+    map of every drug (for the shared tables) is resolved the same way.
+    """
+
+    _TAGS = ('id:', 'name:', 'synonym:', 'is_a:', 'is_obsolete:', 'relationship:')
+
+    def __init__(self, obo_file_path: str, categories_file_path: str):
+        self.name_ids: Dict[str, List[str]] = {} # key: term name (or aliased synonym), value: ids of non-obsolete terms
+        self.alias_ids: Dict[str, List[str]] = {} # key: rule drug name, value: ids of terms it's an alias of
+        self.parents: Dict[str, List[str]] = {} # key: term id, value: direct is_a parents
+        self.names: Dict[str, Optional[str]] = {} # key: id of every term in the ontology graph, value: its name
+        self._resolved: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self._read_obo(obo_file_path)
+
+        # the classes each drug can be resolved to, in the order the full map assigns them (later ones win)
+        drug_classes: Dict[str, str] = {}
+        with open(categories_file_path, 'r', newline='') as file:
+            for row in csv.DictReader(file, delimiter='\t'):
+                if row['ARO Category'] == 'Drug Class':
+                    drug_classes[row['ARO Name']] = row['ARO Accession']
+        self.sources = [(aro_accession, drug_class, True) for drug_class, aro_accession in drug_classes.items()]
+        self.sources += [(aro_accession, self.names[aro_accession], False)
+                         for aro_accession in CARD_BETALACTAM_AROS if aro_accession in self.names]
+
+    def _read_obo(self, obo_file_path: str):
+        # one pass over the [Term] stanzas, reading names and synonyms as obonet reads them
+        targets = set()
+
+        def add_term(term):
+            if not term or term.get('is_obsolete') == 'true' or 'id' not in term:
+                return
+            term_id = term['id']
+            name = term.get('name')
+            self.names[term_id] = name
+            self.name_ids.setdefault(name, []).append(term_id)
+            alias = CARD_DRUG_ALIASES.get(name)
+            if alias:
+                for synonym in term.get('synonym', []):
+                    match = re.search(r'"([^"]+)"', synonym)
+                    if match and match.group(1) == alias:
+                        self.alias_ids.setdefault(alias, []).append(term_id)
+            if 'is_a' in term:
+                self.parents.setdefault(term_id, []).extend(term['is_a'])
+            targets.update(term.get('is_a', ()), term.get('relationship', ()))
+
+        term = None
+        previous_blank = True
+        with open(obo_file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    previous_blank = True
+                    continue
+                if previous_blank:
+                    # a new stanza
+                    add_term(term)
+                    term = {} if line.startswith('[Term]') else None
+                    previous_blank = False
+                    if term is not None:
+                        continue
+                if term is None or line.startswith('!') or not line.startswith(self._TAGS):
+                    continue
+                if line.startswith(('is_a:', 'relationship:')):
+                    # only the target term is needed, which is the first word of the value (after the relationship type)
+                    words = line.split(':', 1)[1].split()
+                    if line.startswith('is_a:'):
+                        term.setdefault('is_a', []).append(words[0])
+                    else:
+                        term.setdefault('relationship', []).append(words[1])
+                    continue
+                tag, value = line.split(':', 1)
+                value = OBO_TAG_VALUE.match(value).group(1)
+                if tag == 'synonym':
+                    term.setdefault('synonym', []).append(value)
+                else:
+                    term[tag] = value
+        add_term(term)
+        # terms that are only the target of a relationship are still in the graph, without a name
+        for target in targets:
+            self.names.setdefault(target, None)
+
+    def _resolve(self, drug: str):
+        direct = {parent for term_id in self.name_ids.get(drug, ()) for parent in self.parents.get(term_id, ())}
+        aliased = {parent for term_id in self.alias_ids.get(drug, ()) for parent in self.parents.get(term_id, ())}
+        drug_class = _MISSING
+        for aro_accession, source_class, use_aliases in self.sources:
+            if aro_accession in direct or (use_aliases and aro_accession in aliased):
+                drug_class = source_class
+        return drug_class
+
+    def drug_class(self, drug: str, default=None):
+        """The CARD drug class of a drug, or default if it isn't a drug in one of the CARD drug classes."""
+        with self._lock:
+            drug_class = self._resolved.get(drug, _MISSING)
+            if drug_class is _MISSING and drug not in self._resolved:
+                drug_class = self._resolved[drug] = self._resolve(drug)
+        return default if drug_class is _MISSING else drug_class
+
+    def drug_class_map(self, drugs) -> dict:
+        """The drug class of each of the drugs that resolves to one, in the same form as the full CARD drug map."""
+        drug_map = {}
+        for drug in drugs:
+            drug_class = self.drug_class(drug, _MISSING)
+            if drug_class is not _MISSING:
+                drug_map[drug] = drug_class
+        return drug_map
+
+    def full_drug_class_map(self) -> dict:
+        """The drug class of every drug in every CARD drug class."""
+        return self.drug_class_map([name for name in self.name_ids if name is not None] + list(self.alias_ids))
+
+
 class ResourceManager:
     """Manages external resource files required for assigning and annotating rules."""
+
+    # where the resources are downloaded from, these can be overridden (eg to point at a local mirror)
+    amrfp_db_root_url = 'https://ftp.ncbi.nlm.nih.gov/pathogen/Antimicrobial_resistance/AMRFinderPlus/database'
+    card_version = "4.0.1"
+    card_ontology_url = "https://card.mcmaster.ca/download/5/ontology-v{version}.tar.bz2"
+    card_data_url = "https://card.mcmaster.ca/download/0/broadstreet-v{version}.tar.bz2"
     
-    def __init__(self):
-        """Initialize resource manager with default resource directory."""
+    def __init__(self, resource_dir=None, amrfp_db_version: str = 'latest', card_version: Optional[str] = None,
+                 shared_tables: bool = False):
+        """
+        Initialize resource manager. Downloaded resources live in a versioned ResourceStore, rooted at resource_dir
+        (or $AMRRULES_RESOURCE_DIR, or the package resources directory). amrfp_db_version and card_version select
+        which installed versions this manager reads from. shared_tables loads the reference structures from
+        memory-mapped tables that are shared between processes, see shared_tables.py.
+        """
+        # bundled resources (eg the AMRFP to CARD conversion table) always live in the package
         self.dir = Path(__file__).parent / "resources"
+        self.store = ResourceStore(resource_dir)
+        self.amrfp_db_version_requested = amrfp_db_version or 'latest'
+        self.card_version_requested = card_version or 'latest'
+        self.shared_tables = shared_tables
+        self._amrfp_dir: Optional[Path] = None
+        self._card_dir: Optional[Path] = None
         self._amrfp_card_convert_cache: Optional[list] = None
         self._amrfp_db_version: Optional[str] = None
         self._refseq_nodes_cache: Optional[dict] = None
         self._card_drug_map: Optional[dict] = None
+        self._card_drug_index: Optional[CardDrugIndex] = None
+        # hits and misses for each of the cached resources above, reported in the run metrics
+        self.cache_stats: Dict[str, Dict[str, int]] = {}
+
+    def _record_cache(self, name: str, hit: bool):
+        """Record a hit or miss against one of the cached resources."""
+        stats = self.cache_stats.setdefault(name, {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += 1
+
+    @property
+    def amrfp_dir(self) -> Path:
+        """
+        Directory holding the selected AMRFP database version. This is resolved once, so a run keeps reading the same
+        version even if a newer one is installed while it is running. Installs from before the versioned store was
+        introduced kept their files directly in the package resources directory, so fall back to that.
+        """
+        if self._amrfp_dir is None:
+            self._amrfp_dir = self.store.resolve('amrfp', self.amrfp_db_version_requested) or self.dir
+        return self._amrfp_dir
+
+    @property
+    def card_dir(self) -> Path:
+        """Directory holding the selected CARD version, resolved in the same way as amrfp_dir."""
+        if self._card_dir is None:
+            self._card_dir = self.store.resolve('card', self.card_version_requested) or self.dir
+        return self._card_dir
     
     def setup_all_resources(self):
         """
         Download and set up all required external resources, from AMRFP and CARD databases.
+        The AMRFP and CARD downloads run concurrently, and versions that are already installed are skipped.
         """
-        amrfp_success = self.download_amrfp_resources()
-        card_success = self.download_card_archives()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            amrfp_future = executor.submit(self.download_amrfp_resources)
+            card_future = executor.submit(self.download_card_archives)
+            amrfp_success = amrfp_future.result()
+            card_success = card_future.result()
 
         if amrfp_success and card_success:
-            print("All resources have been successfully set up.")
+            print(f"All resources have been successfully set up in {self.store.root}.")
             return True
         else:
             return False
@@ -36,139 +377,139 @@ class ResourceManager:
     # Functions for downloading AMRFP and CARD files
     def download_amrfp_resources(self):
         """
-        Download AMRFinderPlus Ref Gene Hierarchy and the database version number into the resource directory.
+        Download AMRFinderPlus Ref Gene Hierarchy and the database version number into a new version directory in the store.
+        The small version.txt file is fetched first, and nothing else is downloaded if that version is already installed.
+        amrfp_db_version_requested is either 'latest' or the NCBI directory of a specific release (eg 4.0/2025-07-16.1).
         """
-        # URLs for the AMRFinderPlus resources
-        amrfp_nodes_url = 'https://ftp.ncbi.nlm.nih.gov/pathogen/Antimicrobial_resistance/AMRFinderPlus/database/latest/ReferenceGeneHierarchy.txt'
-        amrfp_version_url = 'https://ftp.ncbi.nlm.nih.gov/pathogen/Antimicrobial_resistance/AMRFinderPlus/database/latest/version.txt'
-        
-        # Files to download
-        file_urls = {
-            'ReferenceGeneHierarchy.txt': amrfp_nodes_url,
-            'version.txt': amrfp_version_url
-        }
-        
+        amrfp_db_url = f"{self.amrfp_db_root_url}/{self.amrfp_db_version_requested}"
+        amrfp_nodes_url = f"{amrfp_db_url}/ReferenceGeneHierarchy.txt"
+        amrfp_version_url = f"{amrfp_db_url}/version.txt"
+
         success = True
-        for filename, url in file_urls.items():
-            target_path = self.dir / filename
-            print(f"Downloading {filename} from {url}...")
-            
-            try:
-                with urllib.request.urlopen(url) as response:
-                    content = response.read()
-                    
-                with open(target_path, 'wb') as f:
-                    f.write(content)
-                
-                print(f"Successfully downloaded {filename}")
-                
-                # Get the database version
-                if filename == 'version.txt':
-                    self._amrfp_db_version = content.decode('utf-8').strip()
-                    print(f"AMRFinderPlus database version: {self._amrfp_db_version}")
-                    
-            except Exception as e:
-                print(f"Error downloading {filename}: {e}")
-                success = False
-        
+        try:
+            print(f"Checking AMRFinderPlus database version from {amrfp_version_url}...")
+            with urllib.request.urlopen(amrfp_version_url) as response:
+                version_content = response.read()
+            db_version = version_content.decode('utf-8').strip()
+            print(f"AMRFinderPlus database version: {db_version}")
+
+            version_dir = self.store.version_dir('amrfp', db_version)
+            if all((version_dir / f).exists() for f in AMRFP_FILES):
+                print(f"AMRFinderPlus database version {db_version} is already installed, skipping download.")
+                self.store.set_latest('amrfp', db_version)
+            else:
+                print(f"Downloading ReferenceGeneHierarchy.txt from {amrfp_nodes_url}...")
+                temp_dir = self.store.new_version_dir('amrfp')
+                try:
+                    with urllib.request.urlopen(amrfp_nodes_url) as response:
+                        _stream_to_file(response, temp_dir / 'ReferenceGeneHierarchy.txt')
+                    _write_atomic(temp_dir / 'version.txt', version_content)
+                    self.store.install('amrfp', db_version, temp_dir)
+                finally:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                print("Successfully downloaded ReferenceGeneHierarchy.txt")
+            self._amrfp_db_version = db_version
+        except Exception as e:
+            print(f"Error downloading AMRFinderPlus resources: {e}")
+            success = False
+
         if success:
-            print("AMRFinderPlus database files downloaded successfully.")
-            # Make sure to update the amrfp version number
-            self.get_amrfp_db_version()
+            print(f"AMRFinderPlus database files installed in {self.store.version_dir('amrfp', self._amrfp_db_version)}.")
         else:
             print("Warning: The AMRFinderPlus resources could not be downloaded.")
-        
+
         return success
 
     def download_card_archives(self):
         """
-        Download and extract CARD ontology and data files into the resource directory.
+        Download and extract CARD ontology and data files into a new version directory in the store.
+        Both archives are fetched concurrently, and nothing is downloaded if this CARD version is already installed.
         """
-        # URLs for the CARD database files
-        card_ontology_url = "https://card.mcmaster.ca/download/5/ontology-v4.0.1.tar.bz2"
-        card_data_url = "https://card.mcmaster.ca/download/0/broadstreet-v4.0.1.tar.bz2"
+        card_version = self.card_version if self.card_version_requested == 'latest' else self.card_version_requested
+        version_dir = self.store.version_dir('card', card_version)
+        if all((version_dir / f).exists() for f in CARD_ONTOLOGY_FILES + CARD_DATA_FILES):
+            print(f"CARD version {card_version} is already installed, skipping download.")
+            self.store.set_latest('card', card_version)
+            return True
 
-        # Files to extract from each archive
-        card_ontology_files = ["aro.obo", "ncbi_taxonomy.tsv"]
-        card_data_files = ["aro_categories.tsv"]
+        temp_dir = self.store.new_version_dir('card')
+        try:
+            # Download and extract files from both archives
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                ontology_future = executor.submit(self._download_and_extract, self.card_ontology_url.format(version=card_version), CARD_ONTOLOGY_FILES, temp_dir)
+                data_future = executor.submit(self._download_and_extract, self.card_data_url.format(version=card_version), CARD_DATA_FILES, temp_dir)
+                ontology_success = ontology_future.result()
+                data_success = data_future.result()
 
-        # Download and extract files from both archives
-        ontology_success = self._download_and_extract(card_ontology_url, card_ontology_files)
-        data_success = self._download_and_extract(card_data_url, card_data_files)
-        
-        if ontology_success and data_success:
-            print("CARD archives downloaded and extracted successfully.")
-            
-        # Verify that the files exist
-        missing_files = []
-        for file_name in card_ontology_files + card_data_files:
-            file_path = self.dir / file_name
-            if not file_path.exists():
-                missing_files.append(file_name)
-                
-        if missing_files:
-            print(f"Warning: The following files are missing: {', '.join(missing_files)}")
-            return False
-        else:
-            print("All required files are present in the resources directory.")
-            return ontology_success and data_success
-    
-    def _download_and_extract(self, url, files_to_extract):
-        """Function to help download CARD archives and extract specific files, saving them into the resources directory."""
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            # Download the archive
-            print(f"Downloading {url}...")
-            try:
-                with urllib.request.urlopen(url) as response:
-                    temp_file.write(response.read())
-                    temp_file.flush()
-            except Exception as e:
-                print(f"Error downloading {url}: {e}")
+            # Verify that the files exist
+            missing_files = [f for f in CARD_ONTOLOGY_FILES + CARD_DATA_FILES if not (temp_dir / f).exists()]
+            if missing_files:
+                print(f"Warning: The following files are missing: {', '.join(missing_files)}")
                 return False
+            self.store.install('card', card_version, temp_dir)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
-            temp_path = temp_file.name
-        
+        print(f"CARD archives downloaded and extracted into {version_dir}.")
+        return ontology_success and data_success
+
+    def _download_and_extract(self, url, files_to_extract, target_dir: Path):
+        """
+        Function to help download CARD archives and extract specific files, saving them into target_dir.
+        The archive is decompressed as it streams in from the network, and we stop reading as soon as all the files we
+        want have been extracted, so the whole archive is never held in memory or on disk.
+        """
+        print(f"Downloading {url}...")
         try:
-            # Extract specific files
-            with tarfile.open(temp_path, "r:bz2") as tar:
-                all_members = tar.getmembers()
-                # For each file we want to extract
-                for target_file in files_to_extract:
-                    found = False
-                    # Look for exact match or file within subdirectory
-                    for member in all_members:
-                        basename = Path(member.name).name
-                        if basename == target_file:
-                            print(f"Extracting {member.name} as {target_file}...")
-                            # Extract but rename to the target filename
-                            member_obj = tar.extractfile(member)
-                            if member_obj:
-                                with open(self.dir / target_file, 'wb') as f:
-                                    f.write(member_obj.read())
-                                found = True
-                                break
-                    
-                    if not found:
-                        print(f"Warning: Could not find {target_file} in the archive")
-                        
+            response = urllib.request.urlopen(url)
+        except Exception as e:
+            print(f"Error downloading {url}: {e}")
+            return False
+
+        try:
+            with response:
+                remaining = set(files_to_extract)
+                # "r|bz2" reads the archive as a stream, rather than seeking through it to build a member list first
+                with tarfile.open(fileobj=response, mode="r|bz2") as tar:
+                    for member in tar:
+                        target_file = Path(member.name).name
+                        if target_file not in remaining or not member.isfile():
+                            continue
+                        print(f"Extracting {member.name} as {target_file}...")
+                        # Extract but rename to the target filename
+                        _stream_to_file(tar.extractfile(member), target_dir / target_file)
+                        remaining.discard(target_file)
+                        if not remaining:
+                            break
+                for target_file in remaining:
+                    print(f"Warning: Could not find {target_file} in the archive")
             return True
         except Exception as e:
             print(f"Error extracting files: {e}")
             return False
-        finally:
-            # Clean up the temp file
-            try:
-                Path(temp_path).unlink(missing_ok=True)
-            except:
-                pass
 
     # Functions for parsing AMRFP and CARD resources into data structures used elsewhere
+    def _load_structure(self, name: str, source_dir: Path, source_files: list, build: Callable[[], dict], fields=None):
+        """
+        Load one of the reference structures through the process-wide registry, so it's shared with any other
+        ResourceManager in this process that reads the same version. With shared_tables, the structure is attached
+        from a memory-mapped table file (built on first use) rather than parsed into this process's own memory,
+        so it's also shared with every other amrrules process on the machine.
+        """
+        if self.shared_tables:
+            table_path = self.store.root / "tables" / f"{name}-{source_dir.name}.table"
+            return get_registry().get(
+                (name, str(source_dir), 'shared'), lambda: load_shared_table(table_path, source_files, build, fields))
+        return get_registry().get((name, str(source_dir)), build)
+
     def refseq_nodes(self) -> dict:
 
+        self._record_cache('refseq_nodes', self._refseq_nodes_cache is not None)
         if self._refseq_nodes_cache is None:
-            refseq_file = self.dir / "ReferenceGeneHierarchy.txt"
+            refseq_file = self.amrfp_dir / "ReferenceGeneHierarchy.txt"
             if refseq_file.exists():
-                self._refseq_nodes_cache = self._load_refseq_nodes(str(refseq_file))
+                self._refseq_nodes_cache = self._load_structure(
+                    'refseq_nodes', self.amrfp_dir, [refseq_file], lambda: self._load_refseq_nodes(str(refseq_file)))
             else:
                 # Return empty dict if file doesn't exist yet
                 self._refseq_nodes_cache = {}
@@ -176,22 +517,26 @@ class ResourceManager:
 
     def _load_refseq_nodes(self, node_file: str):
         """Load RefSeq nodes from the given file."""
-        self._refseq_nodes_cache = {}
+        refseq_nodes = {}
 
-        refseq_hierarchy = csv.DictReader(open(node_file, 'r'), delimiter='\t')
-        for row in refseq_hierarchy:
-            node_id = row.get('node_id')
-            parent_node = row.get('parent_node_id')
-            self._refseq_nodes_cache[node_id] = parent_node
+        with open(node_file, 'r') as f:
+            refseq_hierarchy = csv.DictReader(f, delimiter='\t')
+            for row in refseq_hierarchy:
+                node_id = row.get('node_id')
+                parent_node = row.get('parent_node_id')
+                refseq_nodes[node_id] = parent_node
 
-        return self._refseq_nodes_cache
+        return refseq_nodes
 
     def get_amrfp_card_conversion(self) -> dict:
 
+        self._record_cache('amrfp_card_conversion', self._amrfp_card_convert_cache is not None)
         if self._amrfp_card_convert_cache is None:
             card_file = self.dir / "amrfp_to_card_drugs_classes.txt"
             if card_file.exists():
-                self._amrfp_card_convert_cache = self._load_amrfp_card_conversion(str(card_file))
+                self._amrfp_card_convert_cache = self._load_structure(
+                    'amrfp_card_conversion', self.dir, [card_file], lambda: self._load_amrfp_card_conversion(str(card_file)),
+                    fields=['drug', 'class'])
             else:
                 # Return empty dict if file doesn't exist yet
                 self._amrfp_card_convert_cache = {}
@@ -202,7 +547,7 @@ class ResourceManager:
         Load the dictionary that converts AMRFP Subclasses to the CARD drug and drug class ontology.
         Also create a dict that just converts CARD drugs to their classes.
         """
-        self._amrfp_card_convert_cache = {}
+        conversion = {}
 
         with open(card_file, 'r') as f:
             reader = csv.DictReader(f, delimiter='\t')
@@ -210,12 +555,12 @@ class ResourceManager:
                 amrfp_subclass = row.get('AFP_Subclass')
                 card_drug = row.get('CARD drug')
                 card_class = row.get('CARD drug class')
-                self._amrfp_card_convert_cache[amrfp_subclass] = {
+                conversion[amrfp_subclass] = {
                     'drug': card_drug,
                     'class': card_class
                 }
 
-        return self._amrfp_card_convert_cache
+        return conversion
 
     def get_amrfp_db_version(self) -> str:
         """
@@ -224,7 +569,7 @@ class ResourceManager:
         Returns:
             str: The version string or "Unknown" if the file is not available
         """
-        version_file = self.dir / "version.txt"
+        version_file = self.amrfp_dir / "version.txt"
         if version_file.exists():
             try:
                 with open(version_file, 'r') as f:
@@ -237,99 +582,27 @@ class ResourceManager:
             print("AMRFinderPlus version file not found.")
             return "Unknown"
     
-    def _parse_obo_for_descendants(self, obo_file_path: str, term_id: str) -> List[str]:
-        """Find all descendants of a given term in the OBO file."""
-        children = []
-        with open(obo_file_path, 'r') as file:
-            current_term = None
-            for line in file:
-                line = line.strip()
-                if line.startswith("[Term]"):
-                    current_term = None
-                elif line.startswith("id: "):
-                    current_term = line.split("id: ")[1]
-                elif line.startswith("is_a: ") and current_term:
-                    parent = line.split("is_a: ")[1].split(" ! ")[0]
-                    if parent == term_id:
-                        children.append(current_term)
-        return children
-    
-    def _extract_card_drugs(self, obo_file_path: str, categories_file_path: str) -> List[Tuple[str, str, str]]:
-        """Extract drug names and classes from CARD ontology files."""
-        def _extract_quoted_synonyms(synonym_entries: List[str]) -> List[str]:
-            """Extract synonym text from OBO synonym entries."""
-            extracted = []
-            for entry in synonym_entries:
-                match = re.search(r'"([^"]+)"', entry)
-                if match:
-                    extracted.append(match.group(1))
-            return extracted
-
-        # Load the OBO file
-        card_ontology = obonet.read_obo(obo_file_path)
-        
-        # Load the categories TSV
-        with open(categories_file_path, 'r', newline='') as file:
-            card_categories = csv.DictReader(file, delimiter='\t')
-            
-            # Get drug classes from categories
-            drug_classes: Dict[str, str] = {}
-            for row in card_categories:
-                if row['ARO Category'] == 'Drug Class':
-                    drug_classes[row['ARO Name']] = row['ARO Accession']
-        
-        # Get term names
-        id_to_name = {id_: data.get("name") for id_, data in card_ontology.nodes(data=True)}
-
-        # Get term synonyms. We currently use this only for a targeted alias mapping.
-        id_to_synonyms = {
-            id_: _extract_quoted_synonyms(data.get("synonym", []))
-            for id_, data in card_ontology.nodes(data=True)
-        }
-        
-        # Collect results
-        output_dict = {}
-        
-        # Extract drugs for each drug class
-        for drug_class, aro_accession in drug_classes.items():
-            try:
-                children = self._parse_obo_for_descendants(obo_file_path, aro_accession)
-                for child in children:
-                    if child in id_to_name:
-                        child_name = id_to_name[child]
-                        output_dict[child_name] = drug_class
-
-                        # Add a targeted alias so rule drug "kanamycin" resolves to CARD term "kanamycin A".
-                        if child_name == "kanamycin A":
-                            for synonym in id_to_synonyms.get(child, []):
-                                if synonym == "kanamycin":
-                                    output_dict[synonym] = drug_class
-            except Exception as e:
-                print(f"Error processing {aro_accession} for {drug_class}: {e}")
-                continue
-        
-        # Additional specific betalactam and other drug classes
-        betalac_aros = [
-            'ARO:3009105', 'ARO:3009106', 'ARO:3009107', 'ARO:3009108', 
-            'ARO:3009109', 'ARO:3009123', 'ARO:3009124', 'ARO:3009125',
-            'ARO:3000035', 'ARO:3007783', 'ARO:0000022', 'ARO:3007629',
-            'ARO:3000707'
-        ]
-        
-        for aro_accession in betalac_aros:
-            if aro_accession in id_to_name:
-                drug_class = id_to_name[aro_accession]
-                children = self._parse_obo_for_descendants(obo_file_path, aro_accession)
-                for child in children:
-                    if child in id_to_name:
-                        child_name = id_to_name[child]
-                        output_dict[child_name] = drug_class
-
-        return output_dict
-
-    def get_card_drug_class_map(self):
+    def card_drug_index(self) -> CardDrugIndex:
+        """The index of the selected CARD version's ontology, for resolving drug names on demand."""
+        obo_file = self.card_dir / "aro.obo"
+        categories_file = self.card_dir / "aro_categories.tsv"
+        if self._card_drug_index is None:
+            self._card_drug_index = get_registry().get(
+                ('card_drug_index', str(self.card_dir)), lambda: CardDrugIndex(str(obo_file), str(categories_file)))
+        return self._card_drug_index
+
+    def get_card_drug_class_map(self, drugs=None):
+        """
+        The CARD drug class of each drug. Given the drug names used by the loaded rules, only those are resolved
+        (through the ontology index); otherwise the map covers every drug in every CARD drug class. With
+        shared_tables the full map is always used, as it's built once and then shared by every process.
+        """
+        if drugs is not None and not self.shared_tables:
+            self._record_cache('card_drug_map', self._card_drug_index is not None)
+            return self.card_drug_index().drug_class_map(drugs)
+        self._record_cache('card_drug_map', self._card_drug_map is not None)
         if self._card_drug_map is None:
-            obo_file = self.dir / "aro.obo"
-            categories_file = self.dir / "aro_categories.tsv"
-            self._card_drug_map = self._extract_card_drugs(str(obo_file), str(categories_file))
+            self._card_drug_map = self._load_structure(
+                'card_drug_map', self.card_dir, [self.card_dir / "aro.obo", self.card_dir / "aro_categories.tsv"],
+                lambda: self.card_drug_index().full_drug_class_map())
         return self._card_drug_map
@@ -0,0 +1,173 @@
+"""
+A/B comparison of two rulesets (--compare-rules): each input row is parsed once, matched against both the current
+rules and an older set, and both are summarised, so that the per-sample, per-drug differences can be reported
+without running the whole cohort twice. The input is compared one sample at a time, so only one sample's results are
+held in memory, and each sample's differences are written out as soon as it's done.
+"""
+
+import copy
+import csv
+import os
+from collections import Counter, defaultdict
+from itertools import groupby
+
+from amrrules.drug_filter import DrugFilter
+from amrrules.genotype_parser import GenotypeTemplates
+from amrrules.mutation_ranges import MutationRuleIndex
+from amrrules.rules_engine import parse_row, expand_genotypes
+from amrrules.summariser import create_summary_dict, get_combination_rules
+from amrrules.tracing import NULL_TRACER
+
+# summary entry attributes compared between the two rulesets, and their column names in the report
+COMPARED_FIELDS = [('category', 'clinical category'), ('phenotype', 'phenotype'), ('evidence_grade', 'evidence grade'), ('ruleIDs', 'ruleIDs')]
+REPORT_COLUMNS = ['sample', 'drug', 'drug class', 'change', 'changed fields'] + \
+    [f"{which} {name}" for _, name in COMPARED_FIELDS for which in ('old', 'new')] + ['organism']
+
+
+def match_both(rows, args, organism_dict, skipped_samples, new_index, old_index, amrfp_nodes, metrics, tracer=NULL_TRACER):
+    """
+    Parse each row once, and match it against both rulesets (through their rule indexes). Returns the GenoResult rows
+    matched against the new rules and a copy of each matched against the old rules.
+    """
+    new_rows = []
+    old_rows = []
+    for row in rows:
+        g_new = parse_row(row, args, organism_dict, skipped_samples)
+        g_old = copy.copy(g_new)
+        if g_new.to_process:
+            tracer.switch_sample('matching', g_new.sample_name)
+            with metrics.stage('matching'):
+                g_new.find_matching_rules(None, amrfp_nodes, mutation_index=new_index)
+                g_old.find_matching_rules(None, amrfp_nodes, mutation_index=old_index)
+        new_rows.append(g_new)
+        old_rows.append(g_old)
+    tracer.end_sample('matching')
+    return new_rows, old_rows
+
+
+def summarise(genotype_rows, rules, args, card_drug_map, card_amrfp_conversion, metrics, tracer=NULL_TRACER, genotype_templates=None,
+              drug_filter=None, combination_rules=None):
+    """Expand and summarise matched rows, as for the genome summary report. Returns the summary entries per sample."""
+    if genotype_templates is None:
+        genotype_templates = GenotypeTemplates(card_drug_map, card_amrfp_conversion, args.no_rule_interpretation)
+    if drug_filter:
+        drug_filter.select(genotype_rows, genotype_templates)
+    with metrics.stage('genotype_expansion'):
+        genotype_objects = expand_genotypes(genotype_rows, card_drug_map, card_amrfp_conversion, args.no_rule_interpretation,
+                                            tracer=tracer, drug_filter=drug_filter, genotype_templates=genotype_templates)
+        grouped_by_sample = defaultdict(list)
+        for geno_obj in genotype_objects:
+            grouped_by_sample[geno_obj.sample_name].append(geno_obj)
+    with metrics.stage('summarisation'):
+        return create_summary_dict(grouped_by_sample, rules, args.flag_core, args.no_rule_interpretation, tracer=tracer,
+                                   combination_rules=combination_rules)
+
+
+class ComparisonCounts:
+    """Aggregate counts of the differences between the two rulesets' summaries."""
+
+    def __init__(self):
+        self.samples = 0
+        self.samples_changed = 0
+        self.entries = Counter() # key: unchanged/added/removed/changed
+        self.fields = Counter() # key: column name, value: number of changed entries where it differs
+        self.category_transitions = Counter() # key: (old category, new category)
+
+    def rows(self):
+        """The counts as (measure, value) rows for the counts report."""
+        rows = [('samples compared', self.samples), ('samples with changes', self.samples_changed)]
+        rows += [(f"entries {change}", self.entries[change]) for change in ('unchanged', 'changed', 'added', 'removed')]
+        rows += [(f"{name} changed", self.fields[name]) for _, name in COMPARED_FIELDS]
+        rows += [(f"clinical category {old} -> {new}", n) for (old, new), n in sorted(self.category_transitions.items())]
+        return rows
+
+
+def _entries_by_key(entries):
+    return {(e.drug_class, e.drug): e for e in entries}
+
+
+def compare_sample(sample, old_entries, new_entries, counts):
+    """Yield a report row for each summary entry of the sample that was added, removed or changed by the new rules."""
+    old_by_key = _entries_by_key(old_entries)
+    new_by_key = _entries_by_key(new_entries)
+    changed_sample = False
+    # entries in the order of the new summary, then any only in the old summary
+    keys = list(new_by_key) + [key for key in old_by_key if key not in new_by_key]
+    for key in keys:
+        old, new = old_by_key.get(key), new_by_key.get(key)
+        if old is None:
+            change, changed_fields = 'added', [name for _, name in COMPARED_FIELDS]
+        elif new is None:
+            change, changed_fields = 'removed', [name for _, name in COMPARED_FIELDS]
+        else:
+            changed_fields = [name for attr, name in COMPARED_FIELDS if getattr(old, attr) != getattr(new, attr)]
+            change = 'changed' if changed_fields else 'unchanged'
+        counts.entries[change] += 1
+        if change == 'unchanged':
+            continue
+        changed_sample = True
+        if change == 'changed':
+            counts.fields.update(changed_fields)
+            if old.category != new.category:
+                counts.category_transitions[(old.category, new.category)] += 1
+        row = {'sample': sample, 'drug': key[1], 'drug class': key[0], 'change': change, 'changed fields': ';'.join(changed_fields),
+               'organism': (new or old).organism}
+        for attr, name in COMPARED_FIELDS:
+            row[f"old {name}"] = getattr(old, attr) if old else '-'
+            row[f"new {name}"] = getattr(new, attr) if new else '-'
+        yield row
+    counts.samples += 1
+    counts.samples_changed += changed_sample
+
+
+def compare_rulesets(rows, args, organism_dict, skipped_samples, new_rules, old_rules, amrfp_nodes, card_drug_map,
+                     card_amrfp_conversion, metrics, tracer=NULL_TRACER, mutation_index=None, genotype_templates=None):
+    """
+    Interpret the input rows with both rulesets one sample at a time, writing each sample's per-drug differences to
+    <prefix>_rules_comparison.tsv as soon as it's done, and the aggregate counts to <prefix>_rules_comparison_counts.tsv
+    at the end. Like --ndjson, this needs all of a sample's rows to be together in the input.
+    Returns the paths to both reports, the comparison counts and the counts for the run summary.
+    """
+    new_index = mutation_index if mutation_index is not None else MutationRuleIndex(new_rules)
+    old_index = MutationRuleIndex(old_rules)
+    new_combination_rules = get_combination_rules(new_rules)
+    old_combination_rules = get_combination_rules(old_rules)
+    # templates are per rule, so the same templates do for both rulesets
+    if genotype_templates is None:
+        genotype_templates = GenotypeTemplates(card_drug_map, card_amrfp_conversion, args.no_rule_interpretation)
+    drug_filter = DrugFilter.from_args(args)
+
+    counts = ComparisonCounts()
+    run_counts = {'rows': 0, 'samples': 0, 'matched': 0, 'unmatched': 0}
+    seen_samples = set()
+    report_file = os.path.join(args.output_dir, args.output_prefix + '_rules_comparison.tsv')
+    with open(report_file, 'w', newline='') as out:
+        writer = csv.DictWriter(out, fieldnames=REPORT_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        for name, sample_rows in groupby(rows, key=lambda row: row.get('Name', '')):
+            if name in seen_samples:
+                raise ValueError(
+                    f"Sample {name} has rows in more than one place in the input file. --compare-rules compares each sample once all "
+                    f"its rows have been read, so needs all of a sample's rows to be together (eg sort the input by the Name column).")
+            seen_samples.add(name)
+            new_rows, old_rows = match_both(sample_rows, args, organism_dict, skipped_samples, new_index, old_index, amrfp_nodes,
+                                            metrics, tracer)
+            new_summary = summarise(new_rows, new_rules, args, card_drug_map, card_amrfp_conversion, metrics, tracer,
+                                    genotype_templates, drug_filter, new_combination_rules)
+            old_summary = summarise(old_rows, old_rules, args, card_drug_map, card_amrfp_conversion, metrics, tracer,
+                                    genotype_templates, drug_filter, old_combination_rules)
+            with metrics.stage('write_comparison'):
+                for sample in list(new_summary) + [s for s in old_summary if s not in new_summary]:
+                    writer.writerows(compare_sample(sample, old_summary.get(sample, []), new_summary.get(sample, []), counts))
+                out.flush()
+            run_counts['rows'] += len(new_rows)
+            run_counts['samples'] += len({g.sample_name for g in new_rows if g.to_process})
+            run_counts['matched'] += sum(1 for g in new_rows if g.matched_rules)
+            run_counts['unmatched'] += sum(1 for g in new_rows if not g.matched_rules)
+
+    counts_file = os.path.join(args.output_dir, args.output_prefix + '_rules_comparison_counts.tsv')
+    with open(counts_file, 'w', newline='') as out:
+        writer = csv.writer(out, delimiter='\t')
+        writer.writerow(['measure', 'count'])
+        writer.writerows(counts.rows())
+    return report_file, counts_file, counts, run_counts
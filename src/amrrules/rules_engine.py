@@ -1,151 +1,457 @@
-from amrrules.rules_io import parse_rules_file, extract_relevant_rules
-from amrrules.summariser import create_summary_dict
+from amrrules.rules_io import parse_rules_file, extract_relevant_rules, get_rule_files, rules_digest, rule_drugs
+from amrrules.summariser import create_summary_dict, get_combination_rules
 from amrrules.utils import check_sample_ids, validate_amrfp_file, get_organisms, open_input
-from amrrules.output import write_genotype_report, write_genome_report
-from amrrules.resources import ResourceManager as rm
-from amrrules.genotype_parser import GenoResult, Genotype
+from amrrules.output import write_genotype_report, write_genome_report, write_rule_stats, write_cohort_summary, wants_output, is_partitioned
+from amrrules.resources import ResourceManager as rm, get_registry
+from amrrules.genotype_parser import GenoResult, Genotype, GenotypeTemplates
+from amrrules.interpreted_report import AnnotationFragments
+from amrrules.metrics import RunMetrics, RuleStats
+from amrrules.tracing import Tracer, NULL_TRACER
+from amrrules.checkpoint import Checkpoint, run_fingerprint, iter_sample_batches
+from amrrules.sample_index import load_index, parse_sample_list, default_index_path
+from amrrules.drug_filter import DrugFilter
+from amrrules.cohort_summary import CohortSummary
+from amrrules.partitioned_output import PartitionedOutput
+from amrrules.mutation_ranges import MutationRuleIndex
+from amrrules.startup import LoadGraph
+from amrrules.ndjson_output import NdjsonWriter
+from amrrules.sqlite_output import SqliteStore
 import csv
-from importlib import resources
+import os
+import warnings
 from collections import defaultdict
+from itertools import groupby
 
-def run(args):
+def expand_genotypes(genotype_rows, card_drug_map, card_amrfp_conversion, no_rule_interpretation, tracer=NULL_TRACER, drug_filter=None,
+                     genotype_templates=None):
+    """
+    Create one Genotype object per matched rule (or per AMRFP subclass, if there was no matching rule)
+    for each processed GenoResult row, so that we can summarise by drug or drug class.
+    With a drug_filter, only the rules/subclasses it selected for each row are expanded.
+    """
+    if genotype_templates is None:
+        genotype_templates = GenotypeTemplates(card_drug_map, card_amrfp_conversion, no_rule_interpretation)
+    genotype_objects = []
+    for g in genotype_rows:
+        if g.to_process:
+            tracer.switch_sample('genotype_expansion', g.sample_name)
+            if g.matched_rules:
+                duplicated_row = False
+                if len(g.matched_rules) > 0:
+                        # switch on duplicated
+                        duplicated_row = True
+                for rule in (g.selected_rules if drug_filter else g.matched_rules):
+                    geno_obj = Genotype.from_template(g, genotype_templates.rule_template(rule, g.amrfp_class), rule=rule,
+                                                      duplicated=duplicated_row)
+                    genotype_objects.append(geno_obj)
+            else:
+                # extract the subclasses and split as needed
+                g_subclasses = g.selected_subclasses if drug_filter else g.amrfp_subclass.split('/')
+                for subclass in g_subclasses:
+                    template = genotype_templates.subclass_template(subclass, g.variation_type, g.subtype, g.partial)
+                    geno_obj = Genotype.from_template(g, template, amrfp_subclass=subclass)
+                    genotype_objects.append(geno_obj)
+    tracer.end_sample('genotype_expansion')
+    return genotype_objects
+
+def parse_row(row, args, organism_dict, skipped_samples):
+    """Parse one input row into a GenoResult, marking it not to be processed or printed if its sample is being skipped."""
+    if args.sample_id:
+        row_to_process = GenoResult(row, args.amr_tool, organism_dict, args.print_non_amr, args.full_disrupt, sample_name=args.sample_id)
+    else:
+        row_to_process = GenoResult(row, args.amr_tool, organism_dict, args.print_non_amr, args.full_disrupt)
+    # if this row belongs to a sample we should skip, update the to_process and to_print attributes to False
+    if skipped_samples and row_to_process.sample_name in skipped_samples:
+        row_to_process.to_process = False
+        row_to_process.print_row = False
+    return row_to_process
+
+def process_rows(rows, args, organism_dict, skipped_samples, rules, amrfp_nodes, card_drug_map, card_amrfp_conversion,
+                 metrics=None, tracer=NULL_TRACER, rule_stats=None, mutation_index=None, cohort_summary=None,
+                 genotype_templates=None, annotation_fragments=None, combination_rules=None):
+    """
+    Match, annotate, expand and summarise an iterable of input rows: either the whole input file, or one batch of
+    samples when checkpointing. Returns a dict with the annotated output rows, the summary entries per sample,
+    the matched/unmatched hits and counts for the run summary. Each sample's summary is also added to the
+    cohort_summary aggregates, if given.
+    """
+    if metrics is None:
+        metrics = RunMetrics(enabled=False)
+    if rule_stats is None:
+        rule_stats = RuleStats()
+    if genotype_templates is None:
+        genotype_templates = GenotypeTemplates(card_drug_map, card_amrfp_conversion, args.no_rule_interpretation)
+    if combination_rules is None:
+        combination_rules = get_combination_rules(rules)
+    matched_hits = {}
+    unmatched_hits = []
+    genotype_rows = []
+    # key: organism, value: its rules. Only needed without a rule index, as find_matching_rules looks them up in that
+    relevant_rules = {}
+    row_count = 1
+    for row in rows:
+        row_to_process = parse_row(row, args, organism_dict, skipped_samples)
+        # we only want to find matched rules for a row if it's relevant for AMR, so check this value first
+        # also make sure it's not a row belonging to a sample we should skip
+        if row_to_process.to_process:                
+            tracer.switch_sample('matching', row_to_process.sample_name)
+            with metrics.stage('matching'), tracer.span('matching:find_matching_rules', marker=row_to_process.marker_amrrules) as span:
+                # extract the relevant rules for this ID, based on its organism, once per organism
+                if mutation_index is None and row_to_process.organism not in relevant_rules:
+                    relevant_rules[row_to_process.organism] = extract_relevant_rules(rules, row_to_process.organism)
+                # determine if there's a matching rule for this row (this sets row_to_process.matched_rules)
+                row_to_process.find_matching_rules(relevant_rules.get(row_to_process.organism), amrfp_nodes, mutation_index=mutation_index)
+                if tracer.enabled:
+                    span['hierarchy_depth'] = row_to_process.hierarchy_depth
+            rule_stats.record_match(row_to_process)
+        
+        # track matched / unmatched hits for reporting
+        # create a result row for each matched rule, as we need to duplicate rows in output
+        # if they have multiple matching rules
+        if row_to_process.matched_rules:
+            matched_hits[row_count] = row_to_process.matched_rules
+        # if there's no matching rule, or it's a row we don't process, still create a ResultRow, but it has no rule
+        else:
+            unmatched_hits.append(row.get('Hierarchy node'))
+
+        # keep Genotype objects in case we need them later
+        genotype_rows.append(row_to_process)
+        row_count += 1
+    tracer.end_sample('matching')
+
+    # with --drugs/--drug-classes, decide which rules/subclasses of each row we keep before expanding or annotating anything
+    drug_filter = DrugFilter.from_args(args)
+    if drug_filter:
+        with metrics.stage('drug_filter'):
+            drug_filter.select(genotype_rows, genotype_templates)
+
+    # annotate and get all the output rows together into a single list, only if we're writing the interpreted report
+    genotype_output_rows = []
+    if wants_output(args, 'interpreted'):
+        if annotation_fragments is None:
+            annotation_fragments = AnnotationFragments(args.annot_opts)
+        with metrics.stage('annotation'):
+            for g in genotype_rows:
+                if drug_filter:
+                    # only rows with something in the selected drugs/classes, annotated with just those rules
+                    if not (g.selected_rules or g.selected_subclasses):
+                        continue
+                    g.annotate_row(args.annot_opts, rules=g.selected_rules if g.matched_rules else None, fragments=annotation_fragments)
+                else:
+                    g.annotate_row(args.annot_opts, fragments=annotation_fragments)
+                if g.print_row:
+                    genotype_output_rows.extend(g.annotated_row)
+
+    genotype_objects = []
+    summary_entry_dict = {}
+    summary_counts = {'deduplicated': 0}
+    if wants_output(args, 'summary'):
+        # we now want to create one object per rule/AMRFP subclass, so that we can summarise by drug or drug class.
+        with metrics.stage('genotype_expansion'):
+            genotype_objects = expand_genotypes(genotype_rows, card_drug_map, card_amrfp_conversion, args.no_rule_interpretation, tracer=tracer, drug_filter=drug_filter,
+                                                genotype_templates=genotype_templates)
+
+            # now we want to group all of these objects by sample ID (if we have multiple samples)
+            # because we need to summarise per genome
+            # then we want to group by drug, or drug class if drug is '-', in each sample
+            grouped_by_sample = defaultdict(list)
+            for geno_obj in genotype_objects:
+                grouped_by_sample[geno_obj.sample_name].append(geno_obj)
+
+        with metrics.stage('summarisation'):
+            summary_entry_dict = create_summary_dict(grouped_by_sample, rules, args.flag_core, args.no_rule_interpretation, tracer=tracer, rule_stats=rule_stats, counts=summary_counts,
+                                                     cohort_summary=cohort_summary, combination_rules=combination_rules)
+    else:
+        rule_stats.samples += len({g.sample_name for g in genotype_rows if g.to_process})
+
+    return {
+        'output_rows': genotype_output_rows,
+        'summary_entry_dict': summary_entry_dict,
+        'matched_hits': matched_hits,
+        'unmatched_hits': unmatched_hits,
+        'counts': {
+            'rows': row_count - 1,
+            'samples': len({g.sample_name for g in genotype_rows if g.to_process}),
+            'genotypes': len(genotype_objects),
+            'matched': len(matched_hits),
+            'unmatched': len(unmatched_hits),
+            'deduplicated': summary_counts['deduplicated'],
+        },
+    }
+
+def write_partitions(args, organism_dict, result, base_fieldnames):
+    """Write the interpreted rows and summary entries from process_rows into each sample's partition."""
+    partitions = PartitionedOutput(args, organism_dict)
+    try:
+        partitions.write_interpreted(result['output_rows'], base_fieldnames)
+        partitions.write_summary(result['summary_entry_dict'])
+    finally:
+        partitions.close()
+    return partitions
+
+def merge_results(total, result):
+    """Add the results of process_rows for some samples onto the results for the samples before them."""
+    offset = total['counts']['rows']
+    total['output_rows'].extend(result['output_rows'])
+    total['summary_entry_dict'].update(result['summary_entry_dict'])
+    total['matched_hits'].update((row + offset, rules) for row, rules in result['matched_hits'].items())
+    total['unmatched_hits'].extend(result['unmatched_hits'])
+    for name, n in result['counts'].items():
+        total['counts'][name] += n
+    return total
+
+def stream_samples(rows, ndjson, args, organism_dict, skipped_samples, rules, amrfp_nodes, card_drug_map, card_amrfp_conversion, **kwargs):
+    """
+    Interpret the input one sample at a time, writing each sample's results to the NDJSON stream as soon as it's
+    done. Returns the results for the whole input, as process_rows does for it in one go.
+    """
+    total = {'output_rows': [], 'summary_entry_dict': {}, 'matched_hits': {}, 'unmatched_hits': [],
+             'counts': {'rows': 0, 'samples': 0, 'genotypes': 0, 'matched': 0, 'unmatched': 0, 'deduplicated': 0}}
+    seen_samples = set()
+    for name, sample_rows in groupby(rows, key=lambda row: row.get('Name', '')):
+        if name in seen_samples:
+            raise ValueError(
+                f"Sample {name} has rows in more than one place in the input file. --ndjson streams each sample once all "
+                f"its rows have been read, so needs all of a sample's rows to be together (eg sort the input by the Name column).")
+        seen_samples.add(name)
+        result = process_rows(sample_rows, args, organism_dict, skipped_samples, rules, amrfp_nodes, card_drug_map,
+                              card_amrfp_conversion, **kwargs)
+        ndjson.write_sample(args.sample_id or name or 'sample', result)
+        merge_results(total, result)
+    return total
+
+def select_samples(args):
+    """
+    Validate the input file, and work out which samples to interpret. Returns the samples in the input that will
+    be parsed, the samples selected with --samples (or None for all of them) and the sample index to read them
+    with, if there is one. With an up to date index, the input doesn't need to be scanned at all.
+    """
+    if not getattr(args, 'samples', None):
+        return validate_amrfp_file(args.input, multi_entry=bool(args.organism_file)), None, None
 
-    # extract all the rules relevant to the organisms we're processing
+    selected_samples = parse_sample_list(args.samples)
+    sample_index = load_index(args.input, args.sample_index)
+    if sample_index:
+        if 'Hierarchy node' not in sample_index.fieldnames:
+            raise ValueError("Input AMRFinderPlus file is missing required column: 'Hierarchy node'. Please re-run AMRFinderPlus with the --print_node option to ensure this column is in the output file.")
+        samples_in_file = set(sample_index.samples)
+    else:
+        if args.sample_index:
+            raise ValueError(f"Sample index {args.sample_index} not found (or out of date with the input). Create it with: amrrules index {args.input} --output {args.sample_index}")
+        if not os.path.exists(default_index_path(args.input)):
+            print("No sample index found for the input, so it will be scanned for the selected samples. Run amrrules index on it first to skip this.")
+        samples_in_file = validate_amrfp_file(args.input, multi_entry=bool(args.organism_file))
+        if not samples_in_file:
+            raise ValueError("--samples needs an input file with a 'Name' column, to select samples from.")
+    missing_samples = selected_samples - samples_in_file
+    if missing_samples:
+        warnings.warn(f"The following samples were selected but aren't in the input file:\n{'\n'.join(sorted(missing_samples))}")
+    return samples_in_file & selected_samples, selected_samples, sample_index
+
+def run(args, ndjson_stdout=None):
+
+    # collect per-stage timings for the run report, only if the user has asked for one
+    metrics = RunMetrics(enabled=bool(args.metrics_json))
+    metrics.options = {k: v for k, v in vars(args).items() if k != 'metrics_json'}
+    # record per-sample spans for profiling, only if the user has asked for a trace
+    tracer = Tracer(enabled=bool(args.trace))
+    # cheap counters of which rules are hit and how they were matched
+    rule_stats = RuleStats()
+    # cohort-level aggregates of the genome summary, only if the user has asked for them
+    cohort_summary = CohortSummary() if args.cohort_summary else None
+
+    # the organism file, input validation, reference data and rules are mostly independent, so load them
+    # concurrently, each step starting as soon as the steps it needs are done
+    loads = LoadGraph(metrics)
     if args.organism_file:
         print("\nLoading organism assignments...")
-        organism_dict, skipped_samples = get_organisms(args.organism_file)
-        samples_with_org = set(organism_dict.keys())
+        loads.add('organisms', lambda: get_organisms(args.organism_file), stage='load_organisms')
     else:
-        organism_dict = {'': args.organism}
-        samples_with_org = None
-        skipped_samples = None
+        loads.add('organisms', lambda: ({'': args.organism}, None))
     
     if args.amr_tool == 'amrfp':
-        try:
-            # then we need to grab the refgene heirarchy direct from the ncbi website (get latest for now)
-            #TODO: user specifies version of amrfp database they used, or we extract this from hamronized file
-            print("\nLoading AMRFinderPlus reference data...")
-            amrfp_nodes = rm().refseq_nodes()
-            # check the input file has the Hierarchy node column, and if an organism file is included, that the first column is Name
-            samples_to_parse = validate_amrfp_file(args.input, multi_entry=bool(args.organism_file))
-            
-            # get the AMRFP to CARD conversion mapping for later use - we only want to do this once
-            # so do it here and pass this to where it's needed
-            card_amrfp_conversion = rm().get_amrfp_card_conversion() # get the AMRFP to CARD conversion mapping
-            card_drug_map = rm().get_card_drug_class_map() # get CARD drugs and their associated classes
-        except FileNotFoundError as exc:
-            missing = f"\nMissing file: {exc.filename}" if getattr(exc, "filename", None) else ""
-            raise SystemExit(
-                "Required resource files were not found.\n"
-                "Please run: amrrules --download-resources\n"
-                "Then rerun your original command."
-                f"{missing}\n"
-                f"Details: {exc}"
-            ) from None
+        # then we need to grab the refgene heirarchy direct from the ncbi website (get latest for now)
+        print("\nLoading AMRFinderPlus reference data...")
+        loads.add('resource_manager', lambda: rm(args.resource_dir, args.amrfp_db_version, args.card_version, shared_tables=args.shared_tables),
+                  resource=True)
+        loads.add('amrfp_nodes', lambda resource_manager: resource_manager.refseq_nodes(), deps=['resource_manager'],
+                  stage='load_hierarchy', resource=True)
+        # check the input file has the Hierarchy node column, and if an organism file is included, that the first column is Name
+        loads.add('samples', lambda: select_samples(args), stage='validate_input')
+        # get the AMRFP to CARD conversion mapping for later use - we only want to do this once
+        # so do it here and pass this to where it's needed
+        loads.add('card_amrfp_conversion', lambda resource_manager: resource_manager.get_amrfp_card_conversion(),
+                  deps=['resource_manager'], stage='load_card_conversion', resource=True)
+
+    # parse the rule files for the organisms we need, once we know what they are
+    print("\nParsing rule files...")
+    loads.add('rules', lambda organisms: parse_rules_file(get_rule_files(organisms[0].values())), deps=['organisms'],
+              stage='parse_rules')
+    # index the rules by the gene they are for, with interval trees for those covering a range of positions (eg p.(83_87)X)
+    loads.add('mutation_index', MutationRuleIndex, deps=['rules'], stage='index_rules')
+    rulesets = ['rules']
+    if args.compare_rules:
+        # the older rules to compare against, laid out like the packaged rules directory
+        loads.add('old_rules', lambda organisms: parse_rules_file(get_rule_files(organisms[0].values(), args.compare_rules), args.compare_rules),
+                  deps=['organisms'], stage='parse_old_rules')
+        rulesets.append('old_rules')
+    if args.amr_tool == 'amrfp':
+        # get the CARD classes of the drugs named in those rules, rather than of every drug in CARD
+        loads.add('card_drug_map', lambda resource_manager, *rulesets: resource_manager.get_card_drug_class_map(rule_drugs(*rulesets)),
+                  deps=['resource_manager', *rulesets], stage='load_card_drug_map', resource=True)
+        # work out what each rule (and AMRFP subclass) gives its genotypes in the summary, once rather than per hit
+        loads.add('genotype_templates', lambda card_drug_map, card_amrfp_conversion, *rulesets: GenotypeTemplates(
+                  card_drug_map, card_amrfp_conversion, args.no_rule_interpretation).prepare(*rulesets),
+                  deps=['card_drug_map', 'card_amrfp_conversion', *rulesets], stage='prepare_templates')
+    # and render each rule's annotation columns for the interpreted report
+    loads.add('annotation_fragments', lambda rules: AnnotationFragments(args.annot_opts).prepare(rules), deps=['rules'],
+              stage='prepare_fragments')
+    # the combination rules for each organism, for the genome summary
+    loads.add('combination_rules', get_combination_rules, deps=['rules'])
+
+    # a missing resource file is reported along with any others that are missing, as a prompt to download them
+    # (startup is the wall time until we can start matching, ie roughly the longest single load)
+    with metrics.stage('startup'):
+        loaded = loads.run()
+    organism_dict, skipped_samples = loaded['organisms']
+    samples_with_org = set(organism_dict.keys()) if args.organism_file else None
+    if args.amr_tool == 'amrfp':
+        resource_manager = loaded['resource_manager']
+        amrfp_nodes = loaded['amrfp_nodes']
+        samples_to_parse, selected_samples, sample_index = loaded['samples']
+        card_amrfp_conversion = loaded['card_amrfp_conversion']
+        card_drug_map = loaded['card_drug_map']
+        genotype_templates = loaded['genotype_templates']
+    rules = loaded['rules']
+    mutation_index = loaded['mutation_index']
+    annotation_fragments = loaded['annotation_fragments']
+    combination_rules = loaded['combination_rules']
+    old_rules = loaded.get('old_rules')
     
     # if the is a multi-entry file, we need to check that all our sampleIDs are in the organism file
     # will raise an error if any are missing
     # will raise a warning if there are samples in the org file but aren't in the input file
     if args.organism_file:
+        if selected_samples is not None:
+            # only warn about organism file samples we were asked for
+            samples_with_org = samples_with_org & selected_samples
         check_sample_ids(samples_with_org, samples_to_parse, skipped_samples)
 
-    # collate unique rule files required for the organisms we need to parse
-    rule_files = set()
-    # open the rules key file and get the organism name
-    key_file_path = resources.files("amrrules.rules").joinpath("rule_key_file.tsv")
-    with open(key_file_path, 'r') as key_file:
-        for row in key_file:
-            # split the row into the organism and rules file
-            organism, rules_filename = row.strip().split('\t')
-            # if it's an organism we're interested in, add its rules file (only if it's not already)
-            if organism in set(organism_dict.values()):
-                rule_files.add(rules_filename)
-
-    # parse the rule files
-    print("\nParsing rule files...")
-    rules = parse_rules_file(rule_files)
-
-    matched_hits = {}
-    unmatched_hits = []
-    genotype_rows = []
     # now it's time to parse the input file, which we have validated to check that it has
     # the columns we need. Each row will be parsed into an InputRow object
+    # the results store, which keeps the results of each run alongside those from earlier runs
+    sqlite_store = None
+    if args.sqlite:
+        sqlite_store = SqliteStore(args.sqlite, args, organism_dict, rules_digest(get_rule_files(organism_dict.values())),
+                                   {'amrfp': resource_manager.get_amrfp_db_version(), 'card': resource_manager.card_dir.name})
+
     print("\nMatching markers to rules...")
     with open_input(args.input) as f:
         reader = csv.DictReader(f, delimiter='\t')
         base_fieldnames = reader.fieldnames.copy()
-        row_count = 1
-        for row in reader:
-            if args.sample_id:
-                row_to_process = GenoResult(row, args.amr_tool, organism_dict, args.print_non_amr, args.full_disrupt, sample_name=args.sample_id)
-            else:
-                row_to_process = GenoResult(row, args.amr_tool, organism_dict, args.print_non_amr, args.full_disrupt)
-            # if this row belongs to a sample we should skip, update the to_process and to_print attributes to False
-            if skipped_samples and row_to_process.sample_name in skipped_samples:
-                row_to_process.to_process = False
-                row_to_process.print_row = False
-            # we only want to find matched rules for a row if it's relevant for AMR, so check this value first
-            # also make sure it's not a row belonging to a sample we should skip
-            if row_to_process.to_process:                
-                # extract the relevant rules for this ID, based on its organism
-                relevant_rules = extract_relevant_rules(rules, row_to_process.organism)
-                # determine if there's a matching rule for this row (this sets row_to_process.matched_rules)
-                row_to_process.find_matching_rules(relevant_rules, amrfp_nodes)
-            
-            row_to_process.annotate_row(args.annot_opts)
-
-            # track matched / unmatched hits for reporting
-            # create a result row for each matched rule, as we need to duplicate rows in output
-            # if they have multiple matching rules
-            if row_to_process.matched_rules:
-                matched_hits[row_count] = row_to_process.matched_rules
-            # if there's no matching rule, or it's a row we don't process, still create a ResultRow, but it has no rule
+        if sample_index:
+            # read only the selected samples' rows, straight from their byte ranges
+            reader = sample_index.iter_rows(selected_samples)
+        elif selected_samples is not None:
+            reader = (row for row in reader if row.get('Name') in selected_samples)
+        if args.compare_rules:
+            # interpret each row with both rulesets, and report the differences instead of the usual reports
+            from amrrules.rule_comparison import compare_rulesets
+            comparison_file, comparison_counts_file, comparison_counts, run_counts = compare_rulesets(
+                reader, args, organism_dict, skipped_samples, rules, old_rules, amrfp_nodes, card_drug_map,
+                card_amrfp_conversion, metrics, tracer=tracer, mutation_index=mutation_index,
+                genotype_templates=genotype_templates)
+            genotype_output_file = summary_output_file = None
+        elif args.checkpoint_dir:
+            # process the input in batches of samples, committing the outputs for each batch as we go
+            resource_versions = {'amrfp': resource_manager.get_amrfp_db_version(), 'card': resource_manager.card_dir.name}
+            checkpoint = Checkpoint(args.checkpoint_dir, run_fingerprint(args, resource_versions, selected_samples), resume=args.resume)
+            batches = iter_sample_batches(reader, args.checkpoint_batch_size, checkpoint.completed_samples, checkpoint.rows_done)
+            run_counts = {}
+            for batch_rows, batch_samples in batches:
+                batch_rule_stats = RuleStats()
+                batch_cohort_summary = CohortSummary() if args.cohort_summary else None
+                result = process_rows(batch_rows, args, organism_dict, skipped_samples, rules, amrfp_nodes, card_drug_map,
+                                      card_amrfp_conversion, metrics=metrics, tracer=tracer, rule_stats=batch_rule_stats,
+                                      mutation_index=mutation_index, cohort_summary=batch_cohort_summary,
+                                      genotype_templates=genotype_templates, annotation_fragments=annotation_fragments,
+                                      combination_rules=combination_rules)
+                if is_partitioned(args):
+                    # batches never split a sample, so each sample's partition is complete once its batch is written
+                    with metrics.stage('write_partitions'), tracer.span('write:partitions', samples=len(batch_samples)):
+                        write_partitions(args, organism_dict, result, base_fieldnames)
+                if sqlite_store:
+                    # before the batch is committed, so a batch is never checkpointed without being stored (storing is an upsert)
+                    with metrics.stage('write_sqlite'), tracer.span('write:sqlite', samples=len(batch_samples)):
+                        sqlite_store.write_results(result['output_rows'], result['summary_entry_dict'])
+                with metrics.stage('write_checkpoint'), tracer.span('write:checkpoint', samples=len(batch_samples)):
+                    checkpoint.commit_batch(args, result['output_rows'], base_fieldnames, result['summary_entry_dict'],
+                                            batch_rule_stats, result['counts']['rows'], batch_samples, result['counts'],
+                                            cohort_summary=batch_cohort_summary)
+                rule_stats.merge(batch_rule_stats)
+                for name, n in result['counts'].items():
+                    run_counts[name] = run_counts.get(name, 0) + n
+                print(f"Checkpointed {checkpoint.totals()['rows']} rows ({len(checkpoint.completed_samples)} samples).")
+            if not checkpoint.manifest['batches']:
+                # empty input, commit an empty batch so the reports still get their headers
+                checkpoint.commit_batch(args, [], base_fieldnames, {}, RuleStats(), 0, [], {'rows': 0},
+                                        cohort_summary=CohortSummary() if args.cohort_summary else None)
+        else:
+            if args.ndjson:
+                # interpret one sample at a time, streaming each out as JSON lines as soon as it's done
+                ndjson = NdjsonWriter.open(args.ndjson, args, base_fieldnames, stdout=ndjson_stdout)
+                try:
+                    result = stream_samples(reader, ndjson, args, organism_dict, skipped_samples, rules, amrfp_nodes, card_drug_map,
+                                            card_amrfp_conversion, metrics=metrics, tracer=tracer, rule_stats=rule_stats,
+                                            mutation_index=mutation_index, cohort_summary=cohort_summary,
+                                            genotype_templates=genotype_templates, annotation_fragments=annotation_fragments,
+                                            combination_rules=combination_rules)
+                finally:
+                    ndjson.close()
             else:
-                unmatched_hits.append(row.get('Hierarchy node'))
-
-            # keep Genotype objects in case we need them later
-            genotype_rows.append(row_to_process)
-            row_count += 1
-    
-    # get all the output rows together into a single list
-    genotype_output_rows = []
-    for g in genotype_rows:
-        if g.print_row:
-            genotype_output_rows.extend(g.annotated_row)
-
-    # now write out the interpreted genotype report, which annotates each row with the rule info
-    genotype_output_file = write_genotype_report(args, genotype_output_rows, unmatched_hits, matched_hits, base_fieldnames)
-
-    # we now want to create one object per rule/AMRFP subclass, so that we can summarise by drug or drug class.
-    genotype_objects = []
-    for g in genotype_rows:
-        if g.to_process:
-            if g.matched_rules:
-                duplicated_row = False
-                if len(g.matched_rules) > 0:
-                        # switch on duplicated
-                        duplicated_row = True
-                for rule in g.matched_rules:
-                    geno_obj = Genotype.from_result_row(g, card_map=card_drug_map, rule=rule, duplicated = duplicated_row)
-                    genotype_objects.append(geno_obj)
-            else:
-                # extract the subclasses and split as needed
-                g_subclasses = g.amrfp_subclass.split('/')
-                for subclass in g_subclasses:
-                    geno_obj = Genotype.from_result_row(g, card_amrfp=card_amrfp_conversion, amrfp_subclass=subclass, no_rule_interp=args.no_rule_interpretation)
-                    genotype_objects.append(geno_obj)
-
-    # now we want to group all of these objects by sample ID (if we have multiple samples)
-    # because we need to summarise per genome
-    # then we want to group by drug, or drug class if drug is '-', in each sample
-    grouped_by_sample = defaultdict(list)
-    for geno_obj in genotype_objects:
-        grouped_by_sample[geno_obj.sample_name].append(geno_obj)
+                result = process_rows(reader, args, organism_dict, skipped_samples, rules, amrfp_nodes, card_drug_map,
+                                      card_amrfp_conversion, metrics=metrics, tracer=tracer, rule_stats=rule_stats, mutation_index=mutation_index,
+                                      cohort_summary=cohort_summary, genotype_templates=genotype_templates,
+                                      annotation_fragments=annotation_fragments, combination_rules=combination_rules)
+            run_counts = result['counts']
+            if sqlite_store:
+                with metrics.stage('write_sqlite'), tracer.span('write:sqlite', samples=len(result['summary_entry_dict'])):
+                    sqlite_store.write_results(result['output_rows'], result['summary_entry_dict'])
+            genotype_output_file = summary_output_file = None
+            if is_partitioned(args):
+                # one pair of reports per sample, in organism=.../sample=... directories
+                with metrics.stage('write_partitions'), tracer.span('write:partitions', samples=len(result['summary_entry_dict'])):
+                    write_partitions(args, organism_dict, result, base_fieldnames)
+            # now write out the interpreted genotype report, which annotates each row with the rule info
+            elif wants_output(args, 'interpreted'):
+                with metrics.stage('write_interpreted'), tracer.span('write:interpreted', rows=len(result['output_rows'])):
+                    genotype_output_file = write_genotype_report(args, result['output_rows'], result['unmatched_hits'], result['matched_hits'], base_fieldnames)
+            if wants_output(args, 'summary') and not is_partitioned(args):
+                with metrics.stage('write_genome_summary'), tracer.span('write:genome_summary', samples=len(result['summary_entry_dict'])):
+                    summary_output_file = write_genome_report(result['summary_entry_dict'], args.output_dir, args.output_prefix)
 
+    if args.checkpoint_dir:
+        # put the final reports together from the batches, including any completed in earlier runs
+        with metrics.stage('assemble_checkpoint'):
+            genotype_output_file, summary_output_file, all_rule_stats, cohort_summary = checkpoint.assemble(args)
+        totals = checkpoint.totals()
+    else:
+        all_rule_stats = rule_stats
+        totals = run_counts
 
-    summary_entry_dict = create_summary_dict(grouped_by_sample, rules, args.flag_core, args.no_rule_interpretation)
-    
-    summary_output_file = write_genome_report(summary_entry_dict, args.output_dir, args.output_prefix)
+    # record row/sample throughput and resource cache usage for the run report
+    metrics.add_count('rows', run_counts.get('rows', 0))
+    metrics.add_count('samples', run_counts.get('samples', 0))
+    metrics.add_count('genotypes', run_counts.get('genotypes', 0))
+    # a share of the samples rather than something done per second, so it's left out of the throughput
+    metrics.add_count('deduplicated_samples', run_counts.get('deduplicated', 0), rate=False)
+    # over all batches of a checkpointed run, including any completed before it was resumed
+    metrics.add_count('combination_rule_evaluations', all_rule_stats.combination_evaluations, rate=False)
+    if args.amr_tool == 'amrfp':
+        for cache_name, stats in resource_manager.cache_stats.items():
+            metrics.add_cache_stats(cache_name, stats['hits'], stats['misses'])
+        registry = get_registry()
+        metrics.add_cache_stats('resource_registry', registry.hits, registry.misses)
 
     # print summary stats block
     num_skipped = len(skipped_samples) if skipped_samples is not None else 0
@@ -153,21 +459,56 @@ def run(args):
     print()
     print(ruler)
     print(f"  \033[1;38;2;255;140;0mRun summary\033[0m")
-    print(f"  Samples processed : {len(grouped_by_sample)}")
+    print(f"  Samples processed : {totals.get('samples', 0)}")
     print(f"  Samples skipped   : {num_skipped}")
-    print(f"  Markers matched   : {len(matched_hits)}")
-    print(f"  Markers unmatched : {len(unmatched_hits)}")
+    print(f"  Markers matched   : {totals.get('matched', 0)}")
+    print(f"  Markers unmatched : {totals.get('unmatched', 0)}")
+    print(f"  Samples deduped   : {totals.get('deduplicated', 0)}")
+    if args.compare_rules:
+        entries = comparison_counts.entries
+        print(f"  Samples changed   : {comparison_counts.samples_changed} of {comparison_counts.samples} (vs {args.compare_rules})")
+        print(f"  Entries changed   : {entries['changed']} changed, {entries['added']} added, {entries['removed']} removed")
     print()
     print(f"  \033[1;32mOutput files\033[0m")
-    print(f"  Interpreted genotype report   : {genotype_output_file}")
-    print(f"  Genome summary report         : {summary_output_file}")
+    if genotype_output_file:
+        print(f"  Interpreted genotype report   : {genotype_output_file}")
+    if is_partitioned(args):
+        print(f"  Per-sample reports            : {os.path.join(args.output_dir, args.output_prefix)}{os.sep}organism=*{os.sep}sample=*")
+    if summary_output_file:
+        print(f"  Genome summary report         : {summary_output_file}")
+    if args.ndjson:
+        print(f"  NDJSON stream                 : {'stdout' if args.ndjson == '-' else args.ndjson}")
+    if args.compare_rules:
+        print(f"  Rules comparison              : {comparison_file}")
+        print(f"  Rules comparison counts       : {comparison_counts_file}")
+    if args.cohort_summary:
+        cohort_summary_file = write_cohort_summary(cohort_summary, args.output_dir, args.output_prefix)
+        print(f"  Cohort summary                : {cohort_summary_file}")
+    if sqlite_store:
+        sqlite_store.close()
+        print(f"  Results store                 : {args.sqlite} (run {sqlite_store.run_id})")
+    if args.rule_stats:
+        rule_stats_file = write_rule_stats(all_rule_stats, args.output_dir, args.output_prefix)
+        print(f"  Rule stats                    : {rule_stats_file}")
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+        print(f"  Run metrics                   : {args.metrics_json}")
+    if args.trace:
+        tracer.write_json(args.trace)
+        print(f"  Run trace                     : {args.trace}")
     print(ruler)
     print("\nAMRrules complete.")
 
 
-def download_resources():
+def download_resources(args=None):
     """
     Download and cache the AMRFP and CARD database files required.
+    Versions already in the resource store are skipped.
     """
-    rm().setup_all_resources()
+    if args is None:
+        resource_manager = rm()
+    else:
+        # for downloads, the AMRFP version is the NCBI release directory (eg 4.0/2025-07-16.1) rather than the version name
+        resource_manager = rm(args.resource_dir, args.amrfp_db_version, args.card_version)
+    resource_manager.setup_all_resources()
     print("Resource download complete.")
\ No newline at end of file
@@ -1,20 +1,64 @@
 import csv
+import hashlib
 from importlib import resources
+from pathlib import Path
 
-def parse_rules_file(rule_file_list):
+def _rule_dir(rule_dir=None):
+    """The packaged rules directory, or another directory laid out the same way (eg the rules from an older release)."""
+    return resources.files("amrrules.rules") if rule_dir is None else Path(rule_dir)
+
+def get_rule_files(organisms, rule_dir=None):
+    """
+    Return the set of rule files (without the .tsv extension) needed for the given organisms, using the rules key file.
+    """
+    rule_files = set()
+    organisms = set(organisms)
+    # open the rules key file and get the organism name
+    key_file_path = _rule_dir(rule_dir).joinpath("rule_key_file.tsv")
+    with open(key_file_path, 'r') as key_file:
+        for row in key_file:
+            # split the row into the organism and rules file
+            organism, rules_filename = row.strip().split('\t')
+            # if it's an organism we're interested in, add its rules file (only if it's not already)
+            if organism in organisms:
+                rule_files.add(rules_filename)
+    return rule_files
+
+def parse_rules_file(rule_file_list, rule_dir=None):
     # get the correct rules file based on the organism, from the rules directory
     rules_parsed = []
     for rule_file in rule_file_list:
         rule_file_name = f"{rule_file}.tsv"
         try:
-            with resources.files("amrrules.rules").joinpath(rule_file_name).open('r', encoding='utf-8') as f:
+            with _rule_dir(rule_dir).joinpath(rule_file_name).open('r', encoding='utf-8') as f:
                 reader = csv.DictReader(f, delimiter='\t')
                 for row in reader:
                     rules_parsed.append(row)
         except FileNotFoundError:
-            raise FileNotFoundError(f"Rules file '{rule_file_name}' not found in packaged rules/")
+            raise FileNotFoundError(f"Rules file '{rule_file_name}' not found in {'packaged rules/' if rule_dir is None else rule_dir}")
     return rules_parsed
 
+def rules_digest(rule_file_list, rule_dir=None):
+    """
+    A short checksum of the contents of the rule files, identifying the exact ruleset a run used (the rules
+    ship with the package, but can differ between installs of the same version, eg from a development checkout).
+    """
+    digest = hashlib.sha256()
+    for rule_file in sorted(rule_file_list):
+        digest.update(rule_file.encode('utf-8') + b'\0')
+        digest.update(_rule_dir(rule_dir).joinpath(f"{rule_file}.tsv").read_bytes())
+    return digest.hexdigest()[:16]
+
+def rule_drugs(*rulesets):
+    """
+    The distinct drugs named by the rules (not '-'), ie the only drugs we need CARD drug classes for.
+    """
+    drugs = set()
+    for rules in rulesets:
+        drugs.update(rule.get('drug') for rule in rules)
+    drugs.difference_update(('-', None, ''))
+    return sorted(drugs)
+
 def extract_relevant_rules(rules, organism):
     """
     Extract relevant rules for a given organism from the rules list.
@@ -0,0 +1,230 @@
+"""
+Sample index sidecar files, so that a few samples can be read from a large input file without scanning all of it.
+
+The index (written by amrrules index) maps each sample Name to the byte ranges of its rows. Each range is stored as
+[access point, offset, length]: the access point is a position in the file that reading can start from, and offset
+is the number of (uncompressed) bytes from there to the start of the rows. For an uncompressed file the only access
+point is the start of the file, so the offset is the plain byte offset and rows are read straight from a memory map.
+For a gzipped file the access points are the starts of its gzip members, which for a BGZF file (eg compressed
+with bgzip) are its blocks, so the pair is the BGZF virtual offset. A file compressed with plain gzip is a single
+member, so it can be indexed but still has to be decompressed from the start.
+"""
+
+import bisect
+import csv
+import json
+import mmap
+import os
+import tempfile
+import warnings
+import zlib
+
+INDEX_SUFFIX = ".amrrules_index.json"
+INDEX_VERSION = 1
+READ_SIZE = 1024 * 1024
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def default_index_path(input_path):
+    return f"{input_path}{INDEX_SUFFIX}"
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def parse_sample_list(value):
+    """
+    Samples to interpret, from --samples: either a file with one sample name per line (only the first
+    tab-separated column is used, so an organism file works too), or a comma-separated list of names.
+    """
+    if os.path.isfile(value):
+        with open(value, 'r') as f:
+            samples = [line.rstrip('\n').split('\t')[0].strip() for line in f]
+    else:
+        samples = [s.strip() for s in value.split(',')]
+    return {s for s in samples if s}
+
+
+def _gzip_chunks(raw, access_points):
+    """
+    Decompress a gzip file (which may have many members) from the current position, yielding chunks of
+    uncompressed bytes. The compressed and uncompressed start of each member is appended to access_points.
+    """
+    cstart = raw.tell()
+    ustart = 0
+    access_points.append((cstart, 0))
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    while True:
+        chunk = raw.read(READ_SIZE)
+        if not chunk:
+            break
+        chunk_start = raw.tell() - len(chunk)
+        data = chunk
+        while data:
+            out = decompressor.decompress(data)
+            ustart += len(out)
+            if out:
+                yield out
+            if decompressor.eof:
+                # the rest of the data is the next member
+                unused = decompressor.unused_data
+                cstart = chunk_start + len(chunk) - len(unused)
+                access_points.append((cstart, ustart))
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                data = unused
+            else:
+                data = b''
+
+
+def _iter_lines(chunks):
+    """Yield (offset, line) for each line in a stream of byte chunks, with the offset of the line in the stream."""
+    pending = b''
+    pending_start = 0
+    for chunk in chunks:
+        pending += chunk
+        start = 0
+        while True:
+            end = pending.find(b'\n', start)
+            if end < 0:
+                break
+            yield pending_start + start, pending[start:end + 1]
+            start = end + 1
+        pending_start += start
+        pending = pending[start:]
+    if pending:
+        yield pending_start, pending
+
+
+def build_index(input_path, index_path=None):
+    """
+    Scan the input file once and write an index of the byte ranges of each sample's rows. A sample can have more
+    than one range if its rows aren't all together in the file. Returns the path to the index.
+    """
+    index_path = index_path or default_index_path(input_path)
+    compressed = _is_gzip(input_path)
+    access_points = []
+    runs = {} # key: sample name, value: list of [start, length] in the uncompressed stream
+    with open(input_path, 'rb') as raw:
+        chunks = _gzip_chunks(raw, access_points) if compressed else iter(lambda: raw.read(READ_SIZE), b'')
+        lines = _iter_lines(chunks)
+        header_start, header = next(lines, (0, b''))
+        fieldnames = header.decode('utf-8').rstrip('\r\n').split('\t')
+        if 'Name' not in fieldnames:
+            raise ValueError(f"Input file {input_path} has no 'Name' column, so there are no samples to index.")
+        name_col = fieldnames.index('Name')
+        current = None
+        for start, line in lines:
+            fields = line.split(b'\t', name_col + 1)
+            name = fields[name_col].decode('utf-8').rstrip('\r\n')
+            if current is not None and current[0] == name and current[1][0] + current[1][1] == start:
+                current[1][1] += len(line)
+            else:
+                current = (name, [start, len(line)])
+                runs.setdefault(name, []).append(current[1])
+    if not compressed:
+        access_points = [(0, 0)]
+
+    # convert each start in the uncompressed stream into an access point and an offset from it
+    ustarts = [ustart for _, ustart in access_points]
+    samples = {}
+    for name, sample_runs in runs.items():
+        ranges = samples[name] = []
+        for start, length in sample_runs:
+            cstart, ustart = access_points[bisect.bisect_right(ustarts, start) - 1]
+            ranges.append([cstart, start - ustart, length])
+
+    index = {
+        'index_version': INDEX_VERSION,
+        'input': _file_stamp(input_path),
+        'compressed': compressed,
+        'access_points': len(access_points),
+        'fieldnames': fieldnames,
+        'samples': samples,
+    }
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), prefix=".amrrules_index.", suffix=".part")
+    with os.fdopen(fd, 'w') as out:
+        json.dump(index, out, separators=(',', ':'))
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, index_path)
+
+    print(f"Indexed {len(samples)} samples in {input_path} to {index_path}.")
+    if compressed and len(access_points) <= 2 and os.path.getsize(input_path) > 64 * READ_SIZE:
+        # one member (plus the end of file), so there's nowhere to start reading except the beginning
+        print("The input was compressed with gzip rather than bgzip, so reading a sample still means decompressing "
+              "the file up to that sample. Recompress it with bgzip (and re-index) for fast random access.")
+    return index_path
+
+
+class SampleIndex:
+    """A loaded index for an input file, used to read only the rows of selected samples."""
+
+    def __init__(self, input_path, index):
+        self.input_path = input_path
+        self.compressed = index['compressed']
+        self.fieldnames = index['fieldnames']
+        self.samples = index['samples']
+
+    def _ranges(self, samples):
+        # read in file order, so the rows come out in the same order as a full scan would give
+        ranges = [r for s in samples if s in self.samples for r in self.samples[s]]
+        return sorted(ranges)
+
+    def _read_plain(self, ranges):
+        with open(self.input_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for cstart, offset, length in ranges:
+                    yield mm[cstart + offset:cstart + offset + length]
+
+    def _read_gzip(self, ranges):
+        with open(self.input_path, 'rb') as raw:
+            stream = None # (access point, uncompressed bytes read since the access point, chunk iterator, buffer)
+            for cstart, offset, length in ranges:
+                # carry on from where the last range finished if we can, rather than decompressing from the access point again
+                if stream is None or stream[0] != cstart or stream[1] > offset:
+                    raw.seek(cstart)
+                    stream = [cstart, 0, _gzip_chunks(raw, []), b'']
+                _, position, chunks, buffer = stream
+                while position + len(buffer) < offset + length:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        raise ValueError(f"{self.input_path} is shorter than its index says. Please re-run amrrules index.")
+                    buffer += chunk
+                    if position + len(buffer) < offset:
+                        # not there yet, drop what we've read past
+                        position += len(buffer)
+                        buffer = b''
+                start = offset - position
+                yield buffer[start:start + length]
+                stream[1] = offset + length
+                stream[3] = buffer[start + length:]
+
+    def iter_rows(self, samples):
+        """Yield the rows (as dicts, like csv.DictReader) for the given samples, in file order."""
+        ranges = self._ranges(samples)
+        blocks = self._read_gzip(ranges) if self.compressed else self._read_plain(ranges)
+        lines = (line for block in blocks for line in block.decode('utf-8').splitlines(keepends=True))
+        yield from csv.DictReader(lines, fieldnames=self.fieldnames, delimiter='\t')
+
+
+def load_index(input_path, index_path=None):
+    """
+    Load the index for input_path, or return None (with a warning) if there isn't one or it's out of date with the input.
+    """
+    index_path = index_path or default_index_path(input_path)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    if index.get('index_version') != INDEX_VERSION or index.get('input') != _file_stamp(input_path):
+        warnings.warn(f"Sample index {index_path} is out of date with {input_path}, so the whole input will be scanned. Re-run amrrules index to update it.", stacklevel=2)
+        return None
+    return SampleIndex(input_path, index)
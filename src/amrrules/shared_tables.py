@@ -0,0 +1,230 @@
+"""
+Read-only, memory-mapped lookup tables for the reference structures (hierarchy nodes, CARD drug map
+and AMRFP to CARD conversion), so that many amrrules processes on one machine can share them.
+
+A table is built once from a dict and written to disk in a flat layout:
+
+    header      magic, then a JSON description of the sections below and the source files it was built from
+    strings     interned string table, as uint32 offsets into a block of UTF-8 bytes
+    entries     one row of uint32 string ids per key: the key, then one id per value field
+    slots       open-addressing hash index of uint32 entry numbers (+1, 0 is empty), hashed with crc32
+
+Attaching to a table only maps the file and reads the header, so it takes constant time however large the
+table is, and the OS page cache holds a single copy of the pages for every process that has it mapped.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from collections.abc import Mapping
+from pathlib import Path
+
+MAGIC = b'AMRTBL01'
+# string id used for values that are None
+NO_STRING = 0xFFFFFFFF
+
+
+def _source_stamp(source_files):
+    """Size and modification time of each source file, used to tell when a table needs rebuilding."""
+    stamp = []
+    for f in source_files:
+        st = os.stat(f)
+        stamp.append([str(f), st.st_size, st.st_mtime_ns])
+    return stamp
+
+
+def write_table(mapping, path, source_files=(), fields=None):
+    """
+    Write a dict to path as a shared table. Values are strings (or None), or if fields is given,
+    dicts with those keys. The file is written to a temporary name and renamed into place, so processes
+    attaching at the same time never see a partly written table.
+    """
+    strings = {} # key: string, value: string id
+    string_offsets = array('I', [0])
+    string_data = bytearray()
+
+    def intern(s):
+        if s is None:
+            return NO_STRING
+        sid = strings.get(s)
+        if sid is None:
+            sid = strings[s] = len(strings)
+            string_data.extend(s.encode('utf-8'))
+            string_offsets.append(len(string_data))
+        return sid
+
+    width = 1 + (len(fields) if fields else 1)
+    entries = array('I')
+    key_hashes = []
+    for key, value in mapping.items():
+        entries.append(intern(key))
+        if fields:
+            entries.extend(intern(value.get(f)) for f in fields)
+        else:
+            entries.append(intern(value))
+        key_hashes.append(zlib.crc32(key.encode('utf-8')))
+
+    # keep the index at most half full, so probe sequences stay short
+    n_slots = 1
+    while n_slots < 2 * max(len(key_hashes), 1):
+        n_slots *= 2
+    slots = array('I', [0]) * n_slots
+    for entry, key_hash in enumerate(key_hashes):
+        i = key_hash & (n_slots - 1)
+        while slots[i]:
+            i = (i + 1) & (n_slots - 1)
+        slots[i] = entry + 1
+
+    string_data.extend(b'\0' * (-len(string_data) % 4)) # keep the following sections 4-byte aligned
+    header = {
+        'byteorder': sys.byteorder,
+        'fields': fields,
+        'width': width,
+        'n_entries': len(key_hashes),
+        'n_strings': len(strings),
+        'n_slots': n_slots,
+        'string_data_len': len(string_data),
+        'sources': _source_stamp(source_files),
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(len(MAGIC) + 4 + len(header_bytes)) % 4)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".part")
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<I', len(header_bytes)))
+            out.write(header_bytes)
+            out.write(string_offsets.tobytes())
+            out.write(string_data)
+            out.write(entries.tobytes())
+            out.write(slots.tobytes())
+        # mkstemp creates files that only we can read, but the table is meant to be shared
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+    return path
+
+
+class SharedTable(Mapping):
+    """
+    A read-only dict backed by a memory-mapped table file. Supports the usual Mapping methods
+    (get, [], in, len, iteration); values are decoded from the mapped pages on each lookup.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not an amrrules shared table.")
+        header_len = struct.unpack_from('<I', self._mm, len(MAGIC))[0]
+        start = len(MAGIC) + 4
+        self.header = json.loads(bytes(self._mm[start:start + header_len]))
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError(f"{self.path} was built on a machine with a different byte order.")
+        self.fields = self.header['fields']
+        self._width = self.header['width']
+        self._n_entries = self.header['n_entries']
+        self._mask = self.header['n_slots'] - 1
+
+        # views straight onto the mapped pages, nothing is copied
+        view = memoryview(self._mm)
+        offset = start + header_len
+        offsets_len = 4 * (self.header['n_strings'] + 1)
+        self._string_offsets = view[offset:offset + offsets_len].cast('I')
+        offset += offsets_len
+        self._string_data = view[offset:offset + self.header['string_data_len']]
+        offset += self.header['string_data_len']
+        entries_len = 4 * self._n_entries * self._width
+        self._entries = view[offset:offset + entries_len].cast('I')
+        offset += entries_len
+        self._slots = view[offset:offset + 4 * self.header['n_slots']].cast('I')
+
+    def matches_sources(self, source_files):
+        """True if the table was built from the given source files, as they are now."""
+        try:
+            return self.header['sources'] == _source_stamp(source_files)
+        except OSError:
+            return False
+
+    def _bytes(self, sid):
+        return self._string_data[self._string_offsets[sid]:self._string_offsets[sid + 1]]
+
+    def _string(self, sid):
+        if sid == NO_STRING:
+            return None
+        return str(self._bytes(sid), 'utf-8')
+
+    def _find(self, key):
+        """Return the entry number for key, or -1 if it isn't in the table."""
+        if not isinstance(key, str):
+            return -1
+        key_bytes = key.encode('utf-8')
+        i = zlib.crc32(key_bytes) & self._mask
+        while True:
+            entry = self._slots[i]
+            if not entry:
+                return -1
+            entry -= 1
+            if self._bytes(self._entries[entry * self._width]) == key_bytes:
+                return entry
+            i = (i + 1) & self._mask
+
+    def _value(self, entry):
+        row = entry * self._width
+        if self.fields:
+            return {f: self._string(self._entries[row + 1 + n]) for n, f in enumerate(self.fields)}
+        return self._string(self._entries[row + 1])
+
+    def __getitem__(self, key):
+        entry = self._find(key)
+        if entry < 0:
+            raise KeyError(key)
+        return self._value(entry)
+
+    def get(self, key, default=None):
+        entry = self._find(key)
+        return default if entry < 0 else self._value(entry)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __len__(self):
+        return self._n_entries
+
+    def __iter__(self):
+        for entry in range(self._n_entries):
+            yield self._string(self._entries[entry * self._width])
+
+
+def load_shared_table(path, source_files, build, fields=None):
+    """
+    Attach to the table at path, first (re)building it with build() if it's missing or out of date
+    with its source files. If the table can't be written (eg a read-only install), the dict from build()
+    is returned instead, so callers always get something they can look up.
+    """
+    path = Path(path)
+    if path.exists():
+        try:
+            table = SharedTable(path)
+            if table.matches_sources(source_files):
+                return table
+        except (ValueError, OSError):
+            pass # rebuild anything we can't read
+    mapping = build()
+    try:
+        write_table(mapping, path, source_files, fields)
+        return SharedTable(path)
+    except OSError as e:
+        print(f"Could not write shared table {path} ({e}), using an in-memory copy instead.")
+        return mapping
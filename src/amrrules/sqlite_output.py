@@ -0,0 +1,193 @@
+"""
+An SQLite results store (--sqlite): interpreted rows and genome summary entries from any number of runs in one
+indexed database, so questions like "all samples with carbapenem R via rule ACI0002" or "how has sample X changed
+between rule versions" are a query rather than a grep through years of TSVs.
+
+Results are kept per sample and ruleset (a checksum of the rule files used, as the rules have no release number
+of their own). Re-running a sample with the same rules replaces its earlier results, while a run with changed rules
+adds a new set of results for it alongside the old ones. Each run is recorded with its amrrules version, rules
+checksum, AMRFinderPlus and CARD versions and options, and every result row refers back to the run it came from.
+"""
+
+import json
+import sqlite3
+from datetime import datetime, timezone
+
+from amrrules import __version__
+from amrrules.output import row_sample, sample_organism, summary_rows
+
+_encode = json.JSONEncoder(ensure_ascii=False).encode
+# samples written per transaction
+SQLITE_BATCH_SAMPLES = 500
+# stored as the database's user_version, so a store made with an incompatible layout isn't written to
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    started TEXT,
+    amrrules_version TEXT,
+    rules_digest TEXT,
+    amrfp_db_version TEXT,
+    card_version TEXT,
+    input TEXT,
+    options TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    sample TEXT NOT NULL,
+    rules_digest TEXT NOT NULL,
+    organism TEXT,
+    run_id INTEGER REFERENCES runs(run_id),
+    PRIMARY KEY (sample, rules_digest)
+);
+CREATE TABLE IF NOT EXISTS interpreted (
+    sample TEXT NOT NULL,
+    rules_digest TEXT NOT NULL,
+    organism TEXT,
+    run_id INTEGER REFERENCES runs(run_id),
+    row_number INTEGER,
+    gene TEXT,
+    mutation TEXT,
+    variation_type TEXT,
+    ruleID TEXT,
+    drug TEXT,
+    drug_class TEXT,
+    category TEXT,
+    phenotype TEXT,
+    evidence_grade TEXT,
+    fields TEXT
+);
+CREATE TABLE IF NOT EXISTS summary (
+    summary_id INTEGER PRIMARY KEY,
+    sample TEXT NOT NULL,
+    rules_digest TEXT NOT NULL,
+    organism TEXT,
+    run_id INTEGER REFERENCES runs(run_id),
+    drug TEXT,
+    drug_class TEXT,
+    category TEXT,
+    phenotype TEXT,
+    evidence_grade TEXT,
+    markers_nonS TEXT,
+    markers_norule TEXT,
+    markers_S TEXT,
+    ruleIDs TEXT,
+    combo_rules TEXT
+);
+CREATE TABLE IF NOT EXISTS summary_rules (
+    summary_id INTEGER NOT NULL REFERENCES summary(summary_id) ON DELETE CASCADE,
+    ruleID TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS interpreted_sample ON interpreted (sample, rules_digest);
+CREATE INDEX IF NOT EXISTS interpreted_organism ON interpreted (organism);
+CREATE INDEX IF NOT EXISTS interpreted_drug ON interpreted (drug);
+CREATE INDEX IF NOT EXISTS interpreted_drug_class ON interpreted (drug_class);
+CREATE INDEX IF NOT EXISTS interpreted_ruleID ON interpreted (ruleID);
+CREATE INDEX IF NOT EXISTS interpreted_category ON interpreted (category);
+CREATE INDEX IF NOT EXISTS summary_sample ON summary (sample, rules_digest);
+CREATE INDEX IF NOT EXISTS summary_organism ON summary (organism);
+CREATE INDEX IF NOT EXISTS summary_drug ON summary (drug);
+CREATE INDEX IF NOT EXISTS summary_drug_class ON summary (drug_class);
+CREATE INDEX IF NOT EXISTS summary_category ON summary (category);
+CREATE INDEX IF NOT EXISTS summary_rules_ruleID ON summary_rules (ruleID);
+CREATE INDEX IF NOT EXISTS summary_rules_summary_id ON summary_rules (summary_id);
+"""
+
+# interpreted report columns kept in their own (indexed) columns, as well as in the full row under fields
+INTERPRETED_COLUMNS = {'gene': 'gene', 'mutation': 'mutation', 'variation type': 'variation_type', 'ruleID': 'ruleID',
+                       'drug': 'drug', 'drug class': 'drug_class', 'clinical category': 'category',
+                       'phenotype': 'phenotype', 'evidence grade': 'evidence_grade'}
+# genome summary report columns, and the summary table columns they go in
+SUMMARY_COLUMNS = {'drug': 'drug', 'drug class': 'drug_class', 'clinical category': 'category', 'phenotype': 'phenotype',
+                   'evidence grade': 'evidence_grade', 'markers (non-S)': 'markers_nonS',
+                   'markers (no rule)': 'markers_norule', 'markers (S)': 'markers_S', 'ruleIDs': 'ruleIDs',
+                   'combo rules': 'combo_rules'}
+# ruleIDs values that aren't rules
+NOT_RULES = ('-', 'none (partial hits)')
+
+
+class SqliteStore:
+
+    def __init__(self, path, args, organism_dict, rules_digest, resource_versions):
+        self.args = args
+        self.organism_dict = organism_dict
+        self.rules_digest = rules_digest
+        self.samples_written = 0
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        # readers can query the store while a run is writing to it
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        schema_version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        has_tables = self.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        if has_tables and schema_version != SCHEMA_VERSION:
+            self.conn.close()
+            raise ValueError(f"SQLite store {path} was written by an incompatible version of amrrules. Use a new database file.")
+        self.conn.executescript(SCHEMA)
+        self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        options = {k: v for k, v in vars(args).items() if k not in ('input', 'sqlite')}
+        cursor = self.conn.execute(
+            "INSERT INTO runs (started, amrrules_version, rules_digest, amrfp_db_version, card_version, input, options) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (datetime.now(timezone.utc).isoformat(timespec='seconds'), __version__, rules_digest,
+             resource_versions.get('amrfp'), resource_versions.get('card'), args.input, json.dumps(options, default=str)))
+        self.run_id = cursor.lastrowid
+
+    def write_results(self, output_rows, summary_entry_dict):
+        """
+        Upsert the interpreted rows and summary entries (from process_rows) for each of their samples, replacing
+        anything stored for the same sample and ruleset, in transactions of SQLITE_BATCH_SAMPLES samples.
+        """
+        rows_by_sample = {}
+        for row in output_rows:
+            rows_by_sample.setdefault(row_sample(self.args, row), []).append(row)
+        samples = list(dict.fromkeys(list(rows_by_sample) + list(summary_entry_dict)))
+        for start in range(0, len(samples), SQLITE_BATCH_SAMPLES):
+            batch = samples[start:start + SQLITE_BATCH_SAMPLES]
+            self._write_batch(batch, rows_by_sample, summary_entry_dict)
+
+    def _write_batch(self, samples, rows_by_sample, summary_entry_dict):
+        sample_rows = []
+        interpreted_rows = []
+        summary_table_rows = []
+        rule_rows = []
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # summary ids for this batch, safe to hand out ourselves as we hold the write lock
+            next_id = self.conn.execute("SELECT COALESCE(MAX(summary_id), 0) + 1 FROM summary").fetchone()[0]
+            for sample in samples:
+                key = (sample, self.rules_digest)
+                objs = summary_entry_dict.get(sample, [])
+                organism = objs[0].organism if objs else sample_organism(self.organism_dict, sample)
+                sample_rows.append((*key, organism, self.run_id))
+                for row_number, row in enumerate(rows_by_sample.get(sample, []), start=1):
+                    interpreted_rows.append((*key, organism, self.run_id, row_number,
+                                             *(row.get(col) for col in INTERPRETED_COLUMNS), _encode(dict(row))))
+                for row in summary_rows(objs):
+                    summary_table_rows.append((next_id, *key, organism, self.run_id, *(row[col] for col in SUMMARY_COLUMNS)))
+                    rule_rows.extend((next_id, rule_id) for rule_id in str(row['ruleIDs']).split(';')
+                                     if rule_id and rule_id not in NOT_RULES)
+                    next_id += 1
+            keys = [key[:2] for key in sample_rows]
+            # replace earlier results for these samples and rules (summary_rules go with their summary rows)
+            self.conn.executemany("DELETE FROM interpreted WHERE sample = ? AND rules_digest = ?", keys)
+            self.conn.executemany("DELETE FROM summary WHERE sample = ? AND rules_digest = ?", keys)
+            self.conn.executemany(
+                "INSERT INTO samples (sample, rules_digest, organism, run_id) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (sample, rules_digest) DO UPDATE SET organism = excluded.organism, run_id = excluded.run_id",
+                sample_rows)
+            self.conn.executemany(f"INSERT INTO interpreted (sample, rules_digest, organism, run_id, row_number, "
+                                  f"{', '.join(INTERPRETED_COLUMNS.values())}, fields) VALUES ({', '.join('?' * (6 + len(INTERPRETED_COLUMNS)))})",
+                                  interpreted_rows)
+            self.conn.executemany(f"INSERT INTO summary (summary_id, sample, rules_digest, organism, run_id, "
+                                  f"{', '.join(SUMMARY_COLUMNS.values())}) VALUES ({', '.join('?' * (5 + len(SUMMARY_COLUMNS)))})",
+                                  summary_table_rows)
+            self.conn.executemany("INSERT INTO summary_rules (summary_id, ruleID) VALUES (?, ?)", rule_rows)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.samples_written += len(samples)
+
+    def close(self):
+        self.conn.close()
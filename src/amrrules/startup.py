@@ -0,0 +1,92 @@
+"""
+Concurrent loading at startup: the organism file, the input validation, the AMRFinderPlus and CARD reference data
+and the rules are mostly independent, so they're run as a small dependency graph on a thread pool, each step
+starting as soon as the steps it needs are done.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from amrrules.metrics import RunMetrics
+
+MAX_LOAD_WORKERS = 4
+
+
+class LoadStep:
+
+    def __init__(self, name, func, deps, stage, resource):
+        self.name = name
+        self.func = func # called with the results of deps, in order
+        self.deps = deps
+        self.stage = stage # metrics stage to time the step under, if any
+        self.resource = resource # a missing file here means the resources need downloading
+
+
+class LoadGraph:
+    """
+    Named load steps and the steps each depends on. run() returns the result of every step, or raises once all
+    the steps that could run have finished: a SystemExit listing every missing resource file if any resource
+    step failed with FileNotFoundError, otherwise the first error (in the order the steps were added).
+    """
+
+    def __init__(self, metrics=None, max_workers=MAX_LOAD_WORKERS):
+        self.metrics = metrics if metrics is not None else RunMetrics(enabled=False)
+        self.max_workers = max_workers
+        self.steps = {} # key: step name, value: LoadStep, in the order added
+
+    def add(self, name, func, deps=(), stage=None, resource=False):
+        for dep in deps:
+            if dep not in self.steps:
+                raise ValueError(f"Load step {name} depends on {dep}, which hasn't been added")
+        self.steps[name] = LoadStep(name, func, tuple(deps), stage, resource)
+
+    def _call(self, step, results):
+        args = [results[dep] for dep in step.deps]
+        if step.stage is None:
+            return step.func(*args)
+        with self.metrics.stage(step.stage):
+            return step.func(*args)
+
+    def run(self):
+        results = {}
+        errors = {} # key: step name, value: exception
+        pending = dict(self.steps)
+        running = {} # key: future, value: step name
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='amrrules-load') as executor:
+            while pending or running:
+                for name, step in list(pending.items()):
+                    if any(dep in errors for dep in step.deps):
+                        # can't run without what it depends on, and that step's error is what gets reported
+                        del pending[name]
+                        errors[name] = None
+                    elif all(dep in results for dep in step.deps):
+                        del pending[name]
+                        running[executor.submit(self._call, step, results)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as exc:
+                        errors[name] = exc
+        self._raise_errors(errors)
+        return results
+
+    def _raise_errors(self, errors):
+        failed = [(name, exc) for name, exc in errors.items() if exc is not None]
+        if not failed:
+            return
+        # report every missing resource file at once, rather than one per rerun
+        missing_resources = [exc for name, exc in failed if self.steps[name].resource and isinstance(exc, FileNotFoundError)]
+        if missing_resources:
+            missing = "".join(f"\nMissing file: {exc.filename}" for exc in missing_resources if getattr(exc, "filename", None))
+            details = "".join(f"\nDetails: {exc}" for exc in missing_resources)
+            raise SystemExit(
+                "Required resource files were not found.\n"
+                "Please run: amrrules --download-resources\n"
+                "Then rerun your original command."
+                f"{missing}{details}"
+            ) from None
+        first = min(failed, key=lambda item: list(self.steps).index(item[0]))[1]
+        raise first
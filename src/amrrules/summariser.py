@@ -1,6 +1,8 @@
 from amrrules.resources import ResourceManager as rm
 from amrrules.utils import CATEGORY_ORDER, PHENOTYPE_ORDER, EVIDENCE_GRADE_ORDER
+from amrrules.tracing import NULL_TRACER
 from collections import defaultdict
+from operator import attrgetter
 
 class SummaryEntry:
     """
@@ -32,7 +34,20 @@ class SummaryEntry:
         self.markers_s = None
         self.ruleIDs = None
         self.combo_rules = None
+        self.combo_ruleIDs = [] # ruleIDs of the matched combination rules, used for rule stats
+        self.combo_rules_checked = [] # combination rules evaluated for this entry, used for rule stats
     
+    def copy_for_sample(self, sample_name, genotype_objects):
+        """
+        Return a copy of this (already summarised) entry for another sample with an identical genotype profile.
+        Copies the attribute dict directly, which is much cheaper than copy.copy for the number of entries involved.
+        """
+        new_entry = SummaryEntry.__new__(SummaryEntry)
+        new_entry.__dict__ = dict(self.__dict__)
+        new_entry.sample_name = sample_name
+        new_entry.geno_objs = genotype_objects
+        return new_entry
+
     def summarise_rules(self, no_rule_interpretation, class_summary=None):
         """Compute summary values based on geno_objs."""
 
@@ -130,6 +145,7 @@ class SummaryEntry:
         self.ruleIDs = ";".join(sorted(rule_ids)) if rule_ids else "-"
 
         matched_combo_rules = []
+        self.combo_ruleIDs = []
         # for each rule, we need to extract the ruleID logic and check if it matches our ruleIDs
         for rule in combo_rules:
             ruleID_logic = rule.get('gene')
@@ -139,6 +155,7 @@ class SummaryEntry:
             if matched_combo:
                 # add to the list of matched combos
                 matched_combo_rules.append(ruleID_logic)
+                self.combo_ruleIDs.append(rule.get('ruleID'))
         # if we didn't find any matching combo rules, then we return None
         if len(matched_combo_rules) == 0:
             self.combo_rules = '-'
@@ -246,60 +263,139 @@ def order_summary_objs(objs):
 
     return sorted_list
 
-def create_summary_dict(grouped_by_sample, rules, flag_core, no_rule_interpretation):
+# the attributes of a genotype that its summary entries are built from. gene context isn't included, as it comes
+# from the rule, which is already identified by the ruleID
+_genotype_key = attrgetter('marker_amrrules', 'variation_type', 'ruleID', 'clinical_category', 'phenotype', 'evidence_grade')
 
-    summary_entry_dict = {} # key: sample name, value: list of summary entry objs
-    for sample_name, genotypes in grouped_by_sample.items():
-        summary_entry_list = []
-        # for the sample, we need to group by drug class, and then by drug within that
+def profile_fingerprint(organism, sample_groups, flag_core, no_rule_interpretation):
+    """
+    Canonical fingerprint of a sample's expanded genotypes and the interpretation options, so that samples
+    whose summary entries will be identical (eg clonal outbreak genomes) can be spotted.
+    The drug/drug class groups are sorted, as the entries are written out in a fixed order anyway, but genotypes
+    keep their order within each group, because that sets the order the markers are listed in.
+    """
+    groups = sorted((drug_class, drug, tuple(map(_genotype_key, genotypes)))
+                    for drug_class, drugs in sample_groups.items() for drug, genotypes in drugs.items())
+    return (organism, flag_core, no_rule_interpretation, tuple(groups))
 
-        sample_groups = defaultdict(lambda: defaultdict(list))
-        for g in genotypes:
-            sample_groups[g.drug_class][g.drug].append(g)
-        for drug_class in sample_groups.keys():
-            # for each drug_class, we first need to apply a summary entry at the class level
-            # if the class level exists
-            class_level_hits = sample_groups[drug_class].get('-', None)
-            # initialise our master class entry as None, will be filled later
-            master_class_entry = None
-            if class_level_hits:
-                summary_entry = SummaryEntry(sample_name, class_level_hits)
-                # assign markers with, without rules, and wt markers
+def get_combination_rules(rules):
+    """Return the 'Combination' rules, grouped by organism."""
+    combination_rules = defaultdict(list)
+    for r in rules:
+        if r.get('rule type') == 'Combination':
+            combination_rules[r.get('organism')].append(r)
+    return combination_rules
+
+def summarise_sample(sample_name, sample_groups, combination_rules, flag_core, no_rule_interpretation, tracer=NULL_TRACER):
+    """
+    Build the summary entries for one sample, from its genotypes grouped by drug class then drug.
+    combination_rules is the output of get_combination_rules. Returns a list of (summary entry, (drug class, drug) group it was built from), ordered for output.
+    """
+    summary_entry_list = []
+    entry_groups = {} # key: id of summary entry, value: (drug class, drug) group
+    for drug_class in sample_groups.keys():
+        # for each drug_class, we first need to apply a summary entry at the class level
+        # if the class level exists
+        class_level_hits = sample_groups[drug_class].get('-', None)
+        # initialise our master class entry as None, will be filled later
+        master_class_entry = None
+        if class_level_hits:
+            summary_entry = SummaryEntry(sample_name, class_level_hits)
+            # assign markers with, without rules, and wt markers
+            with tracer.span('summarisation:set_markers', drug_class=drug_class):
                 summary_entry.set_markers(flag_core)
-                # determine the highest category/pheno/evidence grade for this drug_class
+            # determine the highest category/pheno/evidence grade for this drug_class
+            with tracer.span('summarisation:summarise_rules', drug_class=drug_class):
                 summary_entry.summarise_rules(no_rule_interpretation)
-                # assign ruleIDs and combo rules
-                #TODO: Test combo rule implementation
-                # to get the list of possible combo rules to evaluate, we need to extract all 'Combination' rules for this organism
-                combo_rules = [r for r in rules if r.get('organism') == summary_entry.organism and r.get('rule type') == 'Combination']
-                # then need to further filter to include only combo rules that apply to the drug class we're assessing
-                combo_rules = [r for r in combo_rules if summary_entry.drug_class in r.get('drug classes', '')]
+            # assign ruleIDs and combo rules
+            #TODO: Test combo rule implementation
+            # to get the list of possible combo rules to evaluate, we need all the 'Combination' rules for this organism
+            combo_rules = combination_rules.get(summary_entry.organism, [])
+            # then need to further filter to include only combo rules that apply to the drug class we're assessing
+            combo_rules = [r for r in combo_rules if summary_entry.drug_class in r.get('drug classes', '')]
+            with tracer.span('summarisation:set_ruleIDs_and_combo', drug_class=drug_class):
                 summary_entry.set_ruleIDs_and_combo(combo_rules)
-                # this is our master entry for this drug_class, so save it
-                master_class_entry = summary_entry
-                # add it to our list
-                summary_entry_list.append(summary_entry)
-            
-            # otherwise now we're in a specific drug for the class
-            # we need to make sure that the interpretation of this drug doesn't conflict with the class level rules
-            for drug in sample_groups[drug_class].keys():
-                if drug != '-':
-                    # create our summary entry
-                    summary_entry = SummaryEntry(sample_name, sample_groups[drug_class][drug])
-                    # before assigning markers to columns
-                    # we want to remove any duplicated row markers from the class level
-                    # assign markers
+            summary_entry.combo_rules_checked = combo_rules
+            # this is our master entry for this drug_class, so save it
+            master_class_entry = summary_entry
+            # add it to our list
+            summary_entry_list.append(summary_entry)
+            entry_groups[id(summary_entry)] = (drug_class, '-')
+
+        # otherwise now we're in a specific drug for the class
+        # we need to make sure that the interpretation of this drug doesn't conflict with the class level rules
+        for drug in sample_groups[drug_class].keys():
+            if drug != '-':
+                # create our summary entry
+                summary_entry = SummaryEntry(sample_name, sample_groups[drug_class][drug])
+                # before assigning markers to columns
+                # we want to remove any duplicated row markers from the class level
+                # assign markers
+                with tracer.span('summarisation:set_markers', drug=drug):
                     summary_entry.set_markers(flag_core, class_summary=master_class_entry)
-                    # determine highest category/pheno/evidence grade for this drug
-                    # but take into account the rules for the drug class
+                # determine highest category/pheno/evidence grade for this drug
+                # but take into account the rules for the drug class
+                with tracer.span('summarisation:summarise_rules', drug=drug):
                     summary_entry.summarise_rules(no_rule_interpretation, class_summary=master_class_entry)
-                    # assign ruleIDs and combo rules
-                    combo_rules = [r for r in rules if r.get('organism') == summary_entry.organism and r.get('rule type') == 'Combination']
-                    # then need to further filter to include only combo rules that apply to either the drug or class we're assessing
-                    combo_rules = [r for r in combo_rules if summary_entry.drug in r.get('drugs', '') or summary_entry.drug_class in r.get('drug classes', '')]
+                # assign ruleIDs and combo rules
+                combo_rules = combination_rules.get(summary_entry.organism, [])
+                # then need to further filter to include only combo rules that apply to either the drug or class we're assessing
+                combo_rules = [r for r in combo_rules if summary_entry.drug in r.get('drugs', '') or summary_entry.drug_class in r.get('drug classes', '')]
+                with tracer.span('summarisation:set_ruleIDs_and_combo', drug=drug):
                     summary_entry.set_ruleIDs_and_combo(combo_rules, class_summary=master_class_entry)
-                    # add it to our list
-                    summary_entry_list.append(summary_entry)
-            summary_entry_dict[sample_name] = order_summary_objs(summary_entry_list)
+                summary_entry.combo_rules_checked = combo_rules
+                # add it to our list
+                summary_entry_list.append(summary_entry)
+                entry_groups[id(summary_entry)] = (drug_class, drug)
+    return [(entry, entry_groups[id(entry)]) for entry in order_summary_objs(summary_entry_list)]
+
+def create_summary_dict(grouped_by_sample, rules, flag_core, no_rule_interpretation, tracer=NULL_TRACER, rule_stats=None, counts=None, deduplicate=True,
+                        cohort_summary=None, combination_rules=None):
+    """
+    Build the summary entries for every sample. Samples with the same genotype profile (see profile_fingerprint)
+    reuse the entries computed for the first such sample, with just the sample name (and genotypes) swapped in.
+    The number of samples that were deduplicated this way is added to counts['deduplicated'], if given, and each sample's
+    entries are added to the cohort_summary aggregates, if given. combination_rules is the output of
+    get_combination_rules for rules, which is worked out here if it isn't given.
+    """
+    summary_entry_dict = {} # key: sample name, value: list of summary entry objs
+    # the combination rules only depend on the organism, so find them once rather than for every summary entry
+    if combination_rules is None:
+        combination_rules = get_combination_rules(rules)
+    computed_profiles = {} # key: profile fingerprint, value: output of summarise_sample for the first sample with that profile
+    deduplicated = 0
+    for sample_name, genotypes in grouped_by_sample.items():
+        if not genotypes:
+            continue
+        tracer.switch_sample('summarisation', sample_name)
+        # for the sample, we need to group by drug class, and then by drug within that
+        sample_groups = defaultdict(lambda: defaultdict(list))
+        for g in genotypes:
+            sample_groups[g.drug_class][g.drug].append(g)
+
+        fingerprint = profile_fingerprint(genotypes[0].organism, sample_groups, flag_core, no_rule_interpretation) if deduplicate else None
+        computed = computed_profiles.get(fingerprint) if deduplicate else None
+        if computed is None:
+            computed = summarise_sample(sample_name, sample_groups, combination_rules, flag_core, no_rule_interpretation, tracer=tracer)
+            summary_entries = [entry for entry, _ in computed]
+            if deduplicate:
+                computed_profiles[fingerprint] = computed
+        else:
+            # same profile as an earlier sample, so copy its entries rather than rebuilding them
+            deduplicated += 1
+            summary_entries = [entry.copy_for_sample(sample_name, sample_groups[drug_class][drug])
+                               for entry, (drug_class, drug) in computed]
+
+        if rule_stats is not None:
+            for entry in summary_entries:
+                rule_stats.record_combinations(entry.combo_rules_checked, entry.combo_ruleIDs)
+        if cohort_summary is not None:
+            cohort_summary.add_sample(genotypes[0].organism, summary_entries)
+        summary_entry_dict[sample_name] = summary_entries
+    tracer.end_sample('summarisation')
+    if rule_stats is not None:
+        rule_stats.samples += len(summary_entry_dict)
+    if counts is not None:
+        counts['deduplicated'] = counts.get('deduplicated', 0) + deduplicated
     
-    return(summary_entry_dict)
\ No newline at end of file
+    return(summary_entry_dict)
@@ -0,0 +1,99 @@
+"""Chrome trace-event export, for profiling where time goes in an individual run."""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from amrrules import __version__
+
+# shared no-op context, so spans cost almost nothing when tracing is disabled
+_NULL_SPAN = nullcontext()
+
+
+class Tracer:
+    """
+    Records spans as Chrome trace events ("X" complete events), which can be loaded into
+    chrome://tracing or https://ui.perfetto.dev.
+
+    When the tracer is disabled every method returns immediately without recording anything.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = []
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+        # key: span name, value: (sample name, start time, args) for spans opened with switch_sample
+        self._open_sample_spans = {}
+
+    def _now_us(self):
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _add(self, name, start_us, end_us, args):
+        event = {
+            'name': name,
+            'cat': name.split(':')[0],
+            'ph': 'X',
+            'ts': round(start_us, 3),
+            'dur': round(end_us - start_us, 3),
+            'pid': self._pid,
+            'tid': threading.get_ident(),
+        }
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def span(self, name, **args):
+        """Return a context manager that records the enclosed block as a span."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name, args):
+        start = self._now_us()
+        try:
+            yield args
+        finally:
+            self._add(name, start, self._now_us(), args)
+
+    def switch_sample(self, name, sample_name, **args):
+        """
+        Keep a single open span per name, closing it and starting a new one whenever the sample changes.
+        This lets us record per-sample spans from loops that work one row at a time.
+        """
+        if not self.enabled:
+            return
+        open_span = self._open_sample_spans.get(name)
+        if open_span is not None:
+            if open_span[0] == sample_name:
+                return
+            self.end_sample(name)
+        args['sample'] = sample_name
+        self._open_sample_spans[name] = (sample_name, self._now_us(), args)
+
+    def end_sample(self, name):
+        """Close the open per-sample span with this name, if there is one."""
+        if not self.enabled:
+            return
+        open_span = self._open_sample_spans.pop(name, None)
+        if open_span is not None:
+            _, start, args = open_span
+            self._add(name, start, self._now_us(), args)
+
+    def write_json(self, path):
+        """Close any spans still open and write all events to the given path as Chrome trace JSON."""
+        for name in list(self._open_sample_spans):
+            self.end_sample(name)
+        with open(path, 'w') as out:
+            json.dump({
+                'traceEvents': self.events,
+                'displayTimeUnit': 'ms',
+                'otherData': {'amrrules_version': __version__},
+            }, out)
+        return path
+
+
+# disabled tracer used as the default wherever a tracer is optional
+NULL_TRACER = Tracer(enabled=False)
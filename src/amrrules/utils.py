@@ -1,6 +1,7 @@
 import csv, gzip, sys
 from importlib import resources
 import warnings
+from functools import lru_cache
 
 aa_conversion = {'G': 'Gly', 'A': 'Ala', 'S': 'Ser', 'P': 'Pro', 'T': 'Thr', 'C': 'Cys', 'V': 'Val', 'L': 'Leu', 'I': 'Ile', 
                  'M': 'Met', 'N': 'Asn', 'Q': 'Gln', 'K': 'Lys', 'R': 'Arg', 'H': 'His', 'D': 'Asp', 'E': 'Glu', 'W': 'Trp', 
@@ -24,6 +25,11 @@ def get_supported_organisms(rule_dir: str = None):
     """
     Return a list of organism names by scanning organism names in the rules folder.
     """
+    # the packaged rules don't change during a run, so they're only scanned once
+    return list(_scan_supported_organisms())
+
+@lru_cache(maxsize=None)
+def _scan_supported_organisms():
     rule_dir = resources.files("amrrules.rules")
     
     if rule_dir is None:
@@ -33,10 +39,10 @@ def get_supported_organisms(rule_dir: str = None):
     for entry in rule_dir.iterdir():
         if entry.name != "rule_key_file.tsv" and entry.name.endswith(".tsv"):
             # Extract organism name from filename
-            reader = csv.DictReader(open(entry, 'r'), delimiter='\t')
-            for row in reader:
-                organisms.add(row.get('organism'))
-    return sorted(organisms)
+            with open(entry, 'r') as f:
+                for row in csv.DictReader(f, delimiter='\t'):
+                    organisms.add(row.get('organism'))
+    return tuple(sorted(organisms))
 
 def get_organisms(organism_file):
     """
@@ -0,0 +1,300 @@
+"""
+Watch mode: keep the rules and resources loaded, and interpret AMRFinderPlus files as they arrive in a directory.
+"""
+
+import argparse
+import csv
+import fnmatch
+import json
+import os
+import shutil
+import signal
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from pathlib import Path
+
+from amrrules.output import write_genotype_report, write_genome_report, wants_output
+from amrrules.resources import ResourceManager
+from amrrules.rules_engine import process_rows
+from amrrules.genotype_parser import GenotypeTemplates
+from amrrules.interpreted_report import AnnotationFragments
+from amrrules.rules_io import parse_rules_file, get_rule_files, rule_drugs
+from amrrules.mutation_ranges import MutationRuleIndex
+from amrrules.summariser import get_combination_rules
+from amrrules.utils import get_organisms, get_supported_organisms, open_input, validate_amrfp_file
+
+STATE_FILE = ".amrrules_watch_state.json"
+REPORT_SUFFIXES = {'interpreted': '_interpreted.tsv', 'summary': '_genome_summary.tsv'}
+
+# rules and resources loaded once per worker, by _init_worker
+_worker_state = {}
+
+
+def _log(message):
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+def _file_stem(path):
+    name = Path(path).name
+    for ext in ('.tsv.gz', '.tsv', '.txt.gz', '.txt', '.gz'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _init_worker(args):
+    """Load the reference data and the rules for every supported organism, once for the life of the worker."""
+    resource_manager = ResourceManager(args.resource_dir, args.amrfp_db_version, args.card_version, shared_tables=args.shared_tables)
+    _worker_state['amrfp_nodes'] = resource_manager.refseq_nodes()
+    _worker_state['card_amrfp_conversion'] = resource_manager.get_amrfp_card_conversion()
+    _worker_state['rules'] = parse_rules_file(get_rule_files(get_supported_organisms()))
+    _worker_state['card_drug_map'] = resource_manager.get_card_drug_class_map(rule_drugs(_worker_state['rules']))
+    _worker_state['mutation_index'] = MutationRuleIndex(_worker_state['rules'])
+    _worker_state['genotype_templates'] = GenotypeTemplates(_worker_state['card_drug_map'], _worker_state['card_amrfp_conversion'],
+                                                            args.no_rule_interpretation).prepare(_worker_state['rules'])
+    _worker_state['annotation_fragments'] = AnnotationFragments(args.annot_opts).prepare(_worker_state['rules'])
+    _worker_state['combination_rules'] = get_combination_rules(_worker_state['rules'])
+
+
+def interpret_file(path, args, out_dir):
+    """
+    Interpret a single AMRFinderPlus file with the preloaded rules and resources, writing its interpreted and
+    genome summary reports to out_dir. Returns the counts for the file.
+    """
+    if not _worker_state:
+        _init_worker(args)
+    start = time.perf_counter()
+    stem = _file_stem(path)
+
+    if args.organism_file:
+        # re-read every time, as new isolates are usually added to the organism file as they arrive
+        organism_dict, skipped_samples = get_organisms(args.organism_file)
+    else:
+        organism_dict, skipped_samples = {'': args.organism}, None
+    samples_in_file = validate_amrfp_file(path, multi_entry=bool(args.organism_file))
+    if args.organism_file:
+        missing_samples = samples_in_file - set(organism_dict) - skipped_samples
+        if missing_samples:
+            raise ValueError(f"Samples missing from the organism file: {', '.join(sorted(missing_samples))}")
+
+    # files without a Name column are named after the file
+    file_args = argparse.Namespace(**{**vars(args), 'sample_id': None if samples_in_file else stem})
+    with open_input(path) as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        base_fieldnames = reader.fieldnames.copy()
+        result = process_rows(reader, file_args, organism_dict, skipped_samples, _worker_state['rules'], _worker_state['amrfp_nodes'],
+                              _worker_state['card_drug_map'], _worker_state['card_amrfp_conversion'],
+                              mutation_index=_worker_state['mutation_index'], genotype_templates=_worker_state['genotype_templates'],
+                              annotation_fragments=_worker_state['annotation_fragments'],
+                              combination_rules=_worker_state['combination_rules'])
+
+    if wants_output(args, 'interpreted'):
+        write_genotype_report(argparse.Namespace(output_dir=out_dir, output_prefix=stem, annot_opts=args.annot_opts,
+                                                 interpreted_layout=args.interpreted_layout),
+                              result['output_rows'], result['unmatched_hits'], result['matched_hits'], base_fieldnames)
+    if wants_output(args, 'summary'):
+        write_genome_report(result['summary_entry_dict'], out_dir, stem)
+    return {**result['counts'], 'seconds': time.perf_counter() - start}
+
+
+class DirectoryWatcher:
+    """
+    Polls a directory for input files. A file is ready once it hasn't been modified for settle_time seconds,
+    so files that are still being written are left alone. Files are offered again if they change later.
+    """
+
+    def __init__(self, watch_dir, patterns, settle_time, exclude_dirs=()):
+        self.watch_dir = Path(watch_dir)
+        self.patterns = patterns
+        self.settle_time = settle_time
+        self.exclude_dirs = {Path(d).resolve() for d in exclude_dirs}
+        self.unsettled = 0
+
+    def _matches(self, name):
+        if any(name.endswith(suffix) for suffix in REPORT_SUFFIXES.values()):
+            return False # our own outputs, if they're written to the watched directory
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns)
+
+    def poll(self):
+        """Return (path, (size, mtime_ns), mtime) for each settled file, oldest first."""
+        now = time.time()
+        ready = []
+        self.unsettled = 0
+        if self.watch_dir.resolve() in self.exclude_dirs:
+            return ready
+        for entry in os.scandir(self.watch_dir):
+            if not entry.is_file() or entry.name.startswith('.') or not self._matches(entry.name):
+                continue
+            st = entry.stat()
+            if now - st.st_mtime < self.settle_time:
+                self.unsettled += 1
+                continue
+            ready.append((os.path.abspath(entry.path), (st.st_size, st.st_mtime_ns), st.st_mtime))
+        return sorted(ready, key=lambda r: r[2])
+
+
+class WatchStats:
+    """Throughput and lag (time from a file being last modified to its outputs being written), logged periodically."""
+
+    def __init__(self, log_interval):
+        self.log_interval = log_interval
+        self.last_log = time.monotonic()
+        self.total_files = 0
+        self.total_failed = 0
+        self._reset()
+
+    def _reset(self):
+        self.files = 0
+        self.failed = 0
+        self.rows = 0
+        self.samples = 0
+        self.lags = []
+
+    def record(self, counts, mtime):
+        self.files += 1
+        self.total_files += 1
+        self.rows += counts.get('rows', 0)
+        self.samples += counts.get('samples', 0)
+        self.lags.append(time.time() - mtime)
+
+    def record_failure(self):
+        self.failed += 1
+        self.total_failed += 1
+
+    def maybe_log(self, queued, in_flight, force=False):
+        elapsed = time.monotonic() - self.last_log
+        if not force and elapsed < self.log_interval:
+            return
+        if self.files or self.failed or force:
+            lag = f"lag mean {sum(self.lags) / len(self.lags):.1f}s max {max(self.lags):.1f}s" if self.lags else "lag -"
+            _log(f"{self.files} files ({self.samples} samples, {self.rows} rows) in the last {elapsed:.0f}s, "
+                 f"{self.rows / elapsed if elapsed else 0:.1f} rows/s, {lag}, {self.failed} failed, "
+                 f"{queued} queued, {in_flight} running")
+        self._reset()
+        self.last_log = time.monotonic()
+
+
+def _append_report(part_file, rolling_file):
+    """
+    Append a per-file report to a rolling report, writing the header only if the rolling report is new.
+    Returns False (and appends nothing) if the headers don't match, eg the files came from different AMRFinderPlus versions.
+    """
+    with open(part_file, 'r', newline='') as part:
+        header = part.readline()
+        if os.path.exists(rolling_file) and os.path.getsize(rolling_file) > 0:
+            with open(rolling_file, 'r', newline='') as rolling:
+                if rolling.readline() != header:
+                    return False
+            header = None
+        with open(rolling_file, 'a', newline='') as out:
+            if header:
+                out.write(header)
+            shutil.copyfileobj(part, out)
+    return True
+
+
+def _load_state(path):
+    if path.exists():
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def _save_state(path, state):
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix=".part")
+    with os.fdopen(fd, 'w') as out:
+        json.dump(state, out, indent=1)
+    os.replace(temp_path, path)
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def watch(args):
+    """
+    Watch args.watch_dir and interpret each new (or changed) AMRFinderPlus file once it has settled, using a
+    bounded pool of workers that each keep the rules and resources loaded. Runs until interrupted, or with
+    args.once, until every file currently in the directory has been interpreted.
+    """
+    # stop cleanly when run as a service, as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, _stop)
+    os.makedirs(args.output_dir, exist_ok=True)
+    state_path = Path(args.output_dir) / STATE_FILE
+    # key: input file path, value: [size, mtime_ns, status] when it was last interpreted
+    state = _load_state(state_path)
+    parts_dir = Path(args.output_dir) / ".watch_parts"
+    if args.rolling_prefix:
+        parts_dir.mkdir(exist_ok=True)
+
+    watcher = DirectoryWatcher(args.watch_dir, args.pattern, args.settle_time, exclude_dirs=[parts_dir])
+    stats = WatchStats(args.log_interval)
+
+    _log(f"Loading rules and resources for {args.workers} worker(s)...")
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(args,))
+    else:
+        # a single worker thread, so the rules and resources are loaded once in this process
+        executor = ThreadPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(args,))
+    _log(f"Watching {args.watch_dir} for {', '.join(args.pattern)} (settle time {args.settle_time}s). Press Ctrl-C to stop.")
+
+    queued = deque()
+    queued_paths = set()
+    in_flight = {} # key: future, value: (path, stamp, mtime)
+    try:
+        while True:
+            for path, stamp, mtime in watcher.poll():
+                previous = state.get(path)
+                if path in queued_paths or (previous and tuple(previous[:2]) == stamp):
+                    continue
+                queued.append((path, stamp, mtime))
+                queued_paths.add(path)
+
+            # only hand the pool as many files as it has workers, so bursts queue here rather than in memory in the pool
+            while queued and len(in_flight) < args.workers:
+                path, stamp, mtime = queued.popleft()
+                out_dir = str(parts_dir) if args.rolling_prefix else args.output_dir
+                in_flight[executor.submit(interpret_file, path, args, out_dir)] = (path, stamp, mtime)
+
+            if in_flight:
+                done, _ = wait(in_flight, timeout=args.poll_interval, return_when=FIRST_COMPLETED)
+            else:
+                done = set()
+                if args.once and not queued and not watcher.unsettled:
+                    break
+                time.sleep(args.poll_interval)
+
+            for future in done:
+                path, stamp, mtime = in_flight.pop(future)
+                queued_paths.discard(path)
+                try:
+                    counts = future.result()
+                except Exception as e:
+                    _log(f"Failed to interpret {path}: {e}")
+                    stats.record_failure()
+                    state[path] = [*stamp, 'failed']
+                else:
+                    if args.rolling_prefix:
+                        stem = _file_stem(path)
+                        for suffix in (suffix for report, suffix in REPORT_SUFFIXES.items() if wants_output(args, report)):
+                            part_file = parts_dir / (stem + suffix)
+                            rolling_file = os.path.join(args.output_dir, args.rolling_prefix + suffix)
+                            if _append_report(part_file, rolling_file):
+                                part_file.unlink()
+                            else:
+                                kept_file = os.path.join(args.output_dir, stem + suffix)
+                                os.replace(part_file, kept_file)
+                                _log(f"{path} has different columns to {rolling_file}, so its report was written to {kept_file} instead.")
+                    stats.record(counts, mtime)
+                    state[path] = [*stamp, 'done']
+                _save_state(state_path, state)
+            stats.maybe_log(len(queued), len(in_flight))
+    except KeyboardInterrupt:
+        _log("Stopping, waiting for running files to finish...")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        stats.maybe_log(len(queued), 0, force=True)
+        _log(f"Interpreted {stats.total_files} files ({stats.total_failed} failed).")